@@ -1,170 +1,240 @@
-import asyncio
 import json
 from datetime import datetime, timezone
-from pathlib import Path
+from typing import AsyncIterator
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import (APIRouter, Depends, Header, HTTPException, Query,
+                     Request, Response, WebSocket)
 from fastapi.responses import JSONResponse
 from loguru import logger
-from pydantic import ValidationError
 from redis.asyncio import Redis
 from sse_starlette.sse import EventSourceResponse
+from starlette.status import WS_1008_POLICY_VIOLATION
+from suz_shared.codec import decode_task
+from suz_shared.redis_cache import CachedRedis
 
 from settings import settings
-from schemas.feedback import FeedbackItem, TaskFeedback
-from schemas.task import Task, TaskCreate, TaskStatus
-from utils.auth_utils import get_current_user
-from utils.redis_utils import set_task_to_queue, update_task_position
+from schemas.feedback import (FeedbackItem, FeedbackKind, FeedbackRecord,
+                              TaskFeedback)
+from schemas.task import TaskCreate, TaskStatus
+from utils.auth_utils import get_current_user, validate_token
+from utils.feedback_utils import (FeedbackQueueFull, FeedbackStore,
+                                  InvalidFeedbackId)
+from utils.metrics_utils import realtime_connections
+from utils.pubsub_utils import Broadcast
+from utils.realtime_utils import RealtimeChannel
+from utils.redis_functions import set_task_feedback
+from utils.redis_utils import (get_redis, get_user_tasks,
+                               set_task_position, set_task_to_queue)
 from utils.gp_utils import run_query
 
-FEEDBACK_FILE = Path(__file__).parent / 'feedback.json'
-
 router = APIRouter(prefix='/api/v1')
 
 
 @router.post('/enqueue')
-async def enqueue_task(request: Request, task: TaskCreate):
-    user_id = await get_current_user(request, request.app.state.redis)
+async def enqueue_task(request: Request, task: TaskCreate,
+                       user_id: str = Depends(get_current_user)):
     if not task.handler_id or task.handler_id == 'default':
         raise HTTPException(status_code=405, detail='Invalid handler_id')
     task_id, short_id = await set_task_to_queue(user_id, task, request.app)
     return {'task_id': task_id, 'short_task_id': short_id}
 
 
+@router.websocket('/realtime')
+async def realtime_channel(websocket: WebSocket,
+                           redis: CachedRedis = Depends(get_redis)):
+    """Updates of subscribed tasks and handlers, one channel per tab"""
+    # CORS does not apply to WebSockets, cookie is sent from any origin
+    if websocket.headers.get('origin') != settings.FRONTEND_URL:
+        await websocket.close(code=WS_1008_POLICY_VIOLATION)
+        return
+    try:
+        user_id = await validate_token(
+            websocket.cookies.get('access_token', ''), redis)
+    except HTTPException:
+        await websocket.close(code=WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    realtime_connections.labels('websocket').inc()
+    try:
+        await RealtimeChannel(websocket.app, websocket, user_id).serve()
+    finally:
+        realtime_connections.labels('websocket').dec()
+
+
 @router.get('/subscribe/{task_id}')
-async def subscribe_stream_status(request: Request, task_id: str):
-    redis: Redis = request.app.state.redis
+async def subscribe_stream_status(request: Request, task_id: str,
+                                  redis: Redis = Depends(get_redis)):
+    """Stream of one task, superseded by /realtime"""
+    queue_events: Broadcast = request.app.state.queue_events
+    task_key = f'task:{task_id}'
+
     async def event_generator():
+        raw_task = await redis.hgetall(task_key)
+        if not raw_task:
+            return
+        task = decode_task(raw_task)
         last_status = ''
         last_position = -1
         while True:
-            await update_task_position(task_id, redis)
-            raw_task = await redis.get(f'task:{task_id}')
-            if not raw_task:
+            # subscribe before reading, so no change is missed in between
+            wait_changes = queue_events.waiter(task_key, task.handler_id)
+            status, queue_ticket = await redis.hmget(
+                task_key, 'status', 'queue_ticket')
+            if not status:
                 break
-            task = Task.model_validate_json(raw_task)
-            status = task.status
+            task.status = TaskStatus(status)
+            task.queue_ticket = int(queue_ticket)
+            finished = task.status in [
+                TaskStatus.COMPLETED, TaskStatus.FAILED]
+            if finished:
+                # result and error are read once, when they are final
+                raw_task = await redis.hgetall(task_key)
+                if not raw_task:
+                    break
+                task = decode_task(raw_task)
+            await set_task_position(request.app, task)
             position = task.current_position
-            if status != last_status or position != last_position:
+            if task.status != last_status or position != last_position:
                 yield task.model_dump_json(indent=2)
                 last_status = task.status
-            if task.status in [TaskStatus.COMPLETED, TaskStatus.FAILED]:
-                task.finished_at = datetime.now(timezone.utc).isoformat()
-                await redis.setex(
-                    f'task:{task_id}', 86400, task.model_dump_json())
+                last_position = position
+            if finished:
                 break
-            await asyncio.sleep(1)
-    return EventSourceResponse(event_generator())
+            # timeout only guards against lost notifications
+            await wait_changes(timeout=30)
+    return EventSourceResponse(__counted_stream(event_generator()))
+
+
+async def __counted_stream(events: AsyncIterator[str]) -> AsyncIterator[str]:
+    realtime_connections.labels('sse').inc()
+    try:
+        async for event in events:
+            yield event
+    finally:
+        realtime_connections.labels('sse').dec()
 
 
 @router.post('/feedback/{task_id}')
 async def submit_task_feedback(
-        request: Request, task_id: str, feedback: TaskFeedback):
-    redis: Redis = request.app.state.redis
-    user_id = await get_current_user(request, redis)
-    task = Task.model_validate_json(await redis.get(f'task:{task_id}'))
-    if task.user_id != user_id:
+        request: Request, task_id: str, feedback: TaskFeedback,
+        user_id: str = Depends(get_current_user),
+        redis: Redis = Depends(get_redis)):
+    task_user_id = await redis.hget(f'task:{task_id}', 'user_id')
+    if task_user_id is None:
+        raise HTTPException(status_code=404, detail='Task not found')
+    if task_user_id != user_id:
         raise HTTPException(status_code=403, detail='Forbidden')
-    task.feedback = feedback
-    await redis.setex(f'task:{task_id}', 3600, task.model_dump_json())
+    await set_task_feedback(redis, task_id, feedback)
+    __store_feedback(request, FeedbackRecord(
+        created_at=datetime.now(timezone.utc).isoformat(),
+        kind=FeedbackKind.TASK, user_id=user_id, task_id=task_id,
+        feedback=feedback.feedback.value))
 
 
 @router.get('/tasks')
-async def list_queued_tasks_by_user(request: Request):
-    redis: Redis = request.app.state.redis
-    user_id = await get_current_user(request, redis)
-    tasks: list[Task] = []
-    if not user_id:
-        return tasks
-    cursor = 0
-    while True:
-        cursor, keys = await redis.scan(cursor, match='task:*', count=100)
-        for task_id in keys:
-            try:
-                raw_task = await redis.get(task_id)
-                if not raw_task:
-                    continue
-                task = Task.model_validate_json(raw_task)
-            except ValidationError as e:
-                logger.warning(f'Ошибка валидации задачи {task_id}: {e}')
-                continue
-            if task.user_id == user_id:
-                tasks.append(task)
-        if cursor == 0:
-            break
-    tasks.sort(key=lambda t: datetime.fromisoformat(t.queued_at))
-    tasks_as_json = [task.model_dump_json(indent=2) for task in tasks]
-    return tasks_as_json
+async def list_queued_tasks_by_user(
+        request: Request, response: Response,
+        limit: int = Query(100, ge=1, le=500), cursor: str | None = None,
+        user_id: str = Depends(get_current_user)):
+    """Page of user tasks in queued order, next page cursor in header"""
+    return await __tasks_page(
+        request, response, user_id, False, limit, cursor)
+
 
 @router.get('/first-tasks')
-async def list_queued_tasks_by_user(request: Request):
-    redis: Redis = request.app.state.redis
-    user_id = await get_current_user(request, redis)
-    tasks: list[Task] = []
+async def list_first_tasks_by_user(
+        request: Request, response: Response,
+        limit: int = Query(100, ge=1, le=500), cursor: str | None = None,
+        user_id: str = Depends(get_current_user)):
+    """Page of user first tasks in queued order"""
+    return await __tasks_page(
+        request, response, user_id, True, limit, cursor)
+
+
+async def __tasks_page(
+        request: Request, response: Response, user_id: str,
+        first_only: bool, limit: int, cursor: str | None) -> list[str]:
     if not user_id:
-        return tasks
-    cursor = 0
-    while True:
-        cursor, keys = await redis.scan(cursor, match='task:*', count=100)
-        for task_id in keys:
-            try:
-                raw_task = await redis.get(task_id)
-                if not raw_task:
-                    continue
-                task = Task.model_validate_json(raw_task)
-            except ValidationError as e:
-                logger.warning(f'Ошибка валидации задачи {task_id}: {e}')
-                continue
-            if (task.user_id == user_id) and task.is_first:
-                tasks.append(task)
-        if cursor == 0:
-            break
-    tasks.sort(key=lambda t: datetime.fromisoformat(t.queued_at))
-    tasks_as_json = [task.model_dump_json(indent=2) for task in tasks]
-    return tasks_as_json
+        return []
+    try:
+        tasks, next_cursor = await get_user_tasks(
+            request.app, user_id, first_only, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return [task.model_dump_json(indent=2) for task in reversed(tasks)]
+
 
 @router.post('/feedback')
-async def submit_feedback(feedback: FeedbackItem):
+async def submit_feedback(request: Request, feedback: FeedbackItem):
     """Endpoint для сохранения обратной связи"""
+    __store_feedback(request, FeedbackRecord(
+        created_at=datetime.now(timezone.utc).isoformat(),
+        kind=FeedbackKind.MESSAGE, user_id=await __optional_user(request),
+        text=feedback.text, contact=feedback.contact or ''))
+    return {'status': 'success', 'message': 'Feedback received'}
 
-    def ensure_feedback_file_exists():
-        """Создать файл для хранения отзывов, если он не существует"""
-        if not FEEDBACK_FILE.exists():
-            with open(FEEDBACK_FILE, 'w', encoding='utf-8') as fb_file:
-                json.dump([], fb_file, ensure_ascii=False, indent=2)
-
-    ensure_feedback_file_exists()
 
+@router.get('/feedback')
+async def query_feedback(
+        request: Request, kind: FeedbackKind | None = None,
+        task_id: str | None = None, since: str | None = None,
+        until: str | None = None, after_id: str = '',
+        limit: int = Query(100, ge=1, le=1000),
+        x_api_key: str = Header('')) -> list[FeedbackRecord]:
+    """Stored feedback in id order, next page starts after last id"""
+    __check_admin(x_api_key)
+    feedback_store: FeedbackStore = request.app.state.feedback_store
     try:
-        with open(FEEDBACK_FILE, 'r', encoding='utf-8') as f:
-            feedbacks = json.load(f)
+        return await feedback_store.query(
+            kind, task_id, since, until, after_id, limit)
+    except InvalidFeedbackId:
+        raise HTTPException(status_code=400, detail='Invalid after_id')
 
-        new_feedback = {
-            'text': feedback.text,
-            'contact': feedback.contact,
-            'timestamp': datetime.now().isoformat()
-        }
-        feedbacks.append(new_feedback)
 
-        with open(FEEDBACK_FILE, 'w', encoding='utf-8') as f:
-            json.dump(feedbacks, f, ensure_ascii=False, indent=2)
+@router.get('/cache-stats')
+async def redis_cache_stats(
+        redis: CachedRedis = Depends(get_redis),
+        x_api_key: str = Header('')) -> dict[str, float]:
+    """Hit rate and size of Redis client-side cache of this instance"""
+    __check_admin(x_api_key)
+    return redis.cache_stats()
 
-        return {'status': 'success', 'message': 'Feedback received'}
 
-    except Exception as e:
+def __check_admin(x_api_key: str):
+    if not settings.ADMIN_API_KEY or x_api_key != settings.ADMIN_API_KEY:
+        raise HTTPException(status_code=403, detail='Forbidden')
+
+
+def __store_feedback(request: Request, record: FeedbackRecord):
+    feedback_store: FeedbackStore = request.app.state.feedback_store
+    try:
+        feedback_store.submit(record)
+    except FeedbackQueueFull:
         raise HTTPException(
-            status_code=500,
-            detail=f'Failed to save feedback: {str(e)}'
-        )
+            status_code=503, detail='Feedback queue is full, retry later')
+
+
+async def __optional_user(request: Request) -> str:
+    """Feedback form works for anonymous users as well"""
+    try:
+        return await get_current_user(request)
+    except HTTPException:
+        return ''
 
 
 @router.get('/handlers/stream')
 async def available_handlers_stream(request: Request):
+    """Stream of available handlers, superseded by /realtime"""
     # FIXME: если сервер остановить - frontend зависнет со старыми данными,
     #  доработать обработку ошибок на фронте
+    queue_events: Broadcast = request.app.state.queue_events
+
     async def event_generator():
         last_data = None
         while True:
+            wait_changes = queue_events.waiter('handlers')
             handlers = request.app.state.available_handlers
             configs = request.app.state.handlers_configs
             handlers_with_configs = {
@@ -174,9 +244,9 @@ async def available_handlers_stream(request: Request):
                 logger.debug(
                     f'ℹ️ Available handlers quantity updated: {handlers}')
                 yield json.dumps(handlers_with_configs)
-            await asyncio.sleep(3)
+            await wait_changes(30)
 
-    return EventSourceResponse(event_generator())
+    return EventSourceResponse(__counted_stream(event_generator()))
 
 
 @router.get('/test_gp')
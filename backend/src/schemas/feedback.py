@@ -1,19 +1,24 @@
 from enum import Enum
-from typing import Optional
 
 from pydantic import BaseModel
+from suz_shared.schemas.feedback import (FeedbackItem, TaskFeedback,
+                                         TaskFeedbackType)
 
+__all__ = ['FeedbackItem', 'FeedbackKind', 'FeedbackRecord', 'TaskFeedback',
+           'TaskFeedbackType']
 
-class TaskFeedbackType(str, Enum):
-    LIKE = 'like'
-    DISLIKE = 'dislike'
-    NEUTRAL = 'neutral'
 
+class FeedbackKind(str, Enum):
+    MESSAGE = 'message'  # free-form feedback form
+    TASK = 'task'  # like/dislike of a task answer
 
-class FeedbackItem(BaseModel):
-    text: str
-    contact: Optional[str] = None
 
-
-class TaskFeedback(BaseModel):
-    feedback: TaskFeedbackType = TaskFeedbackType.NEUTRAL
+class FeedbackRecord(BaseModel):
+    id: str | None = None  # stream entry id
+    created_at: str
+    kind: FeedbackKind
+    user_id: str = ''
+    task_id: str = ''
+    feedback: str = ''
+    text: str = ''
+    contact: str = ''
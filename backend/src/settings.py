@@ -18,19 +18,54 @@ class Settings(BaseSettings):
     FRONTEND_PORT: int = 5000
     REDIS_PORT: int = 6379
     REDIS_DB: int = 0
+    REDIS_MAX_CONNECTIONS: int = 200
+    REDIS_POOL_TIMEOUT: float = 5
+    # a stuck command fails instead of hanging its request
+    REDIS_SOCKET_TIMEOUT: float = 10
+    REDIS_CONNECT_TIMEOUT: float = 5
+    REDIS_CACHE_SIZE: int = 10000
+    REDIS_CACHE_TTL: float = 5
 
     ACCESS_TOKEN_EXPIRE_DAYS: int = 90
     JWT_ALGORITHM: str = 'HS256'
+    AUTH_CACHE_SIZE: int = 10000
+    AUTH_CACHE_TTL: int = 600
+    TOKEN_RENEW_INTERVAL: int = 24 * 3600
     SECRET_KEY: str
+    TASK_TTL: int = 86400
+    WORKER_TTL: int = 30
+    WORKER_PRUNE_INTERVAL: int = 5
+    QUEUE_MIGRATION_BATCH: int = 1000
+    LEADER_LEASE_TTL: float = 5
+    LEADER_RETRY_INTERVAL: float = 1
+    REALTIME_MAX_SUBSCRIPTIONS: int = 500
     USE_GP_COLD_STORE: bool = False
     GP_HOST: str = ''
     GP_PORT: int = 5432
     GP_DATABASE: str = ''
     GP_SCHEMA: str = ''
     GP_TABLE: str = ''
+    COLD_STORE_BATCH: int = 500
+    COLD_STORE_FLUSH_INTERVAL: int = 5
+    COLD_STORE_CLAIM_IDLE: int = 60
+    HISTORY_CACHE_SIZE: int = 1024
+    HISTORY_CACHE_TTL: int = 60
+    FEEDBACK_QUEUE_SIZE: int = 10000
+    FEEDBACK_BATCH: int = 500
+    FEEDBACK_STREAM_MAXLEN: int = 1000000
+    ADMIN_API_KEY: str = ''
+    JOURNAL_DIR: str = 'journal'
+    JOURNAL_FLUSH_INTERVAL: int = 1
+    JOURNAL_ROTATE_SIZE: int = 64 * 1024 * 1024
+    JOURNAL_ROTATE_INTERVAL: int = 3600
+    JOURNAL_RETENTION_DAYS: int = 7
     GP_USERNAME: str = os.getenv('GP_USERNAME', '')
     GP_PASSWORD: str = os.getenv('GP_PASSWORD', '')
 
+    @property
+    def FRONTEND_URL(self) -> str:
+        return f'http://{self.HOST}:{self.FRONTEND_PORT}'
+
     @classmethod
     def settings_customise_sources(
         cls,
@@ -2,14 +2,19 @@ from datetime import datetime, timedelta
 import uuid
 
 from redis.asyncio import Redis
+from suz_shared.redis_cache import CachedRedis
 from jose import jwt, JWTError
 from fastapi import HTTPException, Request
 
 from settings import settings
+from utils.cache_utils import TTLCache
 
 SECRET_KEY = settings.SECRET_KEY
 ALGORITHM = settings.JWT_ALGORITHM
 ACCESS_TOKEN_EXPIRE_DAYS = settings.ACCESS_TOKEN_EXPIRE_DAYS
+TOKEN_TTL = ACCESS_TOKEN_EXPIRE_DAYS * 24 * 3600
+
+token_cache = TTLCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL)
 
 
 def create_guest_user():
@@ -27,40 +32,57 @@ def create_access_token(data: dict):
 async def store_new_token(redis: Redis):
     user_id = create_guest_user()
     token = create_access_token(data={'sub': user_id})
-    await redis.setex(f'token:{token}', 90 * 24 * 3600, user_id)
+    await redis.setex(f'token:{token}', TOKEN_TTL, user_id)
     return token
 
 
-async def get_current_user(request: Request, redis: Redis):
-    token = request.cookies.get('access_token')
-    if not token:
-        raise HTTPException(status_code=401, detail='Not authenticated')
-
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get('sub')
+async def validate_token(token: str, redis: CachedRedis) -> str:
+    """User id of valid token.
+
+    Token key is read through the client-side cache, so a revoked token
+    is rejected as soon as Redis invalidates it. JWT is decoded and
+    token key with its ttl is read in one round trip once per
+    AUTH_CACHE_TTL, the ttl is extended only when the token is older
+    than TOKEN_RENEW_INTERVAL.
+    """
+    token_key = f'token:{token}'
+    user_id = token_cache.get(token)
+    checked = user_id is not None
+    if not checked:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            raise HTTPException(status_code=401, detail='Invalid token')
+        user_id = payload.get('sub')
         if user_id is None:
             raise HTTPException(status_code=401, detail='Invalid token')
 
-        stored_user_id = await redis.get(f'token:{token}')
-        if stored_user_id != user_id:
-            raise HTTPException(
-                status_code=401, detail='Token invalid or revoked')
-
+    if checked:
+        stored_user_id = await redis.cached_get(token_key)
+    else:
+        async with redis.pipeline(transaction=False) as pipe:
+            await pipe.get(token_key)
+            await pipe.ttl(token_key)
+            stored_user_id, ttl = await pipe.execute()
+    if stored_user_id != user_id:
+        token_cache.pop(token)
+        raise HTTPException(
+            status_code=401, detail='Token invalid or revoked')
+    if not checked:
+        if ttl < TOKEN_TTL - settings.TOKEN_RENEW_INTERVAL:
+            await redis.expire(token_key, TOKEN_TTL)
+        token_cache.set(token, user_id)
+    return user_id
+
+
+async def get_current_user(request: Request) -> str:
+    """Dependency: user of request token, validated once per request"""
+    user_id = getattr(request.state, 'user_id', None)
+    if user_id is not None:
         return user_id
-
-    except JWTError:
-        raise HTTPException(status_code=401, detail='Invalid token')
-
-
-async def renew_token(token: str, redis: Redis):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get('sub')
-        if not user_id or await redis.get(f'token:{token}') != user_id:
-            raise
-    except Exception:
-        raise HTTPException(status_code=401, detail='Invalid token')
-
-
-    await redis.expire(f'token:{token}', 90 * 24 * 3600)
+    token = request.cookies.get('access_token')
+    if not token:
+        raise HTTPException(status_code=401, detail='Not authenticated')
+    user_id = await validate_token(token, request.app.state.redis)
+    request.state.user_id = user_id
+    return user_id
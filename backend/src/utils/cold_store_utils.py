@@ -0,0 +1,147 @@
+"""Change data capture of finished tasks into Greenplum.
+
+Consumer group `greenplum` of `task_changes` stream (see stream_utils)
+picks completions, final failures and feedback changes. Latest state of
+the changed tasks is loaded into a temporary staging table with COPY
+and moved to the cold store table by a few set-based statements, so the
+cost is proportional to changes, not to the number of tasks in Redis.
+"""
+import json
+from datetime import datetime
+
+from loguru import logger
+from redis.asyncio import Redis
+
+from schemas.task import Task, TaskStatus
+from settings import settings
+from utils.gp_utils import get_pg_conn, run_query
+from utils.stream_utils import (StreamEntry, consume_task_changes,
+                                fetch_changed_tasks)
+
+CONSUMER_GROUP = 'greenplum'
+COLD_STORE_EVENTS = {
+    TaskStatus.COMPLETED.value, TaskStatus.FAILED.value, 'feedback'}
+
+COLUMNS = (
+    'task_id', 'prompt', 'status', 'task_type', 'user_id', 'short_task_id',
+    'queued_at', 'finished_at', 'context', 'retries', 'start_position',
+    'current_position', 'result_text', 'result_relevant_docs',
+    'error_text', 'error_relevant_docs', 'feedback', 'handler_id',
+    'is_first')
+
+
+async def create_cold_store_table(table_name: str):
+    table = f'{settings.GP_SCHEMA}.{table_name}'
+    await run_query(f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        task_id TEXT,
+        prompt TEXT,
+        status TEXT,
+        task_type TEXT,
+        user_id TEXT,
+        short_task_id TEXT,
+        queued_at TIMESTAMP WITH TIME ZONE,
+        finished_at TIMESTAMP WITH TIME ZONE,
+        context TEXT,
+        retries INTEGER,
+        start_position INTEGER,
+        current_position INTEGER,
+        result_text TEXT,
+        result_relevant_docs JSONB,
+        error_text TEXT,
+        error_relevant_docs JSONB,
+        feedback TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        handler_id TEXT,
+        is_first BOOLEAN
+    ) DISTRIBUTED RANDOMLY;
+    """)
+    logger.info(f'ℹ️ Table {table} created or already exists')
+
+    # tables created before history columns (no ADD COLUMN IF NOT EXISTS)
+    for column in ('handler_id TEXT', 'is_first BOOLEAN'):
+        try:
+            await run_query(f'ALTER TABLE {table} ADD COLUMN {column}')
+        except Exception as e:
+            logger.debug(f'ℹ️ Possible duplicate column: {e}')
+
+    for name, columns in (('task_id', 'task_id'), ('status', 'status'),
+                          ('user_id', 'user_id, queued_at')):
+        try:
+            await run_query(
+                f'CREATE INDEX idx_{table_name}_{name} '
+                f'ON {table} ({columns})')
+        except Exception as e:
+            logger.warning(f'⚠️ Possible duplicate index: {e}')
+
+
+async def sync_task_changes(redis: Redis, table_name: str):
+    """Load task changes from Redis stream into cold store table"""
+    await create_cold_store_table(table_name)
+
+    async def load_batch(entries: list[StreamEntry]):
+        tasks = await fetch_changed_tasks(redis, entries, COLD_STORE_EVENTS)
+        if tasks:
+            await __upsert_tasks(table_name, tasks)
+        logger.info(
+            f'ℹ️ Cold store: {len(entries)} changes, '
+            f'{len(tasks)} tasks loaded')
+
+    await consume_task_changes(
+        redis, CONSUMER_GROUP, load_batch, settings.COLD_STORE_BATCH,
+        settings.COLD_STORE_FLUSH_INTERVAL, settings.COLD_STORE_CLAIM_IDLE)
+
+
+async def __upsert_tasks(table_name: str, tasks: list[Task]):
+    table = f'{settings.GP_SCHEMA}.{table_name}'
+    stage = f'{table_name}_stage'
+    async with get_pg_conn() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                f'CREATE TEMP TABLE {stage} '
+                f'(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP')
+            await conn.copy_records_to_table(
+                stage, records=[__task_record(task) for task in tasks],
+                columns=COLUMNS)
+            await conn.execute(
+                f'UPDATE {stage} s SET created_at = t.created_at '
+                f'FROM {table} t WHERE t.task_id = s.task_id')
+            await conn.execute(
+                f'DELETE FROM {table} t USING {stage} s '
+                f'WHERE t.task_id = s.task_id')
+            await conn.execute(f'INSERT INTO {table} SELECT * FROM {stage}')
+
+
+def __task_record(task: Task) -> tuple:
+    return (
+        task.task_id,
+        task.prompt,
+        task.status.value,
+        task.task_type,
+        task.user_id,
+        task.short_task_id,
+        __parse_datetime(task.queued_at),
+        __parse_datetime(task.finished_at),
+        task.context,
+        task.retries,
+        task.start_position,
+        task.current_position,
+        task.result.text,
+        json.dumps(task.result.relevant_docs, ensure_ascii=False),
+        task.error.text,
+        json.dumps(task.error.relevant_docs, ensure_ascii=False),
+        task.feedback.feedback.value,
+        task.handler_id,
+        task.is_first,
+    )
+
+
+def __parse_datetime(value: str) -> datetime | None:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        logger.warning(f'⚠️ Failed to parse datetime "{value}"')
+        return None
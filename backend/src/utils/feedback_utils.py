@@ -0,0 +1,225 @@
+"""Append-only feedback store shared by backend instances.
+
+Feedback form messages and task likes are appended to `feedback` Redis
+stream, so every instance reads and exports records of all instances;
+stream entry ids are record ids. Requests only put records into a
+bounded queue, one background writer per instance appends them in
+batches, a batch per round trip. The stream keeps about `maxlen` latest
+records.
+
+With cold store enabled the leader copies new records to
+`<GP_TABLE>_feedback` table through consumer group `greenplum` of the
+stream (see stream_utils), export position is kept by the group.
+"""
+import asyncio
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+
+from loguru import logger
+from pydantic import ValidationError
+from redis.asyncio import Redis
+from redis.exceptions import RedisError, ResponseError
+
+from schemas.feedback import FeedbackKind, FeedbackRecord
+from settings import settings
+from utils.gp_utils import get_pg_conn, run_query
+from utils.stream_utils import StreamEntry, consume_stream
+
+# feedback file of older versions, imported once
+LEGACY_FEEDBACK_FILE = (
+        Path(__file__).parents[1] / 'api' / 'v1' / 'feedback.json')
+
+FEEDBACK_STREAM = 'feedback'
+CONSUMER_GROUP = 'greenplum'
+# stream entries read per round trip of a filtered query
+QUERY_SCAN_COUNT = 1000
+
+COLUMNS = ('id', 'created_at', 'kind', 'user_id', 'task_id', 'feedback',
+           'text', 'contact')
+
+
+class FeedbackQueueFull(Exception):
+    pass
+
+
+class InvalidFeedbackId(Exception):
+    pass
+
+
+class FeedbackStore:
+    def __init__(self, redis: Redis, queue_size: int, batch_size: int,
+                 maxlen: int):
+        self.redis = redis
+        self.batch_size = batch_size
+        self.maxlen = maxlen
+        self.queue: asyncio.Queue[FeedbackRecord] = asyncio.Queue(queue_size)
+        self._writer: asyncio.Task | None = None
+
+    async def open(self):
+        await self._import_legacy_file()
+
+    def submit(self, record: FeedbackRecord):
+        """Queue record for writing, raise FeedbackQueueFull if overloaded"""
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            raise FeedbackQueueFull()
+
+    def start(self):
+        self._writer = asyncio.create_task(self._run_writer())
+
+    async def stop(self, timeout: float = 10.0):
+        """Let writer store queued records, then stop it"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f'⚠️ {self.queue.qsize()} feedback records were not saved')
+        self._writer.cancel()
+        # a batch being written must not outlive the connection
+        await asyncio.gather(self._writer, return_exceptions=True)
+
+    async def _run_writer(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            while True:
+                try:
+                    await self._write(batch)
+                    break
+                except RedisError as e:
+                    logger.error(f'‼️ Feedback write failed, retrying: {e}')
+                    await asyncio.sleep(1)
+            for _ in batch:
+                self.queue.task_done()
+
+    async def query(self, kind: FeedbackKind | None = None,
+                    task_id: str | None = None, since: str | None = None,
+                    until: str | None = None, after_id: str = '',
+                    limit: int = 100) -> list[FeedbackRecord]:
+        """Records in id order, filtered, starting after `after_id`.
+
+        Raises InvalidFeedbackId for malformed `after_id`.
+        """
+        records = []
+        start = f'({after_id}' if after_id else '-'
+        while True:
+            try:
+                entries = await self.redis.xrange(
+                    FEEDBACK_STREAM, start, '+', count=QUERY_SCAN_COUNT)
+            except ResponseError as e:
+                raise InvalidFeedbackId(str(e))
+            for entry_id, fields in entries:
+                record = _record(entry_id, fields)
+                if record is None or not (
+                        (kind is None or record.kind == kind)
+                        and (not task_id or record.task_id == task_id)
+                        and (not since or record.created_at >= since)
+                        and (not until or record.created_at < until)):
+                    continue
+                records.append(record)
+                if len(records) == limit:
+                    return records
+            if len(entries) < QUERY_SCAN_COUNT:
+                return records
+            start = f'({entries[-1][0]}'
+
+    async def export_to_greenplum(self, table_name: str):
+        """Copy new records to cold store table until cancelled"""
+        table = f'{settings.GP_SCHEMA}.{table_name}'
+        await run_query(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id TEXT,
+            created_at TIMESTAMP WITH TIME ZONE,
+            kind TEXT,
+            user_id TEXT,
+            task_id TEXT,
+            feedback TEXT,
+            text TEXT,
+            contact TEXT
+        ) DISTRIBUTED RANDOMLY;
+        """)
+
+        async def load_batch(entries: list[StreamEntry]):
+            rows = []
+            for entry_id, fields in entries:
+                # fields of entries trimmed before they were claimed
+                record = _record(entry_id, fields) if fields else None
+                if record is None:
+                    continue
+                try:
+                    created_at = datetime.fromisoformat(record.created_at)
+                except ValueError:
+                    # skipped for good: the entry is acknowledged anyway
+                    logger.warning(
+                        f'⚠️ Feedback record {entry_id} not exported, '
+                        f'bad created_at: {record.created_at!r}')
+                    continue
+                rows.append((entry_id, created_at, record.kind.value,
+                             record.user_id, record.task_id,
+                             record.feedback, record.text, record.contact))
+            async with get_pg_conn() as conn:
+                async with conn.transaction():
+                    # entries of failed batches are delivered again
+                    await conn.execute(
+                        f'DELETE FROM {table} WHERE id = ANY($1::text[])',
+                        [entry_id for entry_id, _ in entries])
+                    if rows:
+                        await conn.copy_records_to_table(
+                            table_name,
+                            schema_name=settings.GP_SCHEMA or None,
+                            records=rows, columns=COLUMNS)
+            logger.info(f'ℹ️ {len(rows)} feedback records exported')
+
+        await consume_stream(
+            self.redis, FEEDBACK_STREAM, CONSUMER_GROUP, load_batch,
+            self.batch_size, settings.COLD_STORE_FLUSH_INTERVAL,
+            settings.COLD_STORE_CLAIM_IDLE)
+
+    async def _write(self, batch: list[FeedbackRecord]):
+        # all or nothing: a retried batch is not appended twice
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for record in batch:
+                pipe.xadd(FEEDBACK_STREAM,
+                          record.model_dump(mode='json', exclude={'id'}),
+                          maxlen=self.maxlen, approximate=True)
+            await pipe.execute()
+
+    async def _import_legacy_file(self):
+        if not LEGACY_FEEDBACK_FILE.exists():
+            return
+        with open(LEGACY_FEEDBACK_FILE, encoding='utf-8') as f:
+            items = json.load(f)
+        modified_at = datetime.fromtimestamp(
+            LEGACY_FEEDBACK_FILE.stat().st_mtime)
+        for i in range(0, len(items), self.batch_size):
+            await self._write([
+                FeedbackRecord(created_at=_legacy_created_at(
+                                   item.get('timestamp'), modified_at),
+                               kind=FeedbackKind.MESSAGE,
+                               text=item.get('text', ''),
+                               contact=item.get('contact') or '')
+                for item in items[i:i + self.batch_size]])
+        LEGACY_FEEDBACK_FILE.rename(
+            LEGACY_FEEDBACK_FILE.with_suffix('.json.imported'))
+        logger.info(f'ℹ️ {len(items)} feedback records imported')
+
+
+def _record(entry_id: str, fields: dict[str, str]) -> FeedbackRecord | None:
+    try:
+        return FeedbackRecord(id=entry_id, **fields)
+    except ValidationError as e:
+        logger.warning(f'⚠️ Invalid feedback record {entry_id}: {e}')
+        return None
+
+
+def _legacy_created_at(timestamp: str | None, default: datetime) -> str:
+    """UTC ISO time of legacy record, saved in server local time"""
+    try:
+        created_at = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        created_at = default
+    # naive time is taken as local
+    return created_at.astimezone(timezone.utc).isoformat()
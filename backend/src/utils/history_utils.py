@@ -0,0 +1,98 @@
+"""User task history in the Greenplum cold store.
+
+Older pages of `/tasks` and `/first-tasks` are read from the cold store
+table when Redis index of the user is exhausted. Pages use keyset
+pagination over (queued_at, task_id) with cursor
+`<queued_at unix time in microseconds>_<task_id>`, the query is reused
+from the asyncpg statement cache of the pooled connection. Finished
+tasks rarely change, so pages are cached in process for
+HISTORY_CACHE_TTL.
+"""
+import json
+from datetime import datetime, timedelta, timezone
+
+from asyncpg import Record
+
+from schemas.answer import Answer
+from schemas.feedback import TaskFeedback
+from schemas.task import Task
+from settings import settings
+from utils.cache_utils import TTLCache
+from utils.gp_utils import get_pg_conn
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+history_cache = TTLCache(settings.HISTORY_CACHE_SIZE,
+                         settings.HISTORY_CACHE_TTL)
+
+Keyset = tuple[datetime, str]
+
+
+def make_cursor(queued_at: datetime, task_id: str) -> str:
+    return f'{(queued_at - EPOCH) // timedelta(microseconds=1)}_{task_id}'
+
+
+def parse_cursor(cursor: str) -> Keyset:
+    """(queued_at, task_id) of cursor, raises ValueError if malformed"""
+    micros, _, task_id = cursor.partition('_')
+    return EPOCH + timedelta(microseconds=int(micros)), task_id
+
+
+def task_keyset(task: Task) -> Keyset:
+    return datetime.fromisoformat(task.queued_at), task.task_id
+
+
+async def get_cold_user_tasks(
+        user_id: str, first_only: bool, limit: int,
+        before: Keyset | None) -> list[Task]:
+    """Page of user tasks from cold store strictly before keyset"""
+    cache_key = (user_id, first_only, limit, before)
+    tasks = history_cache.get(cache_key)
+    if tasks is not None:
+        return tasks
+
+    table = f'{settings.GP_SCHEMA}.{settings.GP_TABLE}'
+    before_at, before_id = before or (None, '')
+    async with get_pg_conn() as conn:
+        rows = await conn.fetch(f"""
+            SELECT * FROM {table}
+            WHERE user_id = $1
+              AND ($2 OR COALESCE(is_first, false))
+              AND ($3::timestamptz IS NULL
+                   OR (queued_at, task_id) < ($3::timestamptz, $4::text))
+            ORDER BY queued_at DESC, task_id DESC
+            LIMIT $5
+        """, user_id, not first_only, before_at, before_id, limit)
+
+    tasks = [__row_to_task(row) for row in rows]
+    history_cache.set(cache_key, tasks)
+    return tasks
+
+
+def __row_to_task(row: Record) -> Task:
+    return Task(
+        task_id=row['task_id'],
+        prompt=row['prompt'] or '',
+        status=row['status'],
+        # rows stored before handler_id column have only task type
+        handler_id=row['handler_id'] or f'{row["task_type"]}:',
+        user_id=row['user_id'],
+        short_task_id=row['short_task_id'] or '',
+        queued_at=row['queued_at'].isoformat() if row['queued_at'] else '',
+        finished_at=(
+            row['finished_at'].isoformat() if row['finished_at'] else ''),
+        is_first=bool(row['is_first']),
+        context=row['context'] or '',
+        retries=row['retries'] or 0,
+        start_position=row['start_position'] or 0,
+        result=Answer(text=row['result_text'] or '',
+                      relevant_docs=__docs(row['result_relevant_docs'])),
+        error=Answer(text=row['error_text'] or '',
+                     relevant_docs=__docs(row['error_relevant_docs'])),
+        feedback=TaskFeedback(feedback=row['feedback'] or 'neutral'),
+    )
+
+
+def __docs(raw_docs: str | None) -> dict[str, str]:
+    # older rows may hold an empty list
+    return json.loads(raw_docs or '{}') or {}
@@ -0,0 +1,154 @@
+"""Append-only journal of task changes.
+
+Consumer group `journal` of `task_changes` stream (see stream_utils)
+appends current state of every changed task to gzip-compressed JSONL
+files `tasks-<UTC time>.jsonl.gz` in JOURNAL_DIR, one line per task per
+batch: {"ts": unix time, "event": last event, "task": task dict}.
+Consumer group position is the checkpoint: entries are acknowledged
+after the batch is flushed to disk. Files are rotated by size and age
+and removed after JOURNAL_RETENTION_DAYS.
+
+State at any moment is rebuilt by replaying journal files in order:
+    python -m utils.journal_utils journal --at 2025-01-01T12:00:00+00:00
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+
+from loguru import logger
+from redis.asyncio import Redis
+
+from utils.stream_utils import (StreamEntry, consume_task_changes,
+                                fetch_changed_tasks)
+
+CONSUMER_GROUP = 'journal'
+FILE_PATTERN = 'tasks-*.jsonl.gz'
+
+
+class TaskJournal:
+    """Writer of rotated gzip JSONL journal files.
+
+    Methods do blocking file IO, call them off the event loop.
+    """
+
+    def __init__(self, directory: str | Path, rotate_size: int,
+                 rotate_interval: int, retention_days: int):
+        self.directory = Path(directory)
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.retention_days = retention_days
+        self.file: gzip.GzipFile | None = None
+        self.path: Path | None = None
+        self.opened_at = 0.0
+        # a write thread may outlive its cancelled caller
+        self._lock = threading.Lock()
+
+    def write(self, lines: list[dict]):
+        """Append lines and flush them, so they survive a crash"""
+        with self._lock:
+            if self.file is None or self.__rotation_due():
+                self.__rotate()
+            for line in lines:
+                self.file.write(json.dumps(
+                    line, ensure_ascii=False, separators=(',', ':')
+                ).encode('utf-8') + b'\n')
+            self.file.flush(zlib.Z_SYNC_FLUSH)
+
+    def rotate(self):
+        with self._lock:
+            self.__rotate()
+
+    def close(self):
+        with self._lock:
+            self.__close()
+
+    def __rotate(self):
+        self.__close()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+        self.path = self.directory / f'tasks-{name}.jsonl.gz'
+        self.file = gzip.open(self.path, 'ab')
+        self.opened_at = time.monotonic()
+        self.__remove_expired()
+
+    def __close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __rotation_due(self) -> bool:
+        return (self.path.stat().st_size >= self.rotate_size
+                or time.monotonic() - self.opened_at >= self.rotate_interval)
+
+    def __remove_expired(self):
+        expire_before = time.time() - self.retention_days * 86400
+        for path in self.directory.glob(FILE_PATTERN):
+            if path != self.path and path.stat().st_mtime < expire_before:
+                path.unlink()
+                logger.info(f'🧹 Journal file removed: {path.name}')
+
+
+async def write_task_journal(redis: Redis, journal: TaskJournal,
+                             batch: int, block: int, claim_idle: int):
+    """Append task changes from Redis stream to journal"""
+    async def write_batch(entries: list[StreamEntry]):
+        tasks = await fetch_changed_tasks(redis, entries)
+        events = {fields['task_id']: fields['event']
+                  for _, fields in entries if fields}
+        ts = time.time()
+        # rotation (and removal of expired files) happens in write too
+        await asyncio.to_thread(journal.write, [
+            {'ts': ts, 'event': events[task.task_id],
+             'task': task.model_dump(mode='json')}
+            for task in tasks])
+        logger.debug(f'ℹ️ Journal: {len(tasks)} tasks written')
+
+    try:
+        await consume_task_changes(
+            redis, CONSUMER_GROUP, write_batch, batch, block, claim_idle)
+    finally:
+        await asyncio.to_thread(journal.close)
+
+
+def read_snapshot(directory: str | Path,
+                  at: datetime | None = None) -> dict[str, dict]:
+    """Tasks state at given moment (latest by default) from journal"""
+    until = at.timestamp() if at else float('inf')
+    tasks: dict[str, dict] = {}
+    for path in sorted(Path(directory).glob(FILE_PATTERN)):
+        for line in __read_lines(path):
+            record = json.loads(line)
+            if record['ts'] > until:
+                return tasks
+            tasks[record['task']['task_id']] = record['task']
+    return tasks
+
+
+def __read_lines(path: Path):
+    with gzip.open(path, 'rb') as f:
+        try:
+            yield from f
+        except EOFError:
+            pass  # file being written: stream is not finished yet
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rebuild tasks snapshot from journal')
+    parser.add_argument('directory')
+    parser.add_argument('--at', type=datetime.fromisoformat, default=None,
+                        help='ISO time with timezone, latest by default')
+    args = parser.parse_args()
+    json.dump(read_snapshot(args.directory, args.at), sys.stdout,
+              ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
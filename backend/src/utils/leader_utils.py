@@ -0,0 +1,125 @@
+"""Leader election among backend instances.
+
+Singleton background jobs (handlers discovery and queue migrations,
+cold store and journal writers, feedback export, DLQ cleanup) run only
+on the instance holding `leader:<name>` lease in Redis. The leader
+renews the lease every third of its ttl and stops the jobs as soon as
+renewal fails or the lease could have expired; a renewal still running
+when only a third of the ttl is left counts as failed. Followers try to
+take the lease every LEADER_RETRY_INTERVAL and immediately when it is
+released, so failover takes at most lease ttl plus retry interval after
+a crash and no time after a clean shutdown.
+"""
+import asyncio
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable
+
+from loguru import logger
+from redis.asyncio import Redis
+
+from utils.pubsub_utils import Broadcast
+from utils.redis_functions import acquire_leadership, release_leadership
+
+Job = Callable[[], Awaitable]
+
+
+class LeaderElection:
+    def __init__(self, redis: Redis, events: Broadcast, name: str,
+                 lease_ttl: float, retry_interval: float):
+        self.redis = redis
+        self.events = events
+        self.name = name
+        self.lease_ttl = lease_ttl
+        self.retry_interval = retry_interval
+        self.id = (f'{socket.gethostname()}:{os.getpid()}:'
+                   f'{uuid.uuid4().hex[:8]}')
+        self.is_leader = False
+        self._renewed_at = 0.0
+        self._jobs: dict[str, Job] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def channel(self) -> str:
+        return f'leader:{self.name}'
+
+    def add_job(self, name: str, job: Job):
+        """Run job while this instance is the leader"""
+        self._jobs[name] = job
+
+    async def run(self):
+        renew_interval = self.lease_ttl / 3
+        while True:
+            # subscribe before trying, so a release is not missed
+            wait_release = self.events.waiter(self.channel)
+            # lease counts from the request, not from the reply
+            attempted_at = time.monotonic()
+            timeout = self.lease_ttl - renew_interval
+            if self.is_leader:
+                # a stuck call must not outlive the lease: the jobs would
+                # go on next to a new leader
+                timeout += self._renewed_at - attempted_at
+            if timeout <= 0:
+                logger.warning('⚠️ Leader lease is about to expire')
+                held = False
+            else:
+                try:
+                    held = await asyncio.wait_for(
+                        acquire_leadership(self.redis, self.name, self.id,
+                                           int(self.lease_ttl * 1000)),
+                        timeout)
+                    if held:
+                        self._renewed_at = attempted_at
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f'⚠️ Leader lease renewal failed: {e!r}')
+                    # another instance may take the lease once it expires
+                    held = self.is_leader and (
+                            time.monotonic() - self._renewed_at
+                            < self.lease_ttl - renew_interval)
+
+            if held and not self.is_leader:
+                self.__start_jobs()
+            elif not held and self.is_leader:
+                await self.__stop_jobs()
+
+            if self.is_leader:
+                await asyncio.sleep(renew_interval)
+            else:
+                await wait_release(self.retry_interval)
+
+    async def release(self):
+        """Stop jobs and hand the lease over to followers"""
+        if not self.is_leader:
+            return
+        await self.__stop_jobs()
+        try:
+            await release_leadership(self.redis, self.name, self.id)
+        except Exception as e:
+            logger.warning(f'⚠️ Leader lease release failed: {e}')
+
+    def __start_jobs(self):
+        logger.info(f'✅️ {self.id} is the {self.name} leader now')
+        self.is_leader = True
+        self._tasks = [
+            asyncio.create_task(job(), name=name)
+            for name, job in self._jobs.items()]
+        for task in self._tasks:
+            task.add_done_callback(self.__log_job_failure)
+
+    async def __stop_jobs(self):
+        logger.warning(f'⚠️ {self.id} is not the {self.name} leader anymore')
+        self.is_leader = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @staticmethod
+    def __log_job_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                f'‼️ Leader job {task.get_name()} failed: {task.exception()}')
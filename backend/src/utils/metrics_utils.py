@@ -0,0 +1,68 @@
+"""Prometheus metrics of backend, served at /metrics.
+
+Counters and histograms are updated in place (one lock and a bucket
+increment per observation). Queue depth, DLQ size and cache gauges are
+read from Redis when metrics are scraped, so they cost nothing between
+scrapes. Task queue wait and processing times are exported by workers.
+"""
+from fastapi import FastAPI
+from prometheus_client import (CONTENT_TYPE_LATEST, Gauge, Histogram,
+                               generate_latest)
+from suz_shared.redis_cache import CachedRedis
+
+REDIS_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+HTTP_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+http_request_seconds = Histogram(
+    'suz_http_request_duration_seconds',
+    'HTTP request time until response headers',
+    ('method', 'route', 'status'), buckets=HTTP_BUCKETS)
+redis_command_seconds = Histogram(
+    'suz_backend_redis_command_duration_seconds',
+    'Redis command latency', ('command',), buckets=REDIS_BUCKETS)
+realtime_connections = Gauge(
+    'suz_realtime_connections', 'Open task and handlers update streams',
+    ('transport',))
+queue_depth = Gauge(
+    'suz_queue_depth', 'Tasks waiting for a worker',
+    ('handler_id', 'queue'))
+processing_tasks = Gauge(
+    'suz_processing_tasks', 'Tasks leased by workers')
+dead_letters = Gauge(
+    'suz_dead_letters', 'Tasks in dead letter queue')
+handler_workers = Gauge(
+    'suz_handler_workers', 'Live workers serving handler', ('handler_id',))
+redis_cache = Gauge(
+    'suz_redis_cache', 'Redis client-side cache stats', ('stat',))
+
+
+def observe_redis_command(command: str, seconds: float):
+    redis_command_seconds.labels(command).observe(seconds)
+
+
+async def render_metrics(fastapi_app: FastAPI) -> tuple[bytes, str]:
+    """Refresh Redis gauges, return exposition and its content type"""
+    redis: CachedRedis = fastapi_app.state.redis
+    available_handlers: dict[str, int] = fastapi_app.state.available_handlers
+    handler_ids = sorted(
+        set(available_handlers) | set(fastapi_app.state.handlers_configs))
+    async with redis.pipeline(transaction=False) as pipe:
+        for handler_id in handler_ids:
+            pipe.llen(f'task_queue:{handler_id}')
+            pipe.llen(f'pending_task_queue:{handler_id}')
+        pipe.llen('processing_queue')
+        pipe.llen('dead_letters')
+        *depths, processing, dlq_size = await pipe.execute()
+
+    queue_depth.clear()
+    handler_workers.clear()
+    for i, handler_id in enumerate(handler_ids):
+        queue_depth.labels(handler_id, 'queued').set(depths[2 * i])
+        queue_depth.labels(handler_id, 'pending').set(depths[2 * i + 1])
+        handler_workers.labels(handler_id).set(
+            available_handlers.get(handler_id, 0))
+    processing_tasks.set(processing)
+    dead_letters.set(dlq_size)
+    for stat, value in redis.cache_stats().items():
+        redis_cache.labels(stat).set(value)
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import weakref
+from typing import Awaitable, Callable
+
+from fastapi import FastAPI
+from loguru import logger
+from redis.asyncio import Redis
+from redis.exceptions import ConnectionError
+from suz_shared.redis_cache import CachedRedis
+
+# idle pub/sub connection is pinged that often, below socket timeout
+PUBSUB_HEALTH_CHECK_INTERVAL = 5
+
+
+class Broadcast:
+    """Wake up every local waiter of a key at once.
+
+    Events are held by waiters only and dropped with the last of them,
+    so keys of finished tasks and closed connections do not pile up.
+    """
+
+    def __init__(self):
+        self._events: weakref.WeakValueDictionary[str, asyncio.Event] = (
+            weakref.WeakValueDictionary())
+
+    def notify(self, key: str):
+        event = self._events.pop(key, None)
+        if event:
+            event.set()
+
+    def notify_all(self):
+        for key in list(self._events):
+            self.notify(key)
+
+    def waiter(self, *keys: str) -> Callable[[float], Awaitable[bool]]:
+        """Register interest in keys now, wait for any of them later.
+
+        Notifications sent between this call and awaiting the returned
+        function are not lost. Returned function gives False on timeout.
+        """
+        events = [self.__event(key) for key in keys]
+
+        async def wait(timeout: float) -> bool:
+            waiters = [asyncio.create_task(event.wait()) for event in events]
+            try:
+                done, _ = await asyncio.wait(
+                    waiters, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                # also when the caller is cancelled
+                for waiter in waiters:
+                    waiter.cancel()
+            return bool(done)
+
+        return wait
+
+    def __event(self, key: str) -> asyncio.Event:
+        event = self._events.get(key)
+        if event is None:
+            event = self._events[key] = asyncio.Event()
+        return event
+
+
+async def listen_redis_events(fastapi_app: FastAPI):
+    """Fan out Redis notifications to local subscribers.
+
+    One pub/sub connection per backend process: queue served counters
+    are stored in `state.queue_served` and wake waiters of the handler
+    id, task status changes wake waiters of `task:<task_id>` key,
+    worker registry changes are collected in `state.changed_workers`
+    (None - full reload needed) and wake waiters of `workers` key.
+    Followers take available handlers published by the leader, leader
+    lease releases wake waiters of the lease channel.
+    """
+    redis: Redis = fastapi_app.state.redis
+    queue_events: Broadcast = fastapi_app.state.queue_events
+    leader = fastapi_app.state.leader
+    while True:
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.psubscribe(
+                    'queue_served:*', 'task_status:*', 'worker_events',
+                    'available_handlers', 'leader:*')
+                # could miss messages while we were disconnected
+                fastapi_app.state.queue_served.clear()
+                fastapi_app.state.changed_workers = None
+                if not leader.is_leader:
+                    await __load_available_handlers(fastapi_app)
+                queue_events.notify_all()
+                pinged = False
+                while True:
+                    # listen() would fail on socket timeout of a quiet
+                    # channel, ping it instead
+                    message = await pubsub.get_message(
+                        timeout=PUBSUB_HEALTH_CHECK_INTERVAL)
+                    if message is None:
+                        if pinged:
+                            raise ConnectionError('Pub/sub connection lost')
+                        await pubsub.ping()
+                        pinged = True
+                        continue
+                    pinged = False
+                    if message['type'] != 'pmessage':
+                        continue
+                    channel: str = message['channel']
+                    if channel == 'available_handlers':
+                        if not leader.is_leader:
+                            state = json.loads(message['data'])
+                            fastapi_app.state.available_handlers = state[
+                                'available_handlers']
+                            fastapi_app.state.handlers_configs = state[
+                                'handlers_configs']
+                            queue_events.notify('handlers')
+                        continue
+                    if channel.startswith('leader:'):
+                        if not message['data']:
+                            queue_events.notify(channel)
+                        continue
+                    if channel == 'worker_events':
+                        changed_workers = fastapi_app.state.changed_workers
+                        if changed_workers is not None:
+                            changed_workers.add(message['data'])
+                        queue_events.notify('workers')
+                        continue
+                    if channel.startswith('task_status:'):
+                        queue_events.notify(
+                            channel.replace('task_status:', 'task:', 1))
+                        continue
+                    handler_id = channel.removeprefix('queue_served:')
+                    fastapi_app.state.queue_served[handler_id] = int(
+                        message['data'])
+                    queue_events.notify(handler_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f'⚠️ Redis events listener failed: {e}')
+            await asyncio.sleep(1)
+
+
+async def __load_available_handlers(fastapi_app: FastAPI):
+    """Take handlers state last published by the leader"""
+    redis: CachedRedis = fastapi_app.state.redis
+    raw_handlers = await redis.cached_get('available_handlers')
+    raw_configs = await redis.cached_get('handlers_configs')
+    fastapi_app.state.available_handlers = json.loads(raw_handlers or '{}')
+    fastapi_app.state.handlers_configs = json.loads(raw_configs or '{}')
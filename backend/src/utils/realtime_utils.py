@@ -0,0 +1,192 @@
+"""Multiplexed realtime channel of a browser tab.
+
+One WebSocket per tab carries status updates of any number of tasks
+and available handlers updates, served by a single coroutine.
+Client messages:
+    {"type": "subscribe" | "unsubscribe", "task_ids": [...]}
+    {"type": "resume", "token": "..."}
+Server messages:
+    {"type": "handlers", "handlers": {"available_handlers", "configs"}}
+    {"type": "task", "task": {...}}
+    {"type": "resume", "token": "..."}
+Resume token follows every batch of updates and holds subscriptions
+with their last sent states, so after reconnecting to any backend
+instance the client sends it first and gets only what has changed.
+Finished tasks are sent once with their result and unsubscribed.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import uuid
+
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from redis.asyncio import Redis
+from suz_shared.codec import decode_task
+
+from schemas.task import Task, TaskStatus
+from settings import settings
+from utils.pubsub_utils import Broadcast
+from utils.redis_utils import set_task_position
+
+FINISHED_STATUSES = (TaskStatus.COMPLETED, TaskStatus.FAILED)
+
+TaskState = tuple[str, int]
+
+
+class RealtimeChannel:
+    def __init__(self, fastapi_app: FastAPI, websocket: WebSocket,
+                 user_id: str):
+        self.app = fastapi_app
+        self.redis: Redis = fastapi_app.state.redis
+        self.events: Broadcast = fastapi_app.state.queue_events
+        self.websocket = websocket
+        self.user_id = user_id
+        # local key to wake the sender on client messages
+        self.key = f'realtime:{uuid.uuid4().hex}'
+        self.tasks: dict[str, Task] = {}
+        self.requested: set[str] = set()
+        self.sent: dict[str, TaskState] = {}
+        self.handlers_sent = ''
+
+    async def serve(self):
+        """Run until client disconnects"""
+        receiver = asyncio.create_task(self.__receive())
+        sender = asyncio.create_task(self.__send_updates())
+        try:
+            done, _ = await asyncio.wait(
+                (receiver, sender), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not isinstance(task.exception(), WebSocketDisconnect):
+                    task.result()
+        finally:
+            # broadcast events of the channel keys are dropped once the
+            # sender waiting on them is done
+            for task in (receiver, sender):
+                task.cancel()
+            await asyncio.gather(receiver, sender, return_exceptions=True)
+
+    async def __receive(self):
+        while True:
+            try:
+                message = await self.websocket.receive_json()
+            except ValueError:
+                continue
+            if not isinstance(message, dict):
+                continue
+            task_ids = [task_id for task_id in message.get('task_ids') or []
+                        if isinstance(task_id, str)]
+            if message.get('type') == 'subscribe':
+                room = (settings.REALTIME_MAX_SUBSCRIPTIONS
+                        - len(self.tasks) - len(self.requested))
+                self.requested.update(task_ids[:max(room, 0)])
+            elif message.get('type') == 'unsubscribe':
+                for task_id in task_ids:
+                    self.tasks.pop(task_id, None)
+                    self.requested.discard(task_id)
+                    self.sent.pop(task_id, None)
+            elif message.get('type') == 'resume':
+                self.__resume(message.get('token'))
+            self.events.notify(self.key)
+
+    def __resume(self, token):
+        try:
+            state = json.loads(base64.urlsafe_b64decode(token))
+            sent = {task_id: (status, position)
+                    for task_id, (status, position) in state['tasks'].items()}
+            handlers_sent = str(state['handlers'])
+        except (TypeError, ValueError, KeyError, AttributeError):
+            return  # start over, client gets current state
+        sent = dict(list(sent.items())[:settings.REALTIME_MAX_SUBSCRIPTIONS])
+        self.sent.update(sent)
+        self.requested.update(sent)
+        self.handlers_sent = handlers_sent
+
+    async def __send_updates(self):
+        while True:
+            await self.__load_requested()
+            # subscribe before reading, so no change is missed in between
+            wait_changes = self.events.waiter(
+                self.key, 'handlers',
+                *(f'task:{task_id}' for task_id in self.tasks),
+                *{task.handler_id for task in self.tasks.values()})
+            changed = await self.__send_handlers()
+            changed = await self.__send_tasks() or changed
+            if changed:
+                await self.websocket.send_json(
+                    {'type': 'resume', 'token': self.__token()})
+            # timeout only guards against lost notifications
+            await wait_changes(30)
+
+    async def __load_requested(self):
+        task_ids = list(self.requested)
+        self.requested.clear()
+        if not task_ids:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hgetall(f'task:{task_id}')
+            raw_tasks = await pipe.execute()
+        for task_id, raw_task in zip(task_ids, raw_tasks):
+            task = decode_task(raw_task) if raw_task else None
+            if task is None or task.user_id != self.user_id:
+                self.sent.pop(task_id, None)
+                continue
+            self.tasks[task_id] = task
+
+    async def __send_handlers(self) -> bool:
+        handlers = {'available_handlers': self.app.state.available_handlers,
+                    'configs': self.app.state.handlers_configs}
+        digest = hashlib.md5(
+            json.dumps(handlers, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        if digest == self.handlers_sent:
+            return False
+        await self.websocket.send_json(
+            {'type': 'handlers', 'handlers': handlers})
+        self.handlers_sent = digest
+        return True
+
+    async def __send_tasks(self) -> bool:
+        task_ids = list(self.tasks)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hmget(f'task:{task_id}', 'status', 'queue_ticket')
+            states = await pipe.execute()
+
+        changed = False
+        for task_id, (status, queue_ticket) in zip(task_ids, states):
+            # client may unsubscribe while we await redis or the socket
+            task = self.tasks.get(task_id)
+            if task is None:
+                continue
+            if status:
+                task.status = TaskStatus(status)
+                task.queue_ticket = int(queue_ticket or 0)
+            finished = task.status in FINISHED_STATUSES
+            if status and finished:
+                # result and error are read once, when they are final
+                raw_task = await self.redis.hgetall(f'task:{task_id}')
+                task = decode_task(raw_task) if raw_task else None
+            if not status or task is None:
+                self.tasks.pop(task_id, None)
+                self.sent.pop(task_id, None)
+                continue
+
+            await set_task_position(self.app, task)
+            state = (task.status.value, task.current_position)
+            if self.sent.get(task_id) != state:
+                await self.websocket.send_json(
+                    {'type': 'task', 'task': task.model_dump(mode='json')})
+                changed = True
+            if finished:
+                self.tasks.pop(task_id, None)
+                self.sent.pop(task_id, None)
+            elif task_id in self.tasks:
+                self.sent[task_id] = state
+        return changed
+
+    def __token(self) -> str:
+        state = {'tasks': self.sent, 'handlers': self.handlers_sent}
+        return base64.urlsafe_b64encode(json.dumps(
+            state, separators=(',', ':')).encode('utf-8')).decode('ascii')
@@ -0,0 +1,62 @@
+"""Backend side of the `suz_queue` Redis Functions library.
+
+Library source lives in `redis_functions/suz_queue.lua` in the project
+root and is shared with worker, see the file header for semantics. It
+is loaded by `suz_shared.redis_functions.load_redis_functions`.
+"""
+from redis.asyncio import Redis
+from suz_shared.codec import encode_task
+
+from schemas.feedback import TaskFeedback
+from schemas.task import Task
+
+
+async def enqueue_task(
+        redis: Redis, task: Task, ttl: int, handler_available: bool,
+        queued_at: float, index_ttl: int) -> int:
+    """Store, index and push task to queue, return start position"""
+    fields = [item for field in encode_task(task).items()
+              for item in field]
+    return await redis.fcall(
+        'task_enqueue', 0, task.task_id, task.handler_id, task.user_id,
+        int(task.is_first), int(handler_available), queued_at, ttl,
+        index_ttl, *fields)
+
+
+async def set_task_feedback(
+        redis: Redis, task_id: str, feedback: TaskFeedback) -> bool:
+    """Store feedback and emit it to cold store, False if task is gone"""
+    return bool(await redis.fcall(
+        'task_feedback', 0, task_id, feedback.model_dump_json()))
+
+
+async def suspend_handler(
+        redis: Redis, handler_id: str, batch: int) -> tuple[int, int]:
+    """Move handler tasks to pending, return (scanned, processing)"""
+    scanned, processing = await redis.fcall(
+        'handler_suspend', 0, handler_id, batch)
+    return scanned, processing
+
+
+async def resume_handler(
+        redis: Redis, handler_id: str, batch: int) -> tuple[int, int]:
+    """Move pending tasks to handler queue, return (scanned, resumed)"""
+    scanned, resumed = await redis.fcall(
+        'handler_resume', 0, handler_id, batch)
+    return scanned, resumed
+
+
+async def prune_workers(redis: Redis, worker_ttl: int) -> list[str]:
+    """Remove workers that missed heartbeats, return their ids"""
+    return await redis.fcall('worker_prune', 0, worker_ttl)
+
+
+async def acquire_leadership(
+        redis: Redis, name: str, owner_id: str, ttl_ms: int) -> bool:
+    """Take free leader lease or extend own one, True if held"""
+    return bool(await redis.fcall(
+        'leader_acquire', 0, name, owner_id, ttl_ms))
+
+
+async def release_leadership(redis: Redis, name: str, owner_id: str):
+    await redis.fcall('leader_release', 0, name, owner_id)
@@ -1,36 +1,51 @@
 import asyncio
 import hashlib
 import json
+import time
 import uuid
 from datetime import datetime, timezone
 
 from fastapi import FastAPI
+from fastapi.requests import HTTPConnection
 from loguru import logger
 from pydantic import ValidationError
 from redis.asyncio import Redis
+from suz_shared.codec import decode_task
+from suz_shared.redis_cache import CachedRedis
 
 from schemas.task import Task, TaskCreate, TaskStatus
+from settings import settings
+from utils.history_utils import (get_cold_user_tasks, make_cursor,
+                                 parse_cursor, task_keyset)
+from utils.pubsub_utils import Broadcast
+from utils.redis_functions import (enqueue_task, prune_workers,
+                                   resume_handler, suspend_handler)
 
 
-# TODO: add redis pool init here for Depends
+def get_redis(connection: HTTPConnection) -> CachedRedis:
+    """Dependency: Redis client of the app over the shared pool"""
+    return connection.app.state.redis
 
 
-async def update_task_position(task_id: str, redis: Redis):
-    all_tasks = await redis.lrange('task_queue', 0, -1)
-    all_tasks.reverse()
-    try:
-        current_pos = all_tasks.index(task_id) + 1
-    except ValueError:
-        pending_tasks = await redis.lrange('pending_task_queue', 0, -1)
-        if task_id in pending_tasks:
-            current_pos = -1
-        else:
-            current_pos = 0
-    task_data = await redis.get(f'task:{task_id}')
-    if task_data:
-        task = Task.model_validate_json(task_data)
-        task.current_position = current_pos
-        await redis.setex(f'task:{task_id}', 3600, task.model_dump_json())
+async def get_queue_served(fastapi_app: FastAPI, handler_id: str) -> int:
+    """Tasks served from handler queue, kept up to date by pub/sub"""
+    queue_served: dict[str, int] = fastapi_app.state.queue_served
+    if handler_id not in queue_served:
+        redis: Redis = fastapi_app.state.redis
+        queue_served[handler_id] = int(
+            await redis.get(f'queue_served:{handler_id}') or 0)
+    return queue_served[handler_id]
+
+
+async def set_task_position(fastapi_app: FastAPI, task: Task):
+    """Set current position in O(1): queue_ticket - queue_served"""
+    if task.status == TaskStatus.PENDING:
+        task.current_position = -1
+    elif task.status == TaskStatus.QUEUED:
+        served = await get_queue_served(fastapi_app, task.handler_id)
+        task.current_position = max(task.queue_ticket - served, 0)
+    else:
+        task.current_position = 0
 
 
 async def set_task_to_queue(user_id: str,
@@ -39,44 +54,86 @@ async def set_task_to_queue(user_id: str,
     redis: Redis = fastapi_app.state.redis
     task_id = str(uuid.uuid4())
     short_id = generate_short_id(task_id, user_id)
+    queued_at = datetime.now(timezone.utc)
     task_to_enqueue = Task(
         task_id=task_id,
         prompt=task.prompt.strip(),
         handler_id=task.handler_id,
         user_id=user_id,
         short_task_id=short_id,
-        queued_at=datetime.now(timezone.utc).isoformat(),
+        queued_at=queued_at.isoformat(),
         is_first=task.is_first
     )
 
     available_handlers = fastapi_app.state.available_handlers
-    if task.handler_id not in available_handlers:
-        task_to_enqueue.start_position = -1
-        task_to_enqueue.status = TaskStatus.PENDING
-        async with redis.pipeline() as pipe:
-            await redis.setex(
-                f'task:{task_id}', 3600, task_to_enqueue.model_dump_json())
-            await pipe.lpush('pending_task_queue', task_id)
-            await pipe.lpush(f'pending_task_queue:{task.handler_id}', task_id)
-            await pipe.execute()
-
-    else:
-        # can set wrong task start_position
-        # we can`t get position and set task with one transaction
-        current_queue_length = await redis.llen('task_queue')
-        start_position = current_queue_length + 1
-        task_to_enqueue.start_position = start_position
-        task_to_enqueue.status = TaskStatus.QUEUED
-        async with redis.pipeline() as pipe:
-            await redis.setex(
-                f'task:{task_id}', 3600, task_to_enqueue.model_dump_json())
-            await pipe.lpush('task_queue', task_id)
-            await pipe.lpush(f'task_queue:{task.handler_id}', task_id)
-            await pipe.execute()
+    await enqueue_task(
+        redis, task_to_enqueue, settings.TASK_TTL,
+        task.handler_id in available_handlers,
+        queued_at.timestamp(), settings.TASK_TTL)
 
     return task_id, short_id
 
 
+async def get_user_tasks(
+        fastapi_app: FastAPI, user_id: str, first_only: bool = False,
+        limit: int = 100, cursor: str | None = None
+) -> tuple[list[Task], str | None]:
+    """Page of user tasks, newest first, and cursor of the next page.
+
+    Recent tasks are read with one ZREVRANGEBYSCORE over the user index
+    and one pipelined HGETALL batch. When the index is exhausted, the
+    page is continued from the cold store (if enabled), so history
+    outlives task ttl. Cursor format is described in history_utils.
+    """
+    redis: Redis = fastapi_app.state.redis
+    index_key = (f'user_first_tasks:{user_id}' if first_only
+                 else f'user_tasks:{user_id}')
+    before = parse_cursor(cursor) if cursor else None
+    max_score = f'({before[0].timestamp()!r}' if before else '+inf'
+    index_page = await redis.zrevrangebyscore(
+        index_key, max_score, '-inf', start=0, num=limit, withscores=True)
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for task_id, _ in index_page:
+            await pipe.hgetall(f'task:{task_id}')
+        raw_tasks = await pipe.execute()
+    tasks: list[Task] = []
+    expired_ids = []
+    for (task_id, _), raw_task in zip(index_page, raw_tasks):
+        if not raw_task:
+            expired_ids.append(task_id)
+            continue
+        try:
+            task = decode_task(raw_task)
+        except ValidationError as e:
+            logger.warning(f'Ошибка валидации задачи {task_id}: {e}')
+            continue
+        await set_task_position(fastapi_app, task)
+        tasks.append(task)
+
+    if expired_ids:
+        await redis.zrem(index_key, *expired_ids)
+
+    # cursor always points to a live task: expired ones are the oldest,
+    # next page takes them from cold store
+    if len(index_page) == limit and tasks:
+        return tasks, make_cursor(*task_keyset(tasks[-1]))
+    if not settings.USE_GP_COLD_STORE:
+        return tasks, None
+
+    try:
+        cold_tasks = await get_cold_user_tasks(
+            user_id, first_only, limit - len(tasks),
+            task_keyset(tasks[-1]) if tasks else before)
+    except Exception as e:
+        logger.warning(f'⚠️ Cold store history is unavailable: {e}')
+        return tasks, None
+    tasks = tasks + cold_tasks
+    if len(tasks) < limit:
+        return tasks, None
+    return tasks, make_cursor(*task_keyset(tasks[-1]))
+
+
 def generate_short_id(
         _task_id: str, _user_id: str, length: int = 3) -> str:
     combined = f'{_task_id}:{_user_id}'.encode()
@@ -91,149 +148,148 @@ def generate_short_id(
     return ''.join(reversed(result))
 
 
-async def get_available_handlers(fastapi_app: FastAPI):
+async def sync_available_handlers(fastapi_app: FastAPI):
+    """Keep available handlers in sync with the worker registry.
+
+    Leader job (see leader_utils). Registry changes arrive as
+    `worker_events` notifications (see `listen_redis_events`), only
+    changed workers are refetched. Workers that stopped sending
+    heartbeats are pruned here every WORKER_PRUNE_INTERVAL, which
+    produces the same leave notifications. Results are published to
+    `available_handlers` channel for followers.
+    """
     redis: Redis = fastapi_app.state.redis
-    # TODO: возвращать список доступных обработчиков и описания всех
-    #  обработчиков из redis разными функциями - функцию по получению
-    #  описаний вызывать в случае если есть новые обработчики,
-    #  иначе возвращать существующий список или ничего
-    try:
-        while True:
-            workers_ids = await redis.lrange('workers', 0, -1)
-            available_handlers: dict[str, int] = {}
-            for worker_id in workers_ids:
-                try:
-                    worker_handlers: list[str] = json.loads(
-                        await redis.get(worker_id))
-                except TypeError:
-                    worker_handlers = []
-                for handler_id in worker_handlers:
-                    if handler_id in available_handlers:
-                        available_handlers[handler_id] += 1
+    queue_events: Broadcast = fastapi_app.state.queue_events
+    workers: dict[str, list[str]] = {}
+    pruned_at = 0.0
+    fastapi_app.state.changed_workers = None
+    if fastapi_app.state.available_handlers:
+        # previous leader could stop in the middle of a migration
+        fastapi_app.state.queue_migrations.put_nowait(
+            (set(), set(fastapi_app.state.available_handlers)))
+    while True:
+        try:
+            # subscribe before reading, so no change is missed in between
+            wait_changes = queue_events.waiter('workers')
+            changed_workers = fastapi_app.state.changed_workers
+            fastapi_app.state.changed_workers = set()
+            if changed_workers is None:
+                workers = {
+                    worker_id: json.loads(raw_handlers)
+                    for worker_id, raw_handlers in (
+                        await redis.hgetall('workers')).items()}
+            elif changed_workers:
+                changed_workers = list(changed_workers)
+                raw_handlers = await redis.hmget('workers', changed_workers)
+                for worker_id, raw in zip(changed_workers, raw_handlers):
+                    if raw is None:
+                        workers.pop(worker_id, None)
+                        logger.debug(f'ℹ️ Worker left: {worker_id}')
                     else:
-                        available_handlers[handler_id] = 1
-
-            current_handlers_ids = set(
-                fastapi_app.state.available_handlers.keys())
-            available_handlers_ids = set(available_handlers.keys())
-            handlers_ids_added = (
-                    available_handlers_ids - current_handlers_ids)
-            handlers_ids_removed = (
-                    current_handlers_ids - available_handlers_ids)
-
-            if handlers_ids_added or handlers_ids_removed:
-                logger.debug(
-                    f'ℹ️ Handlers updated: {available_handlers}')
-                if handlers_ids_added:
-                    logger.debug(
-                        f'ℹ️ Handlers added: {handlers_ids_added}')
-                if handlers_ids_removed:
-                    logger.debug(
-                        f'ℹ️ Handlers removed: {handlers_ids_removed}')
-                await update_queues(
-                    fastapi_app, handlers_ids_removed, handlers_ids_added)
-
-                handlers_configs = json.loads(
-                    await redis.get('handlers_configs'))
-                fastapi_app.state.handlers_configs = handlers_configs
-
-            fastapi_app.state.available_handlers = available_handlers
-            await redis.set(
-                'available_handlers', json.dumps(available_handlers))
-
-            await asyncio.sleep(10)
-    except asyncio.CancelledError:
-        logger.error('‼️ Error during updating available handlers')
-        fastapi_app.state.available_handlers = {}
-        fastapi_app.state.handlers_configs = {}
+                        workers[worker_id] = json.loads(raw)
+                        logger.debug(f'ℹ️ Worker joined: {worker_id}')
+
+            await __set_available_handlers(fastapi_app, workers)
+
+            if time.monotonic() - pruned_at >= settings.WORKER_PRUNE_INTERVAL:
+                pruned_at = time.monotonic()
+                pruned = await prune_workers(redis, settings.WORKER_TTL)
+                if pruned:
+                    logger.warning(f'⚠️ Dead workers removed: {pruned}')
+            await wait_changes(settings.WORKER_PRUNE_INTERVAL)
+        except Exception as e:
+            logger.warning(f'⚠️ Available handlers sync failed: {e}')
+            fastapi_app.state.changed_workers = None
+            await asyncio.sleep(1)
+
+
+async def __set_available_handlers(
+        fastapi_app: FastAPI, workers: dict[str, list[str]]):
+    """Count workers per handler, move tasks of (dis)appeared handlers"""
+    redis: CachedRedis = fastapi_app.state.redis
+    available_handlers: dict[str, int] = {}
+    for worker_handlers in workers.values():
+        for handler_id in worker_handlers:
+            available_handlers[handler_id] = (
+                    available_handlers.get(handler_id, 0) + 1)
+    if available_handlers == fastapi_app.state.available_handlers:
+        return
+
+    current_handlers_ids = set(fastapi_app.state.available_handlers.keys())
+    available_handlers_ids = set(available_handlers.keys())
+    handlers_ids_added = available_handlers_ids - current_handlers_ids
+    handlers_ids_removed = current_handlers_ids - available_handlers_ids
+
+    logger.debug(f'ℹ️ Handlers updated: {available_handlers}')
+    if handlers_ids_added or handlers_ids_removed:
+        if handlers_ids_added:
+            logger.debug(f'ℹ️ Handlers added: {handlers_ids_added}')
+        if handlers_ids_removed:
+            logger.debug(f'ℹ️ Handlers removed: {handlers_ids_removed}')
+        fastapi_app.state.queue_migrations.put_nowait(
+            (handlers_ids_removed, handlers_ids_added))
+
+        handlers_configs = json.loads(
+            await redis.cached_get('handlers_configs') or '{}')
+        fastapi_app.state.handlers_configs = handlers_configs
+
+    fastapi_app.state.available_handlers = available_handlers
+    await redis.set('available_handlers', json.dumps(available_handlers))
+    await redis.publish('available_handlers', json.dumps({
+        'available_handlers': available_handlers,
+        'handlers_configs': fastapi_app.state.handlers_configs}))
+    fastapi_app.state.queue_events.notify('handlers')
+
+
+async def migrate_queues(fastapi_app: FastAPI):
+    """Apply handler availability changes to queues one after another.
+
+    Runs apart from handlers discovery, so a long migration does not
+    delay availability updates; order is kept, so queues end up matching
+    the latest availability.
+    """
+    migrations: asyncio.Queue = fastapi_app.state.queue_migrations
+    while True:
+        handlers_ids_removed, handlers_ids_added = await migrations.get()
+        try:
+            await update_queues(
+                fastapi_app, handlers_ids_removed, handlers_ids_added)
+        except Exception as e:
+            logger.error(f'‼️ Queues update failed: {e}')
 
 
 async def update_queues(fastapi_app: FastAPI,
                         handlers_ids_removed: set[str],
                         handlers_ids_added: set[str]):
     redis: Redis = fastapi_app.state.redis
+    batch = settings.QUEUE_MIGRATION_BATCH
+    start_time = time.monotonic()
 
-    if handlers_ids_removed:
-        logger.info('♻️ Moving unactual tasks to pending queue...')
-        for handler_id in handlers_ids_removed:
-            while True:
-                task_id = await redis.brpoplpush(
-                    f'task_queue:{handler_id}',
-                    f'pending_task_queue:{handler_id}',
-                    1)
-                if not task_id:
-                    break
-                try:
-                    task = Task.model_validate_json(
-                        await redis.get(f'task:{task_id}'))
-                except ValidationError as e:
-                    logger.warning(
-                        f'⚠️ Unable to load task: {task_id}, {e}')
-                    continue
-                task.status = TaskStatus.PENDING
-                task.current_position = -1
-                async with redis.pipeline() as pipe:
-                    await pipe.lrem('task_queue', 0, task_id)
-                    await pipe.lpush('pending_task_queue', task_id)
-                    await pipe.setex(
-                        f'task:{task_id}', 3600, task.model_dump_json())
-                    await pipe.execute()
-                logger.info(
-                    f'♻️ Task is pending now: {task_id}, type: {handler_id}')
-
-    logger.info('♻️ Moving processing tasks to pending queue...')
-    processing_tasks = await redis.lrange('processing_queue', 0, -1)
-    for task_id in processing_tasks:
-        try:
-            task = Task.model_validate_json(
-                await redis.get(f'task:{task_id}'))
-        except ValidationError as e:
-            logger.warning(
-                f'⚠️ Unable to load task: {task_id}, {e}')
-            continue
-        handler_id = task.handler_id
-        if handler_id not in handlers_ids_removed:
-            continue
-        task.status = TaskStatus.PENDING
-        task.current_position = -1
-        async with redis.pipeline() as pipe:
-            await pipe.lrem('processing_queue', 0, task_id)
-            await pipe.lpush('pending_task_queue', task_id)
-            await pipe.lpush(f'pending_task_queue:{handler_id}', task_id)
-            await pipe.setex(
-                f'task:{task_id}', 3600, task.model_dump_json())
-            await pipe.execute()
+    for handler_id in handlers_ids_removed:
+        queued = processing = 0
+        while True:
+            scanned, suspended = await suspend_handler(
+                redis, handler_id, batch)
+            queued += scanned
+            processing += suspended
+            if scanned < batch:
+                break
         logger.info(
-            f'♻️ Task is pending now: {task_id}, type: {handler_id} '
-            f'(was in processing)')
-
-    if handlers_ids_added:
-        logger.info('♻️ Pending tasks recovery...')
-        pending_tasks = await redis.lrange('pending_task_queue', 0, -1)
-        for task_id in pending_tasks:
-            try:
-                task = Task.model_validate_json(
-                    await redis.get(f'task:{task_id}'))
-            except ValidationError as e:
-                logger.warning(
-                    f'⚠️ Unable to load task: {task_id}, {e}')
-                continue
-            handler_id = task.handler_id
-            if handler_id not in handlers_ids_added:
-                continue
-
-            task.status = TaskStatus.QUEUED
-            async with redis.pipeline() as pipe:
-                await pipe.lrem('pending_task_queue', 0, task_id)
-                await pipe.lrem(f'pending_task_queue:{handler_id}', 0, task_id)
-                await pipe.lpush('task_queue', task_id)
-                await pipe.lpush(f'task_queue:{handler_id}', task_id)
-                await pipe.setex(
-                    f'task:{task_id}', 3600, task.model_dump_json())
-                await pipe.execute()
-            logger.info(f'♻️ Task recovered: {task_id}, type: {handler_id}')
-
-    logger.info('✅️ Queues update finished')
+            f'♻️ {handler_id}: {queued} queued and {processing} processing '
+            f'tasks are pending now')
+
+    for handler_id in handlers_ids_added:
+        recovered = 0
+        while True:
+            scanned, resumed = await resume_handler(redis, handler_id, batch)
+            recovered += resumed
+            if scanned < batch:
+                break
+        logger.info(f'♻️ {handler_id}: {recovered} pending tasks recovered')
+
+    logger.info(
+        f'✅️ Queues update finished in '
+        f'{(time.monotonic() - start_time) * 1000:.1f} ms')
 
 
 async def cleanup_dlq(redis: Redis):
@@ -0,0 +1,99 @@
+"""Consumers of `task_changes` stream and other Redis streams.
+
+suz_queue functions append {task_id, event} entry on every task status
+change (event is the new status) and on feedback change ('feedback').
+Every consumer has its own consumer group, reads entries in batches and
+rereads only changed tasks. Batches are acknowledged after they are
+handled, entries of failed batches and of dead consumers are claimed
+again after `claim_idle` seconds.
+"""
+import asyncio
+import os
+import socket
+from typing import Awaitable, Callable
+
+from loguru import logger
+from pydantic import ValidationError
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from suz_shared.codec import decode_task
+
+from schemas.task import Task
+
+TASK_CHANGES = 'task_changes'
+
+StreamEntry = tuple[str, dict[str, str]]
+
+
+async def consume_task_changes(
+        redis: Redis, group: str,
+        handle_batch: Callable[[list[StreamEntry]], Awaitable[None]],
+        batch: int, block: int, claim_idle: int):
+    """Pass batches of task changes to handler until cancelled"""
+    await consume_stream(redis, TASK_CHANGES, group, handle_batch, batch,
+                         block, claim_idle)
+
+
+async def consume_stream(
+        redis: Redis, stream: str, group: str,
+        handle_batch: Callable[[list[StreamEntry]], Awaitable[None]],
+        batch: int, block: int, claim_idle: int):
+    """Pass batches of stream entries to handler until cancelled"""
+    consumer = f'{socket.gethostname()}:{os.getpid()}'
+    await __create_consumer_group(redis, stream, group)
+
+    while True:
+        try:
+            # entries of failed batches and of dead consumers go first
+            _, entries, _ = await redis.xautoclaim(
+                stream, group, consumer,
+                min_idle_time=claim_idle * 1000, count=batch)
+            if not entries:
+                response = await redis.xreadgroup(
+                    group, consumer, {stream: '>'},
+                    count=batch, block=block * 1000)
+                entries = response[0][1] if response else []
+            if not entries:
+                continue
+
+            await handle_batch(entries)
+            await redis.xack(stream, group,
+                             *[entry_id for entry_id, _ in entries])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'‼️ "{group}" {stream} consumer failed: {e}')
+            await asyncio.sleep(5)
+
+
+async def fetch_changed_tasks(
+        redis: Redis, entries: list[StreamEntry],
+        events: set[str] | None = None) -> list[Task]:
+    """Current state of tasks changed by entries (optionally only by
+    given events), expired tasks are skipped
+    """
+    task_ids = list(dict.fromkeys(
+        fields['task_id'] for _, fields in entries
+        if fields and (events is None or fields['event'] in events)))
+    async with redis.pipeline(transaction=False) as pipe:
+        for task_id in task_ids:
+            await pipe.hgetall(f'task:{task_id}')
+        raw_tasks = await pipe.execute()
+
+    tasks = []
+    for task_id, raw_task in zip(task_ids, raw_tasks):
+        if not raw_task:
+            continue
+        try:
+            tasks.append(decode_task(raw_task))
+        except ValidationError as e:
+            logger.warning(f'⚠️ Invalid task {task_id}: {e}')
+    return tasks
+
+
+async def __create_consumer_group(redis: Redis, stream: str, group: str):
+    try:
+        await redis.xgroup_create(stream, group, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
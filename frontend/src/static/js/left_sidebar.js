@@ -31,7 +31,7 @@ function updateSidebarItemsVisibility() {
     });
 }
 
-function addSidebarItem(task) {
+function addSidebarItem(task, older = false) {
     const item = document.createElement('div');
     let prompt = task['prompt'];
     item.className = 'sidebar-item';
@@ -63,6 +63,12 @@ function addSidebarItem(task) {
             taskEl.classList.add('active');
         }
     });
+    if (older) {
+        // задачи из более ранних страниц истории - в конец списка
+        sidebarContent.appendChild(item);
+        updateSidebarItemsVisibility();
+        return item;
+    }
     document.querySelectorAll('.sidebar-item, .result-container').forEach(el => {
         el.classList.remove('active');
     });
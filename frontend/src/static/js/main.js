@@ -3,13 +3,106 @@
 //  чтобы всегда было описание ассистента и человеческое имя для фронта
 
 
-function loadTasks() {
-    fetch(`${BACKEND_URL}/api/v1/tasks`, { credentials: 'include' })
-        .then(response => {
-            if (!response.ok) throw new Error('Network error');
-            return response.json();
+const TASKS_PAGE_SIZE = 100;
+// курсор страницы более старых задач, null - загружены все
+let olderTasksCursor = null;
+
+async function fetchTasksPage(cursor) {
+    // бэкенд отдает задачи страницами: первая - самые новые, следующая
+    // страница по курсору из X-Next-Cursor; внутри страницы от старых к новым
+    let url = `${BACKEND_URL}/api/v1/tasks?limit=${TASKS_PAGE_SIZE}`;
+    if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+    const response = await fetch(url, { credentials: 'include' });
+    if (!response.ok) throw new Error('Network error');
+    return { tasks: await response.json(), cursor: response.headers.get('X-Next-Cursor') };
+}
+
+
+function showLoadedTask(task, older = false) {
+    task = JSON.parse(task);
+    const taskId = task['task_id'];
+    addTaskToUI(task, older);
+
+    //вот эта вся свестопляска для того, чтобы понять подписываться на задачу или нет
+    let statusRawText
+    if (task.status === 'queued') {  // TODO выделить в отдельную функцию
+        let position = task.current_position;
+        if (position > 0) {
+            statusRawText = `ожидание, позиция в очереди: ${position}`
+        } else {
+            statusRawText = 'ожидание, запрос выполняется'
+        }
+    } else if (task.status === 'failed') {
+        statusRawText = 'ошибка';
+    } else if (task.status === 'completed') {
+        statusRawText = 'выполнено';
+    } else if (task.status === 'running') {
+        statusRawText = 'выполняется';
+    } else if (task.status === 'pending') {
+        statusRawText = 'приостановлено, нет запущенных обработчиков для этого типа задачи';
+    }
+    let status = statusRawText
+    updateStatus(taskId, task);
+
+//мне это надо не в сайд бар а ко всем таскам, в сайд баре будут только первые таски в updateStatus короче
+//поэтому надо искать не по сайд бару -----куда кстати попадают задачи после updateStatus - помимо сайдбара в tasks в
+//result-container
+    //ставим класс в div задаче ------- sidebar должен пойти нафиг
+    const sidebarItem = document.querySelector(`.sidebar-item[data-item-number="${taskId}"]`);
+    if (status === 'выполнено') {
+        sidebarItem.classList.add('completed') // TODO move to updateStatus or separate function
+    } else if (status === 'ошибка') {
+        sidebarItem.classList.add('error')
+    } else {
+        subscribeToTask(taskId);
+    }
+    return sidebarItem;
+}
+
+
+function updateOlderTasksButton() {
+    // кнопка всегда последняя в списке задач, более старые задачи вставляются перед ней
+    let button = document.getElementById('older-tasks-btn');
+    if (!olderTasksCursor) {
+        if (button) button.remove();
+        return;
+    }
+    if (!button) {
+        button = document.createElement('button');
+        button.id = 'older-tasks-btn';
+        button.className = 'older-tasks-btn';
+        button.textContent = 'Показать более ранние запросы';
+        button.addEventListener('click', loadOlderTasks);
+        document.getElementById('tasks').appendChild(button);
+    }
+}
+
+
+function loadOlderTasks() {
+    const button = document.getElementById('older-tasks-btn');
+    button.disabled = true;
+    fetchTasksPage(olderTasksCursor)
+        .then(page => {
+            // внизу списка самые старые: страницу добавляем от новых к старым
+            page.tasks.reverse().forEach(task => {
+                try {
+                    showLoadedTask(task, true);
+                } catch (e) {
+                    console.error('Error loading task:', e);
+                }
+            });
+            olderTasksCursor = page.cursor;
+            updateOlderTasksButton();
         })
-        .then(tasks => {
+        .catch(error => console.error('Network error:', error))
+        .finally(() => button.disabled = false);
+}
+
+
+function loadTasks() {
+    fetchTasksPage(null)
+        .then(page => {
+            const tasks = page.tasks;
             if (!tasks || tasks.length === 0) {  // TODO default state is block, if tasks - something else
                 emptyState.style.display = 'block';
                 return;
@@ -19,48 +112,13 @@ function loadTasks() {
 
             tasks.forEach(task => {
                 try {
-                    task = JSON.parse(task);
-                    const taskId = task['task_id'];
-                    addTaskToUI(task);
-
-                    lastAddedItem = document.querySelector(`.sidebar-item[data-item-number="${taskId}"]`);
-                    //вот эта вся свестопляска для того, чтобы понять подписываться на задачу или нет
-                    let statusRawText
-                    if (task.status === 'queued') {  // TODO выделить в отдельную функцию
-                        let position = task.current_position;
-                        if (position > 0) {
-                            statusRawText = `ожидание, позиция в очереди: ${position}`
-                        } else {
-                            statusRawText = 'ожидание, запрос выполняется'
-                        }
-                    } else if (task.status === 'failed') {
-                        statusRawText = 'ошибка';
-                    } else if (task.status === 'completed') {
-                        statusRawText = 'выполнено';
-                    } else if (task.status === 'running') {
-                        statusRawText = 'выполняется';
-                    } else if (task.status === 'pending') {
-                        statusRawText = 'приостановлено, нет запущенных обработчиков для этого типа задачи';
-                    }
-                    let status = statusRawText
-                    updateStatus(taskId, task);
-
-//мне это надо не в сайд бар а ко всем таскам, в сайд баре будут только первые таски в updateStatus короче
-//поэтому надо искать не по сайд бару -----куда кстати попадают задачи после updateStatus - помимо сайдбара в tasks в
-//result-container
-                    //ставим класс в div задаче ------- sidebar должен пойти нафиг
-                    const sidebarItem = document.querySelector(`.sidebar-item[data-item-number="${taskId}"]`);
-                    if (status === 'выполнено') {
-                        sidebarItem.classList.add('completed') // TODO move to updateStatus or separate function
-                    } else if (status === 'ошибка') {
-                        sidebarItem.classList.add('error')
-                    } else {
-                        subscribeToTask(taskId);
-                    }
+                    lastAddedItem = showLoadedTask(task);
                 } catch (e) {
                     console.error('Error loading task:', e);
                 }
             });
+            olderTasksCursor = page.cursor;
+            updateOlderTasksButton();
 
             if (lastAddedItem) {
                 is_new_chat = true;
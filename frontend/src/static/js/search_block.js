@@ -42,7 +42,8 @@ function startTask() {
     });
 }
 
-function addTaskToUI(task) {
+function addTaskToUI(task, older = false) {
+    // older - задача из более ранней страницы истории, добавляется в конец списка
     const emptyState = document.getElementById('emptyState');
     if (emptyState) emptyState.style.display = 'none';
 
@@ -67,14 +68,19 @@ function addTaskToUI(task) {
     <span class="icon">−</span>
     </button>
 </div>`;
-    addSidebarItem(task);
+    addSidebarItem(task, older);
     const container = document.getElementById('tasks');
-    container.insertBefore(taskDiv, container.firstChild);
+    if (older) {
+        // перед кнопкой загрузки более ранних задач
+        container.insertBefore(taskDiv, document.getElementById('older-tasks-btn'));
+    } else {
+        container.insertBefore(taskDiv, container.firstChild);
 
-    document.querySelectorAll('.result-container').forEach(taskEl => {
-        taskEl.classList.remove('active');
-    });
-    taskDiv.classList.add('active');
+        document.querySelectorAll('.result-container').forEach(taskEl => {
+            taskEl.classList.remove('active');
+        });
+        taskDiv.classList.add('active');
+    }
 
     const divider = document.getElementById('taskDivider');
     if (container.children.length === 1) {
@@ -174,32 +180,74 @@ function updateStatus(taskId, task) {
     }
 }
 
+// один WebSocket на вкладку для всех задач и обработчиков
+const realtime = {
+    socket: null,
+    taskIds: new Set(),
+    resumeToken: null,
+    retryDelay: 1000,
+};
+
 function subscribeToTask(taskId) {
-    const eventSource = new EventSource(`${BACKEND_URL}/api/v1/subscribe/${taskId}`);
+    realtime.taskIds.add(taskId);
+    sendRealtime({type: 'subscribe', task_ids: [taskId]});
+}
+
+function sendRealtime(message) {
+    if (realtime.socket && realtime.socket.readyState === WebSocket.OPEN) {
+        realtime.socket.send(JSON.stringify(message));
+    }
+}
+
+function handleTaskUpdate(task) {
+    const taskId = task.task_id;
     const sidebarItem = document.querySelector(`.sidebar-item[data-item-number="${taskId}"]`);
-    eventSource.onmessage = function(event) {
+    updateStatus(taskId, task);
+    // задачи может не быть в сайдбаре (например, еще не добавлена) - отписываемся все равно
+    if (task.status === 'completed') {
+        if (sidebarItem) sidebarItem.classList.add('completed');
+        realtime.taskIds.delete(taskId);
+    } else if (task.status === 'failed') {
+        if (sidebarItem) sidebarItem.classList.add('error');
+        realtime.taskIds.delete(taskId);
+    }
+}
+
+function connectRealtime() {
+    const url = new URL(`${BACKEND_URL}/api/v1/realtime`, window.location.href);
+    url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(url);
+    realtime.socket = socket;
+
+    socket.onopen = () => {
+        realtime.retryDelay = 1000;
+        document.getElementById('status').classList.remove('error');
+        // после переподключения сервер пришлет только изменения
+        if (realtime.resumeToken) {
+            sendRealtime({type: 'resume', token: realtime.resumeToken});
+        }
+        sendRealtime({type: 'subscribe', task_ids: [...realtime.taskIds]});
+    };
+    socket.onmessage = (event) => {
         try {
-            const data = JSON.parse(event.data);
-            if (data.status === 'completed') {
-                updateStatus(taskId, data);
-                sidebarItem.classList.add('completed');
-                eventSource.close();
-            } else if (data.status === 'failed') {
-                updateStatus(taskId, data);
-                sidebarItem.classList.add('error');
-                eventSource.close();
-            } else {
-                updateStatus(taskId, data)
+            const message = JSON.parse(event.data);
+            if (message.type === 'task') {
+                handleTaskUpdate(message.task);
+            } else if (message.type === 'handlers') {
+                updateHandlers(message.handlers);
+            } else if (message.type === 'resume') {
+                realtime.resumeToken = message.token;
             }
         } catch (e) {
-            console.error("Ошибка парсинга:", e);
+            console.error("Ошибка обработки сообщения:", e);
         }
     };
-
-    eventSource.onerror = function(err) {
-        console.error("Ошибка SSE для задачи", taskId, err);
-        eventSource.close();
-        setTimeout(subscribeToTask, 10000, taskId);
+    socket.onclose = (event) => {
+        console.error('WebSocket closed:', event.code);
+        statusDiv.textContent = 'Связь с сервером потеряна, пытаемся переподключиться...';
+        document.getElementById('status').classList.add('error');
+        setTimeout(connectRealtime, realtime.retryDelay);
+        realtime.retryDelay = Math.min(realtime.retryDelay * 2, 10000);
     };
 }
 
@@ -272,21 +320,6 @@ function updateHandlers(handlersData) {
     statusDiv.textContent = `Обработчики обновлены: ${new Date().toLocaleTimeString()}`;
 }
 
-function connectHandlersStream() {
-    let handlersStream = new EventSource(`${BACKEND_URL}/api/v1/handlers/stream`);
-    handlersStream.onmessage = (event) => {
-        updateHandlers(JSON.parse(event.data));
-        document.getElementById('status').classList.remove('error')
-    };
-    handlersStream.onerror = (err) => {
-        console.error('EventSource error:', err);
-        statusDiv.textContent = 'Связь с сервером потеряна, пытаемся переподключиться...';
-        document.getElementById('status').classList.add('error')
-        handlersStream.close();
-        setTimeout(connectHandlersStream, 10000);
-    }
-}
-
 function updateLocalStorageHandlers(newData) {
     const storedData = JSON.parse(localStorage.getItem('handlersConfigs') || '{}');
 
@@ -314,5 +347,5 @@ document.addEventListener('DOMContentLoaded', () => {
     handlerSelect.addEventListener('change', () => {
         executeBtn.disabled = !handlerSelect.value;
     });
-    connectHandlersStream();
+    connectRealtime();
 });
@@ -0,0 +1,448 @@
+#!lua name=suz_queue
+--[[
+Queue state transitions shared by backend and worker.
+
+Every function is one atomic step of a task lifecycle:
+enqueue -> claim -> complete | fail (retry or DLQ), plus pending
+suspend/resume when handlers come and go and lease recovery.
+Task keys are derived from ids passed in ARGV, so the library targets a
+single Redis instance (not a cluster), same as the rest of the project.
+
+Tasks are stored as hashes `task:<task_id>`, one field per Task model
+field (nested models as JSON), so transitions only touch the fields
+they change. Task ttl is set once on enqueue and never rewritten.
+
+Queue positions are O(1): every task pushed to the tail of a handler
+queue takes a ticket from `queue_tickets:<handler_id>`, every task
+leaving its head increments `queue_served:<handler_id>` and publishes
+the new value to the channel of the same name, so
+position = queue_ticket - served.
+
+Every task status change is published to `task_status:<task_id>`
+channel with the new status as payload and appended to `task_changes`
+stream as {task_id, event = status} entry, feedback changes are
+appended there as 'feedback' events. Stream consumers (cold store,
+task journal) reread changed tasks instead of scanning task keys.
+
+Tasks of unavailable handlers wait in `pending_task_queue:<handler_id>`
+lists (oldest on the right, like handler queues) and are moved between
+them and handler queues in batches by handler_suspend/handler_resume.
+
+Per-user listing indexes `user_tasks:<user_id>` and
+`user_first_tasks:<user_id>` are ZSETs of task ids scored by queued_at
+(unix time). Entries older than index ttl are trimmed on enqueue, ids of
+expired tasks are removed lazily by readers.
+
+Worker registry: `workers` hash maps live worker ids to JSON lists of
+their healthy handler ids, `worker_heartbeats` ZSET holds last heartbeat
+time of each of them. Workers missing heartbeats for worker ttl are
+pruned. Every join, handlers change and leave publishes the worker id to
+`worker_events` channel, so readers refetch only changed workers.
+
+Leader leases: `leader:<name>` key holds id of the service instance
+running singleton jobs, it expires unless renewed by its owner. Taking
+and releasing a lease is published to the channel of the same name
+(owner id, empty on release), so followers take over without delay.
+
+Bump LIBRARY_VERSION on every change: services replace the loaded
+library only when their copy is newer.
+]]
+
+local LIBRARY_VERSION = 12
+
+local TASK_QUEUE = 'task_queue'
+local PENDING_QUEUE = 'pending_task_queue'
+local PROCESSING_QUEUE = 'processing_queue'
+local DEAD_LETTERS = 'dead_letters'
+local LEASES = 'task_leases'
+local LEASE_OWNERS = 'task_lease_owners'
+local QUEUE_TICKETS = 'queue_tickets:'
+local QUEUE_SERVED = 'queue_served:'
+local USER_TASKS = 'user_tasks:'
+local USER_FIRST_TASKS = 'user_first_tasks:'
+local TASK_CHANGES = 'task_changes'
+local TASK_CHANGES_MAXLEN = 100000
+local WORKERS = 'workers'
+local WORKER_HEARTBEATS = 'worker_heartbeats'
+local WORKER_EVENTS = 'worker_events'
+local LEADER = 'leader:'
+
+local function now()
+    return tonumber(redis.call('TIME')[1])
+end
+
+local function task_key(task_id)
+    return 'task:' .. task_id
+end
+
+local function emit_change(task_id, event)
+    redis.call('XADD', TASK_CHANGES, 'MAXLEN', '~', TASK_CHANGES_MAXLEN,
+               '*', 'task_id', task_id, 'event', event)
+end
+
+local function publish_status(task_id, status)
+    redis.call('PUBLISH', 'task_status:' .. task_id, status)
+    emit_change(task_id, status)
+end
+
+-- set status and other fields (name, value, ...) of existing task
+-- and publish the new status, returns false if task is gone
+local function update_task(task_id, status, ...)
+    local key = task_key(task_id)
+    if redis.call('EXISTS', key) == 0 then
+        return false
+    end
+    redis.call('HSET', key, 'status', status, ...)
+    publish_status(task_id, status)
+    return true
+end
+
+local function get_handler_id(task_id)
+    return redis.call('HGET', task_key(task_id), 'handler_id')
+end
+
+local function get_served(handler_id)
+    return tonumber(redis.call('GET', QUEUE_SERVED .. handler_id) or 0)
+end
+
+-- task goes to the tail of its handler queue,
+-- returns its ticket and position
+local function take_ticket(handler_id)
+    local ticket = redis.call('INCR', QUEUE_TICKETS .. handler_id)
+    return ticket, ticket - get_served(handler_id)
+end
+
+-- delta tasks left the head of handler queue (negative - returned to it)
+local function serve(handler_id, delta)
+    local served = redis.call('INCRBY', QUEUE_SERVED .. handler_id, delta)
+    redis.call('PUBLISH', QUEUE_SERVED .. handler_id, served)
+    return served
+end
+
+local function drop_lease(task_id)
+    redis.call('ZREM', LEASES, task_id)
+    redis.call('HDEL', LEASE_OWNERS, task_id)
+end
+
+-- lease of task is not expired and its worker is alive
+local function lease_held(task_id, worker_id, time)
+    local deadline = redis.call('ZSCORE', LEASES, task_id)
+    return deadline and tonumber(deadline) > time
+        and redis.call('HEXISTS', WORKERS, worker_id) == 1
+end
+
+local function version()
+    return LIBRARY_VERSION
+end
+
+local function index_task(index_key, task_id, queued_at, index_ttl)
+    redis.call('ZADD', index_key, queued_at, task_id)
+    redis.call('ZREMRANGEBYSCORE', index_key, '-inf',
+               '(' .. (queued_at - index_ttl))
+    redis.call('EXPIRE', index_key, index_ttl)
+end
+
+-- ARGV: task id, handler id, user id, '1' if task is first,
+-- '1' if task handler is available, queued_at unix time, task ttl,
+-- user index ttl, other task fields (name, value, ...)
+-- returns task start position (-1 for pending tasks)
+local function task_enqueue(_, args)
+    local task_id, handler_id, user_id = args[1], args[2], args[3]
+    local queued_at, index_ttl = tonumber(args[6]), tonumber(args[8])
+    index_task(USER_TASKS .. user_id, task_id, queued_at, index_ttl)
+    if args[4] == '1' then
+        index_task(USER_FIRST_TASKS .. user_id, task_id,
+                   queued_at, index_ttl)
+    end
+
+    local key = task_key(task_id)
+    redis.call('HSET', key, unpack(args, 9))
+    local status, ticket, position
+    if args[5] == '1' then
+        status = 'queued'
+        ticket, position = take_ticket(handler_id)
+        redis.call('LPUSH', TASK_QUEUE .. ':' .. handler_id, task_id)
+    else
+        status, ticket, position = 'pending', 0, -1
+        redis.call('LPUSH', PENDING_QUEUE .. ':' .. handler_id, task_id)
+    end
+    redis.call('HSET', key, 'status', status, 'queue_ticket', ticket,
+               'start_position', position, 'current_position', position)
+    redis.call('EXPIRE', key, args[7])
+    publish_status(task_id, status)
+    return position
+end
+
+-- ARGV: worker id, lease timeout, handler ids in priority order
+-- returns {handler_id, task_id} or nil when all queues are empty
+local function task_claim(_, args)
+    for i = 3, #args do
+        local queue = TASK_QUEUE .. ':' .. args[i]
+        local task_id = redis.call('RPOP', queue)
+        while task_id do
+            serve(args[i], 1)
+            -- ids of expired tasks are dropped, not leased
+            if redis.call('EXISTS', task_key(task_id)) == 1 then
+                redis.call('ZADD', LEASES, now() + tonumber(args[2]),
+                           task_id)
+                redis.call('HSET', LEASE_OWNERS, task_id, cjson.encode(
+                    {worker = args[1], handler = args[i]}))
+                redis.call('LPUSH', PROCESSING_QUEUE, task_id)
+                update_task(task_id, 'running', 'current_position', 0)
+                return {args[i], task_id}
+            end
+            task_id = redis.call('RPOP', queue)
+        end
+    end
+    return nil
+end
+
+-- ARGV: lease timeout, task ids
+local function lease_renew(_, args)
+    local deadline = now() + tonumber(args[1])
+    for i = 2, #args do
+        redis.call('ZADD', LEASES, 'XX', deadline, args[i])
+    end
+    return #args - 1
+end
+
+-- ARGV: worker id (empty to reap expired leases of dead workers),
+-- reap limit, task ids to release (for non-empty worker id)
+-- Leases of expired tasks are dropped whoever holds them, otherwise
+-- they would fill the reap window for good.
+-- returns requeued task ids
+local function lease_requeue(_, args)
+    local task_ids
+    if args[1] == '' then
+        task_ids = redis.call('ZRANGEBYSCORE', LEASES, '-inf', now(),
+                              'LIMIT', 0, tonumber(args[2]))
+    else
+        task_ids = {unpack(args, 3)}
+    end
+    local requeued = {}
+    for _, task_id in ipairs(task_ids) do
+        local raw_lease = redis.call('HGET', LEASE_OWNERS, task_id)
+        local lease = raw_lease and cjson.decode(raw_lease)
+        local owner_alive = lease
+            and redis.call('HEXISTS', WORKERS, lease.worker) == 1
+        if redis.call('EXISTS', task_key(task_id)) == 0 then
+            drop_lease(task_id)
+            redis.call('LREM', PROCESSING_QUEUE, 0, task_id)
+        elseif (args[1] == '' and not owner_alive)
+                or (lease and lease.worker == args[1]) then
+            drop_lease(task_id)
+            redis.call('LREM', PROCESSING_QUEUE, 0, task_id)
+            if lease then
+                -- back to the head: whole queue moves one step back
+                local served = serve(lease.handler, -1)
+                redis.call('RPUSH', TASK_QUEUE .. ':' .. lease.handler,
+                           task_id)
+                update_task(task_id, 'queued', 'queue_ticket', served + 1,
+                            'current_position', 1)
+            end
+            table.insert(requeued, task_id)
+        end
+    end
+    return requeued
+end
+
+-- ARGV: task id, changed task fields (name, value, ...)
+local function task_complete(_, args)
+    redis.call('LREM', PROCESSING_QUEUE, 1, args[1])
+    drop_lease(args[1])
+    update_task(args[1], 'completed', unpack(args, 2))
+    return 1
+end
+
+-- ARGV: task id, error answer json, max retries, finished at
+-- returns {'retry' | 'failed', retries} or nil for missing task
+local function task_fail(_, args)
+    local handler_id = get_handler_id(args[1])
+    if not handler_id then
+        -- task expired while running, its lease must not outlive it
+        redis.call('LREM', PROCESSING_QUEUE, 1, args[1])
+        drop_lease(args[1])
+        return nil
+    end
+    local retries = redis.call('HINCRBY', task_key(args[1]), 'retries', 1)
+    redis.call('LREM', PROCESSING_QUEUE, 1, args[1])
+    drop_lease(args[1])
+    if retries >= tonumber(args[3]) then
+        redis.call('RPUSH', DEAD_LETTERS, args[1])
+        update_task(args[1], 'failed', 'error', args[2],
+                    'finished_at', args[4])
+        return {'failed', retries}
+    end
+    local ticket, position = take_ticket(handler_id)
+    redis.call('LPUSH', TASK_QUEUE .. ':' .. handler_id, args[1])
+    update_task(args[1], 'queued', 'queue_ticket', ticket,
+                'current_position', position)
+    return {'retry', retries}
+end
+
+-- ARGV: task id, feedback json; returns 0 if task is gone
+local function task_feedback(_, args)
+    local key = task_key(args[1])
+    if redis.call('EXISTS', key) == 0 then
+        return 0
+    end
+    redis.call('HSET', key, 'feedback', args[2])
+    emit_change(args[1], 'feedback')
+    return 1
+end
+
+-- Move queued tasks of unavailable handler to pending in bulk: up to
+-- batch oldest queued tasks and its processing tasks left by workers.
+-- Tasks still leased by live workers keep running: they would be
+-- completed while waiting in pending and then run again on resume.
+-- ARGV: handler id, batch size
+-- returns {scanned queued tasks, suspended processing tasks}
+local function handler_suspend(_, args)
+    local handler_id, batch = args[1], tonumber(args[2])
+    local queue = TASK_QUEUE .. ':' .. handler_id
+    local pending = PENDING_QUEUE .. ':' .. handler_id
+
+    local processing = 0
+    local time = now()
+    local leases = redis.call('HGETALL', LEASE_OWNERS)
+    for i = 1, #leases, 2 do
+        local task_id = leases[i]
+        local lease = cjson.decode(leases[i + 1])
+        if lease.handler == handler_id
+                and not lease_held(task_id, lease.worker, time) then
+            redis.call('LREM', PROCESSING_QUEUE, 0, task_id)
+            drop_lease(task_id)
+            if update_task(task_id, 'pending', 'current_position', -1) then
+                redis.call('LPUSH', pending, task_id)
+                processing = processing + 1
+            end
+        end
+    end
+
+    -- queue head (oldest task) is on the right
+    local task_ids = redis.call('LRANGE', queue, -batch, -1)
+    if #task_ids > 0 then
+        redis.call('LTRIM', queue, 0, -#task_ids - 1)
+        serve(handler_id, #task_ids)
+        for i = #task_ids, 1, -1 do
+            if update_task(task_ids[i], 'pending',
+                           'current_position', -1) then
+                redis.call('LPUSH', pending, task_ids[i])
+            end
+        end
+    end
+    return {#task_ids, processing}
+end
+
+-- Move up to batch oldest pending tasks back to their handler queue.
+-- ARGV: handler id, batch size
+-- returns {scanned pending tasks, resumed tasks}
+local function handler_resume(_, args)
+    local handler_id, batch = args[1], tonumber(args[2])
+    local queue = TASK_QUEUE .. ':' .. handler_id
+    local pending = PENDING_QUEUE .. ':' .. handler_id
+
+    local task_ids = redis.call('LRANGE', pending, -batch, -1)
+    if #task_ids == 0 then
+        return {0, 0}
+    end
+    redis.call('LTRIM', pending, 0, -#task_ids - 1)
+    local resumed = 0
+    for i = #task_ids, 1, -1 do
+        local task_id = task_ids[i]
+        -- expired tasks must not take tickets
+        if redis.call('EXISTS', task_key(task_id)) == 1 then
+            local ticket, position = take_ticket(handler_id)
+            redis.call('LPUSH', queue, task_id)
+            update_task(task_id, 'queued', 'queue_ticket', ticket,
+                        'current_position', position)
+            resumed = resumed + 1
+        end
+    end
+    return {#task_ids, resumed}
+end
+
+local function remove_worker(worker_id)
+    redis.call('ZREM', WORKER_HEARTBEATS, worker_id)
+    if redis.call('HDEL', WORKERS, worker_id) == 1 then
+        redis.call('PUBLISH', WORKER_EVENTS, worker_id)
+    end
+end
+
+-- Register worker or refresh its heartbeat.
+-- ARGV: worker id, healthy handler ids json
+-- returns 1 if worker joined or its handlers changed
+local function worker_heartbeat(_, args)
+    if redis.call('TYPE', WORKERS).ok == 'list' then
+        redis.call('DEL', WORKERS)  -- registry of older versions
+    end
+    redis.call('ZADD', WORKER_HEARTBEATS, now(), args[1])
+    if redis.call('HGET', WORKERS, args[1]) == args[2] then
+        return 0
+    end
+    redis.call('HSET', WORKERS, args[1], args[2])
+    redis.call('PUBLISH', WORKER_EVENTS, args[1])
+    return 1
+end
+
+-- ARGV: worker id
+local function worker_leave(_, args)
+    remove_worker(args[1])
+    return 1
+end
+
+-- Remove workers without heartbeats for worker ttl.
+-- ARGV: worker ttl; returns removed worker ids
+local function worker_prune(_, args)
+    local worker_ids = redis.call('ZRANGEBYSCORE', WORKER_HEARTBEATS,
+                                  '-inf', now() - tonumber(args[1]))
+    for _, worker_id in ipairs(worker_ids) do
+        remove_worker(worker_id)
+    end
+    return worker_ids
+end
+
+-- Take free lease or extend own one.
+-- ARGV: lease name, owner id, ttl ms; returns 1 if owner holds the lease
+local function leader_acquire(_, args)
+    local key = LEADER .. args[1]
+    local owner = redis.call('GET', key)
+    if owner == args[2] then
+        redis.call('PEXPIRE', key, args[3])
+        return 1
+    end
+    if owner then
+        return 0
+    end
+    redis.call('SET', key, args[2], 'PX', args[3])
+    redis.call('PUBLISH', key, args[2])
+    return 1
+end
+
+-- ARGV: lease name, owner id; returns 1 if the lease was released
+local function leader_release(_, args)
+    local key = LEADER .. args[1]
+    if redis.call('GET', key) ~= args[2] then
+        return 0
+    end
+    redis.call('DEL', key)
+    redis.call('PUBLISH', key, '')
+    return 1
+end
+
+redis.register_function{function_name = 'suz_version', callback = version,
+                        flags = {'no-writes'}}
+redis.register_function('task_enqueue', task_enqueue)
+redis.register_function('task_claim', task_claim)
+redis.register_function('lease_renew', lease_renew)
+redis.register_function('lease_requeue', lease_requeue)
+redis.register_function('task_complete', task_complete)
+redis.register_function('task_fail', task_fail)
+redis.register_function('task_feedback', task_feedback)
+redis.register_function('handler_suspend', handler_suspend)
+redis.register_function('handler_resume', handler_resume)
+redis.register_function('worker_heartbeat', worker_heartbeat)
+redis.register_function('worker_leave', worker_leave)
+redis.register_function('worker_prune', worker_prune)
+redis.register_function('leader_acquire', leader_acquire)
+redis.register_function('leader_release', leader_release)
@@ -0,0 +1,55 @@
+"""Task codec vs pydantic JSON round trip.
+
+Run from `shared/`: python benchmarks/task_codec_bench.py
+"""
+import timeit
+
+from suz_shared.codec import decode_task, encode_task
+from suz_shared.schemas.answer import Answer
+from suz_shared.schemas.task import Task
+
+NUMBER = 2000
+REPEAT = 5
+
+
+def make_small_task() -> Task:
+    return Task(task_id='4f1c', prompt='Как оформить отпуск?',
+                handler_id='generate_pm:1', user_id='user',
+                queued_at='2025-01-01T00:00:00+00:00',
+                result=Answer(text='Ответ ' * 20))
+
+
+def make_large_task() -> Task:
+    docs = {f'doc_{i}': 'Фрагмент документа базы знаний. ' * 40
+            for i in range(10)}
+    return Task(task_id='4f1c', prompt='Как оформить отпуск?',
+                handler_id='generate_pm:1', user_id='user',
+                queued_at='2025-01-01T00:00:00+00:00',
+                result=Answer(text='Ответ ' * 300, relevant_docs=docs))
+
+
+def run(label: str, task: Task):
+    raw_json = task.model_dump_json()
+    raw_hash = encode_task(task)
+
+    cases = {
+        'pydantic encode': lambda: task.model_dump_json(),
+        'pydantic decode': lambda: Task.model_validate_json(raw_json),
+        'codec encode': lambda: encode_task(task),
+        'codec decode': lambda: decode_task(raw_hash),
+    }
+    for name, func in cases.items():
+        # best of REPEAT runs: least disturbed by other processes
+        seconds = min(timeit.repeat(func, number=NUMBER, repeat=REPEAT))
+        print(f'{label} {name:<16} {seconds / NUMBER * 1e6:9.1f} us/op')
+    print(f'{label} json size {len(raw_json)} B, '
+          f'hash size {sum(map(len, raw_hash.values()))} B')
+
+
+def main():
+    run('small', make_small_task())
+    run('large', make_large_task())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Codec of `task:<task_id>` Redis hashes.
+
+Hash holds one field per Task field: scalars as plain strings, booleans
+as '1'/'0', nested models (TASK_JSON_FIELDS) as JSON. Full task hashes
+carry `_v` field with SCHEMA_VERSION.
+
+Encoding reads the model `__dict__` and serializes nested models with
+orjson, skipping pydantic serialization (its per-call overhead is most
+of the cost for a task). Decoding parses JSON fields with orjson and
+validates the hash with the Task validator, which coerces the string
+scalars in pydantic-core. Short JSON values (mostly empty errors and
+neutral feedback) repeat across tasks, their parsed values are cached.
+Compare with pydantic JSON: python benchmarks/task_codec_bench.py
+
+orjson is used for JSON when installed (`suz-shared[fast]`).
+"""
+import json
+from enum import Enum
+from typing import Any, Mapping
+
+from pydantic import BaseModel
+
+from suz_shared.schemas.task import TASK_JSON_FIELDS, Task
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+SCHEMA_VERSION = '1'
+VERSION_FIELD = '_v'
+
+TASK_FIELDS = tuple(Task.model_fields)
+SCALAR_FIELDS = tuple(
+    name for name in TASK_FIELDS if name not in TASK_JSON_FIELDS)
+JSON_FIELDS = tuple(name for name in TASK_FIELDS if name in TASK_JSON_FIELDS)
+
+# parsed short JSON values, shared: only passed to validation
+JSON_CACHE_MAX_LENGTH = 64
+JSON_CACHE_SIZE = 256
+__json_cache: dict[str, Any] = {}
+
+__validate_task = Task.__pydantic_validator__.validate_python
+
+
+def dumps(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value, default=__model_dict).decode('utf-8')
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'),
+                      default=__model_dict)
+
+
+def loads(value: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(value)
+    return json.loads(value)
+
+
+def __model_dict(value: Any) -> Any:
+    # nested models of a nested model
+    if isinstance(value, BaseModel):
+        return value.__dict__
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def encode_task(task: Task, include: set[str] | None = None
+                ) -> dict[str, str]:
+    """Task (or only included fields) as task hash fields"""
+    values = task.__dict__
+    if include is None:
+        scalar_fields, json_fields = SCALAR_FIELDS, JSON_FIELDS
+    else:
+        scalar_fields = [name for name in include
+                         if name not in TASK_JSON_FIELDS]
+        json_fields = [name for name in include if name in TASK_JSON_FIELDS]
+    fields = {}
+    for name in scalar_fields:
+        value = values[name]
+        value_type = type(value)
+        if value_type is str:
+            fields[name] = value
+        elif value_type is bool:
+            fields[name] = '1' if value else '0'
+        elif isinstance(value, Enum):
+            fields[name] = value.value
+        else:
+            fields[name] = str(value)
+    for name in json_fields:
+        fields[name] = dumps(values[name].__dict__)
+    if include is None:
+        fields[VERSION_FIELD] = SCHEMA_VERSION
+    return fields
+
+
+def decode_task(data: Mapping[str, str]) -> Task:
+    """Task from hash fields (HGETALL result).
+
+    Raises pydantic.ValidationError for malformed hashes.
+    """
+    fields = dict(data)
+    fields.pop(VERSION_FIELD, None)
+    for name in JSON_FIELDS:
+        value = fields.get(name)
+        if value is not None:
+            fields[name] = __load_json(value)
+    # model_validate without its Python-level wrapper
+    return __validate_task(fields)
+
+
+def __load_json(value: str) -> Any:
+    parsed = __json_cache.get(value)
+    if parsed is None:
+        parsed = loads(value)
+        if (len(value) <= JSON_CACHE_MAX_LENGTH
+                and len(__json_cache) < JSON_CACHE_SIZE):
+            __json_cache[value] = parsed
+    return parsed
@@ -0,0 +1,169 @@
+"""Pooled Redis client with client-side cache of hot keys.
+
+`CachedRedis.cached_get` keeps values of keys under `cache_prefixes` in
+process. A dedicated connection enables broadcast tracking for the
+prefixes with invalidations redirected to itself
+(CLIENT TRACKING on REDIRECT <own id> BCAST PREFIX ...) and subscribes
+to `__redis__:invalidate`, so a write of any client to a cached key
+drops it at once. Without tracking support (Redis < 6, proxies) or
+while the tracking connection is down, values expire after
+`cache_ttl` instead.
+
+Latency of every command (functions as `FCALL <name>`) is reported to
+`command_observer` when it is set, pipelines are not timed.
+
+Requires `suz-shared[redis]`.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Sequence
+
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
+
+INVALIDATE_CHANNEL = '__redis__:invalidate'
+# tracking connection is pinged when idle for that long
+HEALTH_CHECK_INTERVAL = 10
+
+
+class CachedRedis(Redis):
+    def __init__(self, *args: Any, cache_prefixes: Sequence[str] = (),
+                 cache_ttl: float = 5.0, cache_size: int = 10000,
+                 **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.cache_prefixes = tuple(cache_prefixes)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.tracking = False
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_invalidations = 0
+        self._cache: OrderedDict[str, tuple[float, str | None]] = (
+            OrderedDict())
+        # changes on every invalidation, values read before are not stored
+        self._generation = 0
+        self._tracker: asyncio.Task | None = None
+        self.command_observer: Callable[[str, float], None] | None = None
+
+    async def execute_command(self, *args: Any, **options: Any) -> Any:
+        if self.command_observer is None:
+            return await super().execute_command(*args, **options)
+        start_time = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            command = str(args[0]).upper()
+            if command == 'FCALL':
+                command = f'FCALL {args[1]}'
+            self.command_observer(command, time.perf_counter() - start_time)
+
+    def start_tracking(self):
+        if self.cache_prefixes and self._tracker is None:
+            self._tracker = asyncio.create_task(self._track_invalidations())
+
+    async def aclose(self, close_connection_pool: bool | None = None):
+        if self._tracker is not None:
+            self._tracker.cancel()
+            await asyncio.gather(self._tracker, return_exceptions=True)
+            self._tracker = None
+        await super().aclose(close_connection_pool)
+
+    async def cached_get(self, key: str) -> str | None:
+        """GET served from local cache for keys under cache prefixes"""
+        if not key.startswith(self.cache_prefixes):
+            return await self.get(key)
+        item = self._cache.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
+            return item[1]
+
+        self.cache_misses += 1
+        generation = self._generation
+        value = await self.get(key)
+        if generation == self._generation:
+            ttl = float('inf') if self.tracking else self.cache_ttl
+            self._cache[key] = (time.monotonic() + ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def cache_stats(self) -> dict[str, float]:
+        requests = self.cache_hits + self.cache_misses
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'invalidations': self.cache_invalidations,
+            'hit_rate': self.cache_hits / requests if requests else 0.0,
+            'size': len(self._cache),
+            'tracking': float(self.tracking),
+        }
+
+    def _invalidate(self, keys: list[str] | None):
+        self._generation += 1
+        self.cache_invalidations += 1
+        if keys is None:
+            self._cache.clear()
+            return
+        for key in keys:
+            self._cache.pop(key, None)
+
+    async def _track_invalidations(self):
+        prefixes = [arg for prefix in self.cache_prefixes
+                    for arg in ('PREFIX', prefix)]
+        while True:
+            connection = self.connection_pool.make_connection()
+            try:
+                await connection.connect()
+                await connection.send_command('CLIENT', 'ID')
+                client_id = await connection.read_response()
+                await connection.send_command(
+                    'CLIENT', 'TRACKING', 'on', 'REDIRECT', client_id,
+                    'BCAST', *prefixes)
+                await connection.read_response()
+                await connection.send_command('SUBSCRIBE', INVALIDATE_CHANNEL)
+                await connection.read_response()
+                # values cached before tracking have a ttl, drop them
+                self._invalidate(None)
+                self.tracking = True
+
+                pinged = False
+                while True:
+                    message = await connection.read_response(
+                        timeout=HEALTH_CHECK_INTERVAL)
+                    if message is None:
+                        if pinged:
+                            raise ConnectionError('Tracking connection lost')
+                        await connection.send_command('PING')
+                        pinged = True
+                        continue
+                    pinged = False
+                    if message[0] == 'message':
+                        self._invalidate(message[2])
+            except ResponseError:
+                # tracking is not supported, ttl cache only
+                return
+            except (ConnectionError, TimeoutError, OSError):
+                pass
+            finally:
+                if self.tracking:
+                    self.tracking = False
+                    self._invalidate(None)
+                await connection.disconnect()
+            await asyncio.sleep(1)
+
+
+def create_redis(host: str, port: int, db: int, max_connections: int,
+                 pool_timeout: float, cache_prefixes: Sequence[str] = (),
+                 cache_ttl: float = 5.0, cache_size: int = 10000,
+                 **kwargs: Any) -> CachedRedis:
+    """Client over a bounded pool, commands wait for a free connection"""
+    pool = BlockingConnectionPool(
+        host=host, port=port, db=db, max_connections=max_connections,
+        timeout=pool_timeout, decode_responses=True, **kwargs)
+    redis = CachedRedis(connection_pool=pool, cache_prefixes=cache_prefixes,
+                        cache_ttl=cache_ttl, cache_size=cache_size)
+    redis.auto_close_connection_pool = True
+    return redis
@@ -0,0 +1,40 @@
+"""Loader of the `suz_queue` Redis Functions library.
+
+Library source lives in `redis_functions/suz_queue.lua` in the project
+root (shared is installed editable), see the file header for semantics.
+Backend and worker both load it on start, whoever comes first with a
+newer LIBRARY_VERSION replaces the loaded one.
+
+Requires `suz-shared[redis]`.
+"""
+import re
+from pathlib import Path
+
+from loguru import logger
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+LIBRARY_PATH = (
+        Path(__file__).parents[3] / 'redis_functions' / 'suz_queue.lua')
+
+
+def library_version(code: str) -> int:
+    return int(re.search(r'LIBRARY_VERSION = (\d+)', code).group(1))
+
+
+async def load_redis_functions(redis: Redis):
+    """Load library unless the same or newer version is loaded"""
+    code = LIBRARY_PATH.read_text(encoding='utf-8')
+    version = library_version(code)
+    try:
+        loaded_version = int(await redis.fcall('suz_version', 0))
+    except ResponseError:
+        loaded_version = 0
+
+    if loaded_version < version:
+        await redis.function_load(code, replace=True)
+        logger.info(f'ℹ️ Redis functions suz_queue v{version} loaded')
+    elif loaded_version > version:
+        logger.warning(
+            f'⚠️ Redis functions suz_queue v{loaded_version} is newer '
+            f'than local v{version}')
@@ -0,0 +1,6 @@
+from pydantic import BaseModel
+
+
+class Answer(BaseModel):
+    text: str
+    relevant_docs: dict[str, str] = {}
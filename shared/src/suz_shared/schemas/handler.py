@@ -0,0 +1,23 @@
+from enum import Enum
+
+from pydantic import BaseModel, computed_field
+
+
+class HandlerExecutor(str, Enum):
+    THREAD = 'thread'  # I/O-bound handlers, shared interpreter
+    PROCESS = 'process'  # CPU-bound handlers, separate interpreters
+
+
+class HandlerConfig(BaseModel):
+    name: str
+    task_type: str
+    import_path: str
+    version: str
+    description: str = ''
+    max_concurrency: int = 1
+    executor: HandlerExecutor = HandlerExecutor.THREAD
+
+    @computed_field(return_type=str)
+    @property
+    def handler_id(self):
+        return f'{self.task_type}:{self.version}'
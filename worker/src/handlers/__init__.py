@@ -1,3 +1,3 @@
-from .handlers_init import verify_handlers
+from .handlers_init import Handler, verify_handlers
 
-__all__ = ['verify_handlers']
+__all__ = ['Handler', 'verify_handlers']
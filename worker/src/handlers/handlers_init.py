@@ -1,6 +1,8 @@
+import asyncio
 import importlib
-import time
-from typing import Callable
+import inspect
+from concurrent.futures import Executor
+from typing import Any, Callable
 
 from loguru import logger
 
@@ -9,6 +11,60 @@ from schemas.task import Task
 from schemas.handler import HandlerConfig
 
 
+class Handler:
+    """Uniform async interface over sync and coroutine handlers.
+
+    Imported object may be a plain function, a coroutine function or an
+    object with `__call__` and optional `setup`, `teardown` and `health`
+    methods (sync or async). Sync handlers run in `executor` if given;
+    hooks always run in the worker process.
+    """
+
+    def __init__(self, handler_id: str, func: Callable[[Task], Any],
+                 executor: Executor | None = None):
+        self.handler_id = handler_id
+        self.func = func
+        self.executor = executor
+        self.is_async = inspect.iscoroutinefunction(func) or (
+            inspect.iscoroutinefunction(getattr(func, '__call__', None)))
+        self._setup = getattr(func, 'setup', None)
+        self._teardown = getattr(func, 'teardown', None)
+        self._health = getattr(func, 'health', None)
+
+    async def __call__(self, task: Task) -> Answer:
+        """Run handler on the event loop (async) or in executor (sync)"""
+        if self.is_async:
+            return await self.func(task)
+        if self.executor is None:
+            return await asyncio.to_thread(self.func, task)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.func, task)
+
+    async def setup(self):
+        await self.__run_hook(self._setup)
+
+    async def teardown(self):
+        await self.__run_hook(self._teardown)
+
+    async def health(self) -> bool:
+        if self._health is None:
+            return True
+        try:
+            return bool(await self.__run_hook(self._health))
+        except Exception as e:
+            logger.warning(f'⚠️ Health check "{self.handler_id}": {e}')
+            return False
+
+    @staticmethod
+    async def __run_hook(hook: Callable[[], Any] | None):
+        if hook is None:
+            return None
+        result = hook()
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+
 def import_handler(import_string: str) -> Callable[[Task], Answer]:
     """Import awaitable function by string 'module:func'"""
     module_name, func_name = import_string.split(':')
@@ -16,28 +72,49 @@ def import_handler(import_string: str) -> Callable[[Task], Answer]:
     return getattr(module, func_name)
 
 
-def verify_handlers(
-        handlers_list: list[HandlerConfig]
-) -> dict[str, Callable[[Task], Answer]]:
-    """Verify and register handlers"""
+async def verify_handlers(
+        handlers_list: list[HandlerConfig],
+        executors: dict[str, Executor] | None = None
+) -> dict[str, Handler]:
+    """Verify and register handlers.
+
+    Test launch runs in the handler executor: a process pool handler
+    never runs (and loads its models) in the worker process itself.
+    """
+    executors = executors or {}
     test_task = Task(prompt='Привет')
-    verified_handlers: dict[str, Callable[[Task], Answer]] = {}
+    verified_handlers: dict[str, Handler] = {}
     for handler in handlers_list:
         try:
             for attempt in range(3):
+                handler_func = None
                 try:
-                    handler_func = import_handler(handler.import_path)
-                    handler_func(test_task)  # test launch
+                    handler_func = Handler(
+                        handler.handler_id,
+                        import_handler(handler.import_path),
+                        executors.get(handler.handler_id))
+                    await handler_func.setup()
+                    await handler_func(test_task)  # test launch
                     verified_handlers[handler.handler_id] = handler_func
                     logger.info(
-                        f'✅ Обработчик "{handler.handler_id}" готов')
+                        f'✅ Обработчик "{handler.handler_id}" готов'
+                        f'{" (async)" if handler_func.is_async else ""}')
                     break
                 except ImportError:
                     raise
                 except Exception as e:
+                    # освобождаем то, что занял setup (модели, память GPU),
+                    # перед повтором и перед отказом от обработчика
+                    if handler_func is not None:
+                        try:
+                            await handler_func.teardown()
+                        except Exception as teardown_error:
+                            logger.warning(
+                                f'⚠️ Teardown "{handler.handler_id}": '
+                                f'{teardown_error}')
                     if attempt == 2:
                         raise e
-                    time.sleep(3)
+                    await asyncio.sleep(3)
 
         except ImportError as e:
             logger.warning(
@@ -1,3 +1,10 @@
-from .rag import answer_with_rag
-
 __all__ = ['answer_with_rag']
+
+
+def __getattr__(name: str):
+    # rag loads models and indexes on import: not needed to run
+    # `python -m handlers.pm_handler.update_knowledge_base` and others
+    if name == 'answer_with_rag':
+        from .rag import answer_with_rag
+        return answer_with_rag
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,198 @@
+"""BM25 index over knowledge base chunks with CSR postings.
+
+Index directory (written by `BM25Index.build(...).save(path)`):
+    meta.json        format version, BM25 parameters, corpus stats
+    terms.npy        sorted vocabulary (fixed-width unicode)
+    indptr.npy       postings of term i are [indptr[i], indptr[i + 1])
+    doc_ids.npy      posting document numbers
+    weights.npy      posting BM25 weights, idf and length norm included
+    documents.jsonl, doc_offsets.npy  chunks (see docstore.py)
+Arrays are memory-mapped on load and documents are parsed only when
+they are returned, so nothing proportional to the corpus becomes Python
+objects. A query sums precomputed weights of its terms' postings and
+takes top k with argpartition; cost depends on the postings of query
+terms only.
+
+Tokens are lowercased words reduced by the Snowball Russian stemmer
+(latin words pass through unchanged). `build` takes term counts of
+chunks cached by an earlier build (see kb_cache.py), then only the
+vocabulary, idf and postings are computed again.
+
+Index of an existing pickled BM25Retriever:
+    python -m handlers.pm_handler.bm25_index \
+        --from-pickle bm25_retriever.pkl BM25_INDEX
+"""
+import argparse
+import json
+import pickle
+import re
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Iterable, Sequence
+
+import numpy as np
+import snowballstemmer
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .docstore import DocumentStore
+
+FORMAT_VERSION = 1
+TOKEN_RE = re.compile(r'\w+')
+MAX_TOKEN_LENGTH = 40
+# changes when tokenize() output would change, keys cached term counts
+TOKENIZER = f'russian:{MAX_TOKEN_LENGTH}'
+
+_stemmer = snowballstemmer.stemmer('russian')
+
+
+@lru_cache(maxsize=100_000)
+def _stem(word: str) -> str:
+    return _stemmer.stemWord(word)
+
+
+def tokenize(text: str) -> list[str]:
+    return [_stem(word)
+            for word in TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+            if len(word) <= MAX_TOKEN_LENGTH]
+
+
+def count_terms(text: str) -> dict[str, int]:
+    return dict(Counter(tokenize(text)))
+
+
+class BM25Index:
+    def __init__(self, meta: dict, terms: np.ndarray, indptr: np.ndarray,
+                 doc_ids: np.ndarray, weights: np.ndarray,
+                 docstore: DocumentStore):
+        self.meta = meta
+        self.terms = terms
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.docstore = docstore
+
+    @classmethod
+    def build(cls, documents: Iterable[Document], k1: float = 1.5,
+              b: float = 0.75,
+              term_counts: Sequence[dict[str, int]] | None = None
+              ) -> 'BM25Index':
+        """Index of documents, `term_counts[i]` are count_terms() of
+        `documents[i]` if known
+        """
+        documents = list(documents)
+        if term_counts is None:
+            term_counts = [count_terms(document.page_content)
+                           for document in documents]
+        vocabulary: dict[str, int] = {}
+        term_ids, posting_docs, tfs, doc_lengths = [], [], [], []
+        for doc_number, counts in enumerate(term_counts):
+            doc_lengths.append(sum(counts.values()))
+            term_ids.extend(vocabulary.setdefault(term, len(vocabulary))
+                            for term in counts)
+            posting_docs.extend([doc_number] * len(counts))
+            tfs.extend(counts.values())
+
+        # term ids follow sorted vocabulary, so lookup is a binary search
+        terms = np.array(sorted(vocabulary), dtype=str)
+        rank = np.empty(len(vocabulary), dtype=np.int64)
+        rank[[vocabulary[term] for term in terms]] = np.arange(len(terms))
+        term_ids = rank[np.array(term_ids, dtype=np.int64)]
+        posting_docs = np.array(posting_docs, dtype=np.int32)
+        tfs = np.array(tfs, dtype=np.float32)
+        order = np.lexsort((posting_docs, term_ids))
+        term_ids, posting_docs, tfs = (
+            term_ids[order], posting_docs[order], tfs[order])
+
+        n_docs = len(doc_lengths)
+        doc_lengths = np.array(doc_lengths, dtype=np.float32)
+        avgdl = float(doc_lengths.mean()) if n_docs else 0.0
+        df = np.bincount(term_ids, minlength=len(terms))
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(df, out=indptr[1:])
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        length_norm = k1 * (1 - b + b * doc_lengths / max(avgdl, 1e-9))
+        weights = (idf[term_ids] * tfs * (k1 + 1)
+                   / (tfs + length_norm[posting_docs])).astype(np.float32)
+
+        meta = {'version': FORMAT_VERSION, 'k1': k1, 'b': b,
+                'n_docs': n_docs, 'avgdl': avgdl, 'stemmer': 'russian'}
+        return cls(meta, terms, indptr, posting_docs, weights,
+                   DocumentStore.from_documents(documents))
+
+    def save(self, path: str | Path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ('terms', 'indptr', 'doc_ids', 'weights'):
+            np.save(path / f'{name}.npy', getattr(self, name))
+        self.docstore.save(path)
+        # meta goes last: an index without it is incomplete
+        (path / 'meta.json').write_text(json.dumps(self.meta))
+
+    @classmethod
+    def load(cls, path: str | Path) -> 'BM25Index':
+        # a symlinked index may be switched to a new version meanwhile
+        path = Path(path).resolve()
+        meta = json.loads((path / 'meta.json').read_text())
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError(
+                f'BM25 index format {meta["version"]} is not supported')
+        arrays = {name: np.load(path / f'{name}.npy', mmap_mode='r')
+                  for name in ('terms', 'indptr', 'doc_ids', 'weights')}
+        return cls(meta, docstore=DocumentStore.load(path), **arrays)
+
+    def search(self, query: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Numbers and scores of top k documents, best first"""
+        tokens = np.array(tokenize(query), dtype=str)
+        if not len(tokens) or not len(self.terms):
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        positions = np.searchsorted(self.terms, tokens)
+        found = positions < len(self.terms)
+        found[found] = self.terms[positions[found]] == tokens[found]
+        term_ids = positions[found]
+        if not len(term_ids):
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        slices = [slice(self.indptr[term_id], self.indptr[term_id + 1])
+                  for term_id in term_ids]
+        doc_ids = np.concatenate([self.doc_ids[s] for s in slices])
+        weights = np.concatenate([self.weights[s] for s in slices])
+        doc_ids, inverse = np.unique(doc_ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return doc_ids[top], scores[top]
+
+    def document(self, doc_number: int) -> Document:
+        return self.docstore[doc_number]
+
+
+class BM25IndexRetriever(BaseRetriever):
+    """Langchain retriever over BM25Index"""
+
+    index: Any
+    k: int = 10
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: Any = None) -> list[Document]:
+        doc_numbers, _ = self.index.search(query, self.k)
+        return [self.index.document(int(i)) for i in doc_numbers]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build BM25 index from pickled BM25Retriever')
+    parser.add_argument('--from-pickle', required=True)
+    parser.add_argument('directory')
+    args = parser.parse_args()
+    with open(args.from_pickle, 'rb') as f:
+        retriever = pickle.load(f)
+    BM25Index.build(retriever.docs).save(args.directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Knowledge base chunks stored as JSON lines, read lazily by number.
+
+Directory files:
+    documents.jsonl  {"page_content", "metadata"} per document
+    doc_offsets.npy  byte offsets of documents.jsonl lines
+Both are memory-mapped on load and a document is parsed only when it is
+returned, so the page cache holding them is shared by worker processes.
+"""
+import json
+import mmap
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+class DocumentStore:
+    def __init__(self, data: bytes | mmap.mmap, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[Document]) -> 'DocumentStore':
+        lines = [json.dumps({'page_content': document.page_content,
+                             'metadata': document.metadata},
+                            ensure_ascii=False).encode('utf-8') + b'\n'
+                 for document in documents]
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum([len(line) for line in lines], out=offsets[1:])
+        return cls(b''.join(lines), offsets)
+
+    def save(self, path: str | Path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        (path / 'documents.jsonl').write_bytes(bytes(self.data))
+        np.save(path / 'doc_offsets.npy', self.offsets)
+
+    @classmethod
+    def load(cls, path: str | Path) -> 'DocumentStore':
+        path = Path(path)
+        offsets = np.load(path / 'doc_offsets.npy', mmap_mode='r')
+        with open(path / 'documents.jsonl', 'rb') as f:
+            data = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    if offsets[-1] else b'')
+        return cls(data, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, doc_number: int) -> Document:
+        start, end = self.offsets[doc_number:doc_number + 2]
+        return Document(**json.loads(self.data[start:end]))
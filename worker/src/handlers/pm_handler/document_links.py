@@ -0,0 +1,79 @@
+"""Links of knowledge base chunks to their source documents.
+
+Links are computed once when the knowledge base is built
+(update_knowledge_base.py) and stored in chunk metadata as 'link'.
+`originals.json` maps document numbers to original file names; it is
+parsed once into `originals_index` and reparsed only when its mtime
+changes, which is checked at most every ORIGINALS_CHECK_INTERVAL.
+"""
+import json
+import os
+import threading
+import time
+from urllib.parse import quote
+
+ORIGINALS_PATH = 'knowlege_base_pm/originals.json'
+ORIGINALS_CHECK_INTERVAL = 5
+BASE_URL = ('https://df-bitbucket.ca.sbrf.ru/projects/KNOWLEDGE_BASE_SVA/'
+            'repos/knowledge_base_pm/browse')
+
+
+class OriginalsIndex:
+    """Document number -> original file name"""
+
+    def __init__(self, path: str, check_interval: float):
+        self.path = path
+        self.check_interval = check_interval
+        self._titles: dict[str, str] = {}
+        self._mtime = None
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def get_title(self, doc_number: str) -> str | None:
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            self._reload_if_changed()
+        return self._titles.get(doc_number)
+
+    def _reload_if_changed(self):
+        with self._lock:
+            self._checked_at = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError as e:
+                if self._mtime is not None:
+                    print(f'Ошибка при чтении originals.json: {e}')
+                self._titles, self._mtime = {}, None
+                return
+            if mtime == self._mtime:
+                return
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f'Ошибка при чтении originals.json: {e}')
+                return  # keep previous index, retry on next change
+            self._titles = {
+                doc_number: doc_data['internals_ids']['filename']
+                for doc_number, doc_data in data.get('originals', {}).items()
+                if (doc_data.get('internals_ids') or {}).get('filename')}
+            self._mtime = mtime
+
+
+originals_index = OriginalsIndex(ORIGINALS_PATH, ORIGINALS_CHECK_INTERVAL)
+
+
+def build_document_link(doc_metadata: str) -> str:
+    doc_number = None
+
+    # Извлекаем номер документа
+    if '_doc_' in doc_metadata:  # Для формата card_66_doc_31.md
+        doc_number = doc_metadata.split('_doc_')[-1].split('.')[0]
+    elif doc_metadata.startswith('doc_'):  # Для формата doc_31.md
+        doc_number = doc_metadata.split('_')[1].split('.')[0]
+
+    title = originals_index.get_title(doc_number) if doc_number else None
+    if not title:
+        doc_relative_path = doc_metadata.replace('knowledge_base_pm/', '')
+        return f'{BASE_URL}/{doc_relative_path}'
+
+    return f'{BASE_URL}/originals/{quote(title)}'
@@ -0,0 +1,219 @@
+"""Parallel streaming ingestion of knowledge base files.
+
+    files -> process pool (load, split) -> build cache, dedup by hash
+          -> bounded queue -> embedding thread (batches) -> build cache
+
+Files are loaded and split by `workers` processes with at most
+2 * workers files in flight; chunks are stored as soon as their file is
+done. A chunk text is queued for embedding only if its hash has neither
+a vector nor a place in the queue, only hashes are kept for that. The
+queue holds `queue_size` texts, so extraction waits when embedding lags
+behind and texts in memory stay bounded. Progress and
+throughput are printed every `progress_interval` seconds.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from pathlib import Path
+
+from transformers import AutoTokenizer
+from langchain.document_loaders import PyPDFLoader
+from langchain.document_loaders.text import TextLoader
+from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from .kb_cache import KnowledgeBaseCache
+
+# файлы базы 1.0 режутся на chunks, файлы базы 2.0 индексируются целиком
+SPLIT, WHOLE = 'split', 'whole'
+
+# splitters of pool process, the tokenizer is loaded once per process
+_splitters: dict[tuple[str, int], RecursiveCharacterTextSplitter] = {}
+
+
+def make_splitter(model_name: str,
+                  chunk_size: int) -> RecursiveCharacterTextSplitter:
+    # разбиваем на chunks в соответствии с ограничением эмбеддинг-модели
+    return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        AutoTokenizer.from_pretrained(model_name),
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_size // 10,
+        add_start_index=True,
+    )
+
+
+def load_file(path: str) -> list[Document]:
+    if path.endswith('.pdf'):
+        return PyPDFLoader(path).load()
+    return TextLoader(path).load()
+
+
+def process_file(path: str, mode: str, model_name: str,
+                 chunk_size: int) -> list[Document]:
+    """Chunks of file, runs in pool process"""
+    documents = load_file(path)
+    if mode == WHOLE:
+        return documents
+    key = (model_name, chunk_size)
+    if key not in _splitters:
+        _splitters[key] = make_splitter(model_name, chunk_size)
+    return _splitters[key].split_documents(documents)
+
+
+class EmbeddingStage(threading.Thread):
+    """Embeds queued (hash, text) in batches and stores the vectors"""
+
+    def __init__(self, cache_path: str | Path, model_name: str,
+                 batch_size: int, queue_size: int):
+        super().__init__(name='embedding', daemon=True)
+        self.cache_path = cache_path
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.queue: queue.Queue[tuple[str, str] | None] = queue.Queue(
+            queue_size)
+        self.embedded = 0
+        self.busy_seconds = 0.0
+        self.error: BaseException | None = None
+
+    def put(self, item: tuple[str, str]):
+        while True:
+            if self.error is not None:
+                raise RuntimeError('Embedding stage failed') from self.error
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def stop(self):
+        """Let queued texts be embedded and the thread exit"""
+        while self.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        # model is loaded on first batch, runs without new texts skip it
+        model = None
+        cache = KnowledgeBaseCache(self.cache_path, self.model_name)
+        try:
+            batch = []
+            while True:
+                item = self.queue.get()
+                if item is not None:
+                    batch.append(item)
+                if batch and (item is None
+                              or len(batch) >= self.batch_size):
+                    start_time = time.monotonic()
+                    if model is None:
+                        model = HuggingFaceEmbeddings(
+                            model_name=self.model_name)
+                    cache.put_embeddings(
+                        [hash_ for hash_, _ in batch],
+                        model.embed_documents([text for _, text in batch]))
+                    self.busy_seconds += time.monotonic() - start_time
+                    self.embedded += len(batch)
+                    batch = []
+                if item is None:
+                    return
+        except BaseException as e:
+            self.error = e
+        finally:
+            cache.close()
+
+
+class Progress:
+    def __init__(self, total_files: int, interval: float):
+        self.total_files = total_files
+        self.interval = interval
+        self.files = 0
+        self.chunks = 0
+        self.queued = 0
+        self.embedded = 0
+        self.embedding_seconds = 0.0
+        self.start_time = time.monotonic()
+        self._reported_at = self.start_time
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+    def report(self, force: bool = False):
+        if (not force
+                and time.monotonic() - self._reported_at < self.interval):
+            return
+        self._reported_at = time.monotonic()
+        elapsed = max(self.elapsed, 1e-9)
+        print(f'Файлы: {self.files}/{self.total_files} '
+              f'({self.files / elapsed:.1f}/с), '
+              f'chunks: {self.chunks} ({self.chunks / elapsed:.1f}/с), '
+              f'эмбеддинги: {self.embedded}/{self.queued} '
+              f'({self.embedded / elapsed:.1f}/с)', flush=True)
+
+
+def ingest(cache: KnowledgeBaseCache,
+           files: list[tuple[str, str, str, str]], model_name: str,
+           chunk_size: int, workers: int, batch_size: int,
+           queue_size: int, progress_interval: float) -> Progress:
+    """Store chunks of (path, mode, hash, chunking) files, embed them"""
+    progress = Progress(len(files), progress_interval)
+    seen = cache.embedded_hashes()
+    embedder = EmbeddingStage(cache.path, model_name, batch_size, queue_size)
+    embedder.start()
+
+    def enqueue(hash_: str, text: str):
+        if hash_ not in seen:
+            seen.add(hash_)
+            embedder.put((hash_, text))
+            progress.queued += 1
+
+    try:
+        pool = ProcessPoolExecutor(workers, mp_context=get_context('spawn'))
+        with pool:
+            todo = iter(files)
+            pending = {}
+            while True:
+                while len(pending) < 2 * workers:
+                    file = next(todo, None)
+                    if file is None:
+                        break
+                    path, mode, _, _ = file
+                    future = pool.submit(
+                        process_file, path, mode, model_name, chunk_size)
+                    pending[future] = file
+                if not pending:
+                    break
+                done, _ = wait(pending, timeout=progress_interval,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, _, hash_, chunking = pending.pop(future)
+                    documents = future.result()
+                    hashes = cache.put_file(path, hash_, chunking, documents)
+                    for chunk_hash, document in zip(hashes, documents):
+                        enqueue(chunk_hash, document.page_content)
+                    progress.files += 1
+                    progress.chunks += len(documents)
+                progress.embedded = embedder.embedded
+                progress.report()
+        # chunks left without vectors by interrupted runs
+        for hash_, text in cache.missing_embeddings():
+            enqueue(hash_, text)
+    finally:
+        embedder.stop()
+
+    while embedder.is_alive():
+        embedder.join(progress_interval)
+        progress.embedded = embedder.embedded
+        progress.report()
+    if embedder.error is not None:
+        raise RuntimeError('Embedding stage failed') from embedder.error
+    progress.embedded = embedder.embedded
+    progress.embedding_seconds = embedder.busy_seconds
+    if files or progress.queued:
+        progress.report(force=True)
+    return progress
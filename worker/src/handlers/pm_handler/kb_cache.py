@@ -0,0 +1,194 @@
+"""Knowledge base build cache, keyed by content hashes.
+
+SQLite database with
+    files       source file path, its content hash and chunking key
+    chunks      chunks of every file in order with their text hash
+    embeddings  vector of every chunk text hash per embedding model
+    term_counts BM25 term counts of every chunk text hash per tokenizer
+A file is re-split only when its hash or chunking key changes, a chunk
+is embedded and tokenized only when its text hash has no vector or
+term counts yet. `state` keeps the fingerprint of inputs the indexes
+were last built from.
+"""
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from langchain_core.documents import Document
+
+# hashes per query, below SQLite's limit of host parameters
+QUERY_BATCH = 500
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def file_hash(path: str | Path) -> str:
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+class KnowledgeBaseCache:
+    def __init__(self, path: str | Path, model: str):
+        self.path = Path(path)
+        self.model = model
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                chunking TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                path TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                page_content TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                PRIMARY KEY (path, seq)
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunks_hash ON chunks (hash);
+            CREATE TABLE IF NOT EXISTS embeddings (
+                hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (hash, model)
+            );
+            CREATE TABLE IF NOT EXISTS term_counts (
+                hash TEXT NOT NULL,
+                tokenizer TEXT NOT NULL,
+                counts TEXT NOT NULL,
+                PRIMARY KEY (hash, tokenizer)
+            );
+            CREATE TABLE IF NOT EXISTS state (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def clear(self):
+        with self.db:
+            for table in ('files', 'chunks', 'embeddings', 'term_counts',
+                          'state'):
+                self.db.execute(f'DELETE FROM {table}')
+
+    def files(self) -> dict[str, tuple[str, str]]:
+        """Path -> (content hash, chunking key) of cached files"""
+        return {path: (hash_, chunking) for path, hash_, chunking
+                in self.db.execute('SELECT path, hash, chunking FROM files')}
+
+    def put_file(self, path: str, hash_: str, chunking: str,
+                 chunks: list[Document]) -> list[str]:
+        """Replace chunks of file, return their text hashes"""
+        hashes = [text_hash(chunk.page_content) for chunk in chunks]
+        with self.db:
+            self.db.execute('DELETE FROM chunks WHERE path = ?', (path,))
+            self.db.executemany(
+                'INSERT INTO chunks (path, seq, hash, page_content, metadata) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(path, seq, chunk_hash, chunk.page_content,
+                  json.dumps(chunk.metadata, ensure_ascii=False, default=str))
+                 for seq, (chunk_hash, chunk)
+                 in enumerate(zip(hashes, chunks))])
+            self.db.execute(
+                'INSERT INTO files (path, hash, chunking) VALUES (?, ?, ?) '
+                'ON CONFLICT (path) DO UPDATE SET hash = excluded.hash, '
+                'chunking = excluded.chunking',
+                (path, hash_, chunking))
+        return hashes
+
+    def remove_files(self, paths: Iterable[str]):
+        with self.db:
+            for path in paths:
+                self.db.execute('DELETE FROM chunks WHERE path = ?', (path,))
+                self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def chunks(self, path: str) -> list[tuple[str, Document]]:
+        """(text hash, chunk) of file in order"""
+        return [(hash_, Document(page_content=page_content,
+                                 metadata=json.loads(metadata)))
+                for hash_, page_content, metadata in self.db.execute(
+                    'SELECT hash, page_content, metadata FROM chunks '
+                    'WHERE path = ? ORDER BY seq', (path,))]
+
+    def embedded_hashes(self) -> set[str]:
+        return {hash_ for hash_, in self.db.execute(
+            'SELECT hash FROM embeddings WHERE model = ?', (self.model,))}
+
+    def missing_embeddings(self) -> list[tuple[str, str]]:
+        """(text hash, text) of chunks without a vector of the model"""
+        return self.db.execute(
+            'SELECT hash, MIN(page_content) FROM chunks '
+            'WHERE hash NOT IN '
+            '(SELECT hash FROM embeddings WHERE model = ?) '
+            'GROUP BY hash', (self.model,)).fetchall()
+
+    def put_embeddings(self, hashes: list[str], vectors: list[list[float]]):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO embeddings (hash, model, vector) '
+                'VALUES (?, ?, ?)',
+                [(hash_, self.model,
+                  np.asarray(vector, dtype=np.float32).tobytes())
+                 for hash_, vector in zip(hashes, vectors)])
+
+    def embeddings(self, hashes: list[str]) -> np.ndarray:
+        """Vectors of chunk hashes, row per hash"""
+        unique = list(dict.fromkeys(hashes))
+        vectors = {}
+        # only requested rows: updates need vectors of new chunks only
+        for start in range(0, len(unique), QUERY_BATCH):
+            batch = unique[start:start + QUERY_BATCH]
+            vectors.update(
+                (hash_, np.frombuffer(vector, dtype=np.float32))
+                for hash_, vector in self.db.execute(
+                    f'SELECT hash, vector FROM embeddings WHERE model = ? '
+                    f'AND hash IN ({", ".join("?" * len(batch))})',
+                    (self.model, *batch)))
+        return np.stack([vectors[hash_] for hash_ in hashes])
+
+    def prune_embeddings(self) -> int:
+        """Drop vectors and term counts no chunk refers to, return the
+        number of vectors
+        """
+        with self.db:
+            self.db.execute('DELETE FROM term_counts WHERE hash NOT IN '
+                            '(SELECT hash FROM chunks)')
+            return self.db.execute(
+                'DELETE FROM embeddings WHERE hash NOT IN '
+                '(SELECT hash FROM chunks)').rowcount
+
+    def term_counts(self, tokenizer: str) -> dict[str, dict[str, int]]:
+        """Chunk hash -> term counts of all chunks tokenized so far"""
+        return {hash_: json.loads(counts) for hash_, counts in self.db.execute(
+            'SELECT hash, counts FROM term_counts WHERE tokenizer = ?',
+            (tokenizer,))}
+
+    def put_term_counts(self, tokenizer: str,
+                        counts: dict[str, dict[str, int]]):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO term_counts (hash, tokenizer, counts) '
+                'VALUES (?, ?, ?)',
+                [(hash_, tokenizer, json.dumps(chunk_counts,
+                                               ensure_ascii=False))
+                 for hash_, chunk_counts in counts.items()])
+
+    def get_state(self, name: str) -> str | None:
+        row = self.db.execute(
+            'SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, name: str, value: str):
+        with self.db:
+            self.db.execute(
+                'INSERT INTO state (name, value) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET value = excluded.value',
+                (name, value))
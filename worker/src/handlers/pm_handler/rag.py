@@ -1,9 +1,3 @@
-import os
-import sys
-sys.path.insert(0, os.path.join(os.getcwd(), 'handlers','pm_handler'))
-
-import json
-import pickle
 import time
 import warnings
 from typing import List
@@ -12,32 +6,33 @@ warnings.filterwarnings('ignore')
 
 from FlagEmbedding import FlagReranker
 from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import FAISS
 from langchain.retrievers import EnsembleRetriever
 from langchain.schema import Document
 from langchain.prompts import PromptTemplate
-from urllib.parse import quote
 
+from .bm25_index import BM25Index, BM25IndexRetriever
+from .document_links import build_document_link
 from .gigachat_connect import get_answer
 from .prompts import PROMPT_IN_CHAT_FORMAT
 from .utils import add_docs_links
+from .vector_index import VectorIndex, VectorIndexRetriever
 
 
 def init():
     pass
 
 EMBEDDING_MODEL_NAME = 'models/intfloat'
+# None keeps efSearch/nprobe chosen at build, e.g. {'nprobe': 32}
+VECTOR_SEARCH_PARAMS = None
 
 embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
 
-with open('bm25_retriever.pkl', 'rb') as f:
-    bm25_retriever = pickle.load(f)
-
-KNOWLEDGE_VECTOR_DATABASE = FAISS.load_local(
-    'VECTOR_DB', embedding_model, allow_dangerous_deserialization=True)
+bm25_retriever = BM25IndexRetriever(index=BM25Index.load('BM25_INDEX'), k=10)
 
-faiss_retriever = KNOWLEDGE_VECTOR_DATABASE.as_retriever(
-    search_kwargs={'k': 5}
+faiss_retriever = VectorIndexRetriever(
+    index=VectorIndex.load('VECTOR_INDEX', VECTOR_SEARCH_PARAMS),
+    embeddings=embedding_model,
+    k=5
 )
 
 ensemble_retriever = EnsembleRetriever(
@@ -96,47 +91,6 @@ def get_top_docs(score_to_doc, num_docs):
     return docs
 
 
-def parse_originals_json(doc_number: str) -> dict:
-    try:
-        with open('knowlege_base_pm/originals.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        doc_data = data.get('originals', {}).get(doc_number)
-        if doc_data:
-            doc_description = doc_data.get('internals_ids', {})
-
-            return {
-                'title': doc_description.get('filename'),
-            }
-        return None
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f'Ошибка при чтении originals.json: {e}')
-        return None
-
-
-def build_document_link(doc_metadata: str) -> str:
-    # Формируем ссылку
-    base_url = 'https://df-bitbucket.ca.sbrf.ru/projects/KNOWLEDGE_BASE_SVA/repos/knowledge_base_pm/browse'
-
-    doc_number = None
-
-    # Извлекаем номер документа
-    if '_doc_' in doc_metadata:  # Для формата card_66_doc_31.md
-        doc_number = doc_metadata.split('_doc_')[-1].split('.')[0]
-    elif doc_metadata.startswith('doc_'):  # Для формата doc_31.md
-        doc_number = doc_metadata.split('_')[1].split('.')[0]
-
-    # Получаем информацию о документе
-    doc_info = parse_originals_json(doc_number)
-
-    if not doc_number or not doc_info or not doc_info.get('title'):
-        doc_relative_path = doc_metadata.replace('knowledge_base_pm/', '')
-        return f'{base_url}/{doc_relative_path}'
-
-    encoded_title = quote(doc_info['title'])
-
-    return f'{base_url}/originals/{encoded_title}'
-
-
 def answer_with_rag(prompt: str,
                     num_retrieved_docs: int = 100,
                     num_docs_final: int = 5) -> str:
@@ -147,7 +101,10 @@ def answer_with_rag(prompt: str,
     for doc in relevant_docs:
         doc_content = doc.page_content
         doc_metadata = doc.metadata.get('source', '') if hasattr(doc, 'metadata') else ''
-        doc_link = build_document_link(doc_metadata) if doc_metadata else None
+        # links are stored in chunk metadata since knowledge base build
+        doc_link = doc.metadata.get('link') if hasattr(doc, 'metadata') else None
+        if not doc_link and doc_metadata:
+            doc_link = build_document_link(doc_metadata)
 
         processed_docs.append({
             'text': doc_content,
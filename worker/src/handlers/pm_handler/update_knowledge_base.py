@@ -1,101 +1,247 @@
+"""Build BM25_INDEX and VECTOR_INDEX from knowlege_base_pm.
+
+Rebuilds are incremental (see kb_cache.py): only new and changed files
+are loaded and split, only chunks with unseen text are embedded and
+tokenized. BM25 index is assembled from cached term counts, an IVF
+vector index is updated in place with vectors of added chunks only
+(see VectorIndex.update). A run without changes does nothing. Files
+stream through parallel extraction and batched embedding (see
+ingest.py).
+
+    python -m handlers.pm_handler.update_knowledge_base [--full]
+        [--workers N] [--embedding-batch-size N] [--queue-size N]
+        [--progress-interval SECONDS]
+"""
+import argparse
 import json
 import os
-import pickle
-from typing import List, Optional, Tuple
-
-from transformers import AutoTokenizer, Pipeline
-from langchain_community.retrievers import BM25Retriever
-from langchain.document_loaders.text import TextLoader
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import FAISS
-from langchain.vectorstores.utils import DistanceStrategy
-from langchain.document_loaders import PyPDFDirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from langchain.schema import Document
+
+from .bm25_index import TOKENIZER, BM25Index, count_terms
+from .document_links import ORIGINALS_PATH, build_document_link
+from .ingest import SPLIT, WHOLE, ingest
+from .kb_cache import KnowledgeBaseCache, file_hash, text_hash
+from .vector_index import VectorIndex
 
 # Путь к директории с PDF и Markdown файлам
 base_1_0_directory = 'knowlege_base_pm/knowledge_base_v_1/BZ'
 base_2_0_directory = 'knowlege_base_pm/KB'
 
-# Загрузка Markdown файлов из директории и всех вложенных папок
-def load_markdown_files(directory):
-
-    markdown_documents = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.md'):
-                file_path = os.path.join(root, file)
-                markdown_loader = TextLoader(file_path)
-                markdown_documents.append(markdown_loader.load())
-
-    return markdown_documents
-
-# Загрузчик PDF файлов из директории
-pdf_loader = PyPDFDirectoryLoader(base_1_0_directory)
-
-# Загрузка данных
-pdf_documents = pdf_loader.load()
-markdown_documents_1 = load_markdown_files(base_1_0_directory)
-markdown_documents_2 = load_markdown_files(base_2_0_directory)
-
-# Объединение загруженных документов
-bz1_documents = pdf_documents + [doc for sublist in markdown_documents_1 for doc in sublist]
-
 EMBEDDING_MODEL_NAME = 'models/intfloat'
-
-def split_documents(
-    chunk_size: int,
-    knowledge_base: bz1_documents,
-    tokenizer_name: Optional[str] = EMBEDDING_MODEL_NAME,
-) -> bz1_documents:
+CHUNK_SIZE = 512
+EMBEDDING_BATCH_SIZE = 64
+# chunk texts waiting for embedding
+EMBEDDING_QUEUE_SIZE = 1024
+PROGRESS_INTERVAL = 10
+# flat, hnsw, hnsw_sq8, ivf_sq8 или ivf_pq (см. vector_index.py);
+# ivf только добавляет векторы к обученному индексу, hnsw при каждом
+# изменении строит граф заново
+VECTOR_INDEX_TYPE = 'ivf_sq8'
+VECTOR_INDEX_PARAMS = {'hnsw_m': 32, 'ef_construction': 200,
+                       'ef_search': 64, 'nprobe': 16}
+
+CACHE_PATH = 'KB_CACHE.sqlite'
+BM25_INDEX_PATH = 'BM25_INDEX'
+VECTOR_INDEX_PATH = 'VECTOR_INDEX'
+
+
+def list_sources() -> list[tuple[str, str]]:
+    """(path, mode) of knowledge base files in index order"""
+    pdf_files = sorted(
+        str(path) for path in Path(base_1_0_directory).glob('**/[!.]*.pdf')
+        if not any(part.startswith('.') for part in path.parts))
+    return ([(path, SPLIT) for path in pdf_files]
+            + [(path, SPLIT) for path in markdown_files(base_1_0_directory)]
+            + [(path, WHOLE) for path in markdown_files(base_2_0_directory)])
+
+
+def markdown_files(directory: str) -> list[str]:
+    return sorted(os.path.join(root, file)
+                  for root, _, files in os.walk(directory)
+                  for file in files if file.endswith('.md'))
+
+
+def chunking_key(mode: str) -> str:
+    """Changes when chunks of unchanged file would change"""
+    if mode == WHOLE:
+        return WHOLE
+    return f'{EMBEDDING_MODEL_NAME}:{CHUNK_SIZE}:{CHUNK_SIZE // 10}'
+
+
+def assemble(cache: KnowledgeBaseCache,
+             sources: list[tuple[str, str]]
+             ) -> tuple[list[Document], list[str], list[str]]:
+    """Chunks of all files, their text hashes and keys in index order.
+
+    Key of a deduplicated chunk is its text hash, chunks of whole files
+    are told apart by path.
     """
-    Split documents into chunks of maximum size `chunk_size` tokens and
-    return a list of documents.
+    documents, hashes, keys, seen = [], [], [], set()
+    for path, mode in sources:
+        for seq, (hash_, document) in enumerate(cache.chunks(path)):
+            # удаляем дубли
+            if mode == SPLIT:
+                if hash_ in seen:
+                    continue
+                seen.add(hash_)
+                keys.append(hash_)
+            else:
+                keys.append(f'{path}:{seq}:{hash_}')
+            documents.append(document)
+            hashes.append(hash_)
+    # ссылки на документы считаем один раз, при сборке базы
+    for document in documents:
+        source = document.metadata.get('source', '')
+        document.metadata['link'] = (
+            build_document_link(source) if source else None)
+    return documents, hashes, keys
+
+
+def chunk_term_counts(cache: KnowledgeBaseCache, documents: list[Document],
+                      hashes: list[str]) -> list[dict[str, int]]:
+    """BM25 term counts of chunks, only new texts are tokenized"""
+    counts = cache.term_counts(TOKENIZER)
+    new_counts = {}
+    for document, hash_ in zip(documents, hashes):
+        if hash_ not in counts and hash_ not in new_counts:
+            new_counts[hash_] = count_terms(document.page_content)
+    cache.put_term_counts(TOKENIZER, new_counts)
+    counts.update(new_counts)
+    return [counts[hash_] for hash_ in hashes]
+
+
+def build_vector_index(cache: KnowledgeBaseCache, documents: list[Document],
+                       hashes: list[str], keys: list[str]) -> VectorIndex:
+    """Previous index updated with changed chunks or a new one"""
+    # векторы другой модели не должны переиспользоваться
+    keys = [f'{EMBEDDING_MODEL_NAME}:{key}' for key in keys]
+    index = VectorIndex.update(
+        VECTOR_INDEX_PATH, documents, keys,
+        lambda doc_numbers: cache.embeddings(
+            [hashes[i] for i in doc_numbers]),
+        VECTOR_INDEX_TYPE, **VECTOR_INDEX_PARAMS)
+    if index is None:
+        index = VectorIndex.build(
+            documents, cache.embeddings(hashes), VECTOR_INDEX_TYPE,
+            previous=VECTOR_INDEX_PATH, keys=keys, **VECTOR_INDEX_PARAMS)
+    return index
+
+
+def save_replacing(index: BM25Index | VectorIndex, path: str):
+    """Save to a new version directory and switch path to it.
+
+    path is a symlink to `<path>.<version>`, replaced with os.replace of
+    a temporary symlink, so readers always find a complete index.
+    Workers keep reading memory-mapped files of the old index until
+    they reload, so the previous version is kept as well.
     """
-    text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
-        AutoTokenizer.from_pretrained(tokenizer_name),
-        chunk_size=chunk_size,
-        chunk_overlap=int(chunk_size / 10),
-        add_start_index=True,
-    )
-
-    docs_processed = []
-    for doc in bz1_documents:
-        docs_processed += text_splitter.split_documents([doc])
-
-    # удаляем дубли
-    unique_texts = {}
-    docs_processed_unique = []
-    for doc in docs_processed:
-        if doc.page_content not in unique_texts:
-            unique_texts[doc.page_content] = True
-            docs_processed_unique.append(doc)
-
-    return docs_processed_unique
-
-# разобьем документы на chunks в соответствии с ограничением эмбеддинг-модели
-docs_processed_simple = split_documents(
-    512,
-    bz1_documents,
-    tokenizer_name=EMBEDDING_MODEL_NAME,
-)
-
-docs_processed_simple = docs_processed_simple + [doc for sublist in markdown_documents_2 for doc in sublist]
-
-embedding_model = HuggingFaceEmbeddings(
-    model_name=EMBEDDING_MODEL_NAME
-)
-
-bm25_retriever = BM25Retriever.from_documents(
-    docs_processed_simple
-)
-bm25_retriever.k = 10
-
-# Создание готового bm25 ретривера
-with open('bm25_retriever.pkl', 'wb') as f:
-    pickle.dump(bm25_retriever, f)
-
-KNOWLEDGE_VECTOR_DATABASE = FAISS.from_documents(
-    docs_processed_simple, embedding_model, distance_strategy=DistanceStrategy.COSINE
-)
-
-KNOWLEDGE_VECTOR_DATABASE.save_local('VECTOR_DB')
+    target = Path(path)
+    directory = target.with_name(f'{target.name}.{time.time_ns()}')
+    index.save(directory)
+    link = target.with_name(f'{target.name}.link')
+    link.unlink(missing_ok=True)
+    link.symlink_to(directory.name)
+    if target.is_dir() and not target.is_symlink():
+        # каталог индекса прежних версий становится самой старой версией
+        target.rename(target.with_name(f'{target.name}.0'))
+    os.replace(link, target)
+
+    versions = sorted(
+        (version for version in target.parent.glob(f'{target.name}.*')
+         if version.suffix[1:].isdigit()),
+        key=lambda version: int(version.suffix[1:]))
+    for version in versions[:-2]:
+        shutil.rmtree(version, ignore_errors=True)
+
+
+def update_knowledge_base(full: bool = False,
+                          workers: int = os.cpu_count() or 1,
+                          batch_size: int = EMBEDDING_BATCH_SIZE,
+                          queue_size: int = EMBEDDING_QUEUE_SIZE,
+                          progress_interval: float = PROGRESS_INTERVAL):
+    start_time = time.monotonic()
+    cache = KnowledgeBaseCache(CACHE_PATH, EMBEDDING_MODEL_NAME)
+    if full:
+        cache.clear()
+
+    sources = list_sources()
+    cached_files = cache.files()
+    changed_files = []
+    for path, mode in sources:
+        hash_, chunking = file_hash(path), chunking_key(mode)
+        if cached_files.get(path) != (hash_, chunking):
+            changed_files.append((path, mode, hash_, chunking))
+    source_paths = {path for path, _ in sources}
+    removed = [path for path in cached_files if path not in source_paths]
+    cache.remove_files(removed)
+
+    progress = ingest(cache, changed_files, EMBEDDING_MODEL_NAME,
+                      CHUNK_SIZE, workers, batch_size, queue_size,
+                      progress_interval)
+    pruned = cache.prune_embeddings()
+    ingest_seconds = time.monotonic() - start_time
+
+    # индексы собираются заново, если изменились файлы, параметры
+    # индексов или originals.json (ссылки)
+    state = text_hash(json.dumps([
+        sorted(cache.files().items()), VECTOR_INDEX_TYPE,
+        VECTOR_INDEX_PARAMS,
+        file_hash(ORIGINALS_PATH) if os.path.exists(ORIGINALS_PATH) else None,
+    ]))
+    indexes_exist = all(os.path.exists(os.path.join(path, 'meta.json'))
+                        for path in (BM25_INDEX_PATH, VECTOR_INDEX_PATH))
+    if state == cache.get_state('indexes') and indexes_exist:
+        print('База знаний не изменилась')
+        cache.close()
+        return
+
+    documents, hashes, keys = assemble(cache, sources)
+    term_counts = chunk_term_counts(cache, documents, hashes)
+    # bm25 строится в python, faiss отпускает GIL: собираем параллельно;
+    # кэш (sqlite) читается только из основного потока
+    with ThreadPoolExecutor(1) as executor:
+        # Создание bm25 индекса (массивы numpy, читаются через mmap)
+        bm25_index = executor.submit(
+            BM25Index.build, documents, term_counts=term_counts)
+        # Создание векторного индекса (index.faiss и документы через mmap)
+        vector_index = build_vector_index(cache, documents, hashes, keys)
+        save_replacing(bm25_index.result(), BM25_INDEX_PATH)
+        save_replacing(vector_index, VECTOR_INDEX_PATH)
+    cache.set_state('indexes', state)
+    cache.close()
+
+    print(f'Файлов изменено: {len(changed_files)}, удалено: {len(removed)}; '
+          f'новых эмбеддингов: {progress.embedded}, удалено: {pruned}; '
+          f'chunks в индексах: {len(documents)}')
+    print(f'Загрузка и эмбеддинг: {ingest_seconds:.1f} с '
+          f'(эмбеддинг занят {progress.embedding_seconds:.1f} с), '
+          f'индексы: {time.monotonic() - start_time - ingest_seconds:.1f} с')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Update knowledge base indexes')
+    parser.add_argument('--full', action='store_true',
+                        help='drop cached chunks and embeddings')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes loading and splitting files')
+    parser.add_argument('--embedding-batch-size', type=int,
+                        default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument('--queue-size', type=int,
+                        default=EMBEDDING_QUEUE_SIZE,
+                        help='chunk texts waiting for embedding')
+    parser.add_argument('--progress-interval', type=float,
+                        default=PROGRESS_INTERVAL, help='seconds')
+    args = parser.parse_args()
+    update_knowledge_base(args.full, args.workers,
+                          args.embedding_batch_size, args.queue_size,
+                          args.progress_interval)
+
+
+if __name__ == '__main__':
+    main()
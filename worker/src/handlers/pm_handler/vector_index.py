@@ -0,0 +1,346 @@
+"""FAISS index over knowledge base chunks with a lazy docstore.
+
+Index directory (written by `VectorIndex.build(...).save(path)`):
+    meta.json        format version, index type, build and search params
+    index.faiss      FAISS index of L2-normalized embeddings, inner
+                     product metric (cosine similarity)
+    vector_ids.npy   FAISS id of every document
+    id_rows.npy      document number of every FAISS id, -1 if removed
+    keys.json        caller's key of every document (see update)
+    documents.jsonl, doc_offsets.npy  chunks (see docstore.py)
+Vectors are memory-mapped on load (inverted lists of IVF indexes, flat
+codes of flat and HNSW ones) as is the docstore, so processes share them
+through the page cache. Only HNSW links and IVF centroids are private.
+
+Index types:
+    flat      exact search, linear in the number of chunks
+    hnsw      HNSW graph over float vectors, recall grows with efSearch
+    hnsw_sq8  same over 8-bit scalar quantized vectors (4x smaller)
+    ivf_sq8   inverted lists of 8-bit codes, recall grows with nprobe
+              (default)
+    ivf_pq    inverted lists of product quantized codes (pq_m bytes per
+              vector), the smallest one
+Search params stored at build are defaults, `VectorIndex.load` takes
+overrides. `VectorIndex.update` changes an IVF index in place: vectors
+of removed document keys are dropped with `remove_ids`, vectors of new
+keys are added with `add_with_ids` (inverted lists keep the ids) and
+only these are read, so incremental knowledge base updates stay cheap.
+A rebuild of an IVF index still reuses the trained quantizer of the
+previous one while the number of chunks stays close (see
+_reusable_factory). HNSW graphs are built from scratch on every rebuild
+(the most expensive step for large bases): choose them for full
+rebuilds only, when search latency matters more than update time.
+
+Index of an existing langchain FAISS store without re-embedding:
+    python -m handlers.pm_handler.vector_index \
+        --from-langchain VECTOR_DB VECTOR_INDEX
+"""
+import argparse
+import json
+import math
+import pickle
+import re
+from pathlib import Path
+from typing import Any, Callable, Sequence
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .docstore import DocumentStore
+
+FORMAT_VERSION = 2
+INDEX_TYPES = ('flat', 'hnsw', 'hnsw_sq8', 'ivf_sq8', 'ivf_pq')
+IVF_TYPES = ('ivf_sq8', 'ivf_pq')
+# faiss needs that many training vectors per centroid for stable k-means
+MIN_POINTS_PER_CENTROID = 39
+# ids of removed vectors are not reused, an update gives up (and the
+# index is rebuilt with dense ids) once they outnumber live ones
+MAX_ID_SPARSITY = 2
+
+
+def _ivf_nlist(n_vectors: int, nlist: int | None) -> int:
+    if nlist is None:
+        nlist = 4 * int(math.sqrt(n_vectors))
+    return max(1, min(nlist, n_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def _factory_string(index_type: str, dimension: int, n_vectors: int,
+                    hnsw_m: int, nlist: int | None,
+                    pq_m: int | None) -> str:
+    if index_type == 'flat':
+        return 'Flat'
+    if index_type == 'hnsw':
+        return f'HNSW{hnsw_m},Flat'
+    if index_type == 'hnsw_sq8':
+        return f'HNSW{hnsw_m},SQ8'
+    nlist = _ivf_nlist(n_vectors, nlist)
+    if index_type == 'ivf_sq8':
+        return f'IVF{nlist},SQ8'
+    pq_m = pq_m or dimension // 16
+    if dimension % pq_m:
+        raise ValueError(f'pq_m={pq_m} does not divide dimension {dimension}')
+    return f'IVF{nlist},PQ{pq_m}'
+
+
+def _read_meta(path: Path) -> dict | None:
+    try:
+        meta = json.loads((path / 'meta.json').read_text())
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == FORMAT_VERSION else None
+
+
+def _reusable_factory(meta: dict, index_type: str, dimension: int,
+                      n_vectors: int, nlist: int | None,
+                      pq_m: int | None) -> str | None:
+    """Factory string of the previous IVF index if its centroids fit.
+
+    Centroids are reused while their number stays within 2x of the one
+    a new index would get, so added chunks do not retrain the index.
+    """
+    if (meta.get('index_type') != index_type
+            or meta.get('dimension') != dimension):
+        return None
+    previous_nlist = int(re.match(r'IVF(\d+),', meta['factory']).group(1))
+    target_nlist = _ivf_nlist(n_vectors, nlist)
+    if not target_nlist / 2 <= previous_nlist <= target_nlist * 2:
+        return None
+    factory = _factory_string(index_type, dimension, n_vectors, 0,
+                              previous_nlist, pq_m)
+    return factory if factory == meta['factory'] else None
+
+
+def _trained_index(path: Path, index_type: str, dimension: int,
+                   n_vectors: int, nlist: int | None,
+                   pq_m: int | None) -> tuple[Any, str | None]:
+    """Empty trained copy of IVF index at path and its factory string"""
+    meta = _read_meta(path)
+    factory = meta and _reusable_factory(meta, index_type, dimension,
+                                         n_vectors, nlist, pq_m)
+    if not factory:
+        return None, None
+    index = faiss.read_index(str(path / 'index.faiss'))
+    index.reset()
+    return index, factory
+
+
+class VectorIndex:
+    def __init__(self, meta: dict, index: Any, docstore: DocumentStore,
+                 vector_ids: np.ndarray, keys: list[str] | None = None,
+                 id_rows: np.ndarray | None = None):
+        self.meta = meta
+        self.index = index
+        self.docstore = docstore
+        self.vector_ids = vector_ids
+        # only kept while building, loaded indexes do not need them
+        self.keys = keys
+        if id_rows is None:
+            id_rows = np.full(meta['next_id'], -1, dtype=np.int64)
+            id_rows[vector_ids] = np.arange(len(vector_ids))
+        self.id_rows = id_rows
+
+    @classmethod
+    def build(cls, documents: Sequence[Document], vectors: np.ndarray,
+              index_type: str = 'ivf_sq8', hnsw_m: int = 32,
+              ef_construction: int = 200, ef_search: int = 64,
+              nlist: int | None = None, nprobe: int = 16,
+              pq_m: int | None = None,
+              previous: str | Path | None = None,
+              keys: Sequence[str] | None = None) -> 'VectorIndex':
+        """Index of `vectors[i]`, the embedding of `documents[i]`
+
+        `previous` is the directory of an index being replaced, `keys`
+        identify documents for later updates (document numbers if None).
+        """
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f'Unknown index type {index_type}, '
+                             f'expected one of {INDEX_TYPES}')
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        n_vectors, dimension = vectors.shape
+        if index_type == 'ivf_pq' and n_vectors < 256:
+            # 8-bit PQ codebooks need 256 training vectors
+            index_type = 'ivf_sq8'
+        if index_type in IVF_TYPES and n_vectors < MIN_POINTS_PER_CENTROID:
+            index_type = 'flat'
+        faiss.normalize_L2(vectors)
+
+        index = None
+        if index_type in IVF_TYPES and previous is not None:
+            index, factory = _trained_index(Path(previous), index_type,
+                                            dimension, n_vectors, nlist,
+                                            pq_m)
+        if index is None:
+            factory = _factory_string(index_type, dimension, n_vectors,
+                                      hnsw_m, nlist, pq_m)
+            index = faiss.index_factory(dimension, factory,
+                                        faiss.METRIC_INNER_PRODUCT)
+        search_params = {}
+        if index_type.startswith('hnsw'):
+            index.hnsw.efConstruction = ef_construction
+            search_params['efSearch'] = ef_search
+        elif index_type in IVF_TYPES:
+            search_params['nprobe'] = nprobe
+        if not index.is_trained:
+            index.train(vectors)
+        # sequential ids of added vectors are the document numbers
+        index.add(vectors)
+
+        meta = {'version': FORMAT_VERSION, 'index_type': index_type,
+                'factory': factory, 'dimension': dimension,
+                'n_docs': n_vectors, 'next_id': n_vectors,
+                'search_params': search_params}
+        if keys is None:
+            keys = [str(doc_number) for doc_number in range(n_vectors)]
+        return cls(meta, index, DocumentStore.from_documents(documents),
+                   np.arange(n_vectors, dtype=np.int64), list(keys))
+
+    @classmethod
+    def update(cls, path: str | Path, documents: Sequence[Document],
+               keys: Sequence[str],
+               vectors: Callable[[list[int]], np.ndarray],
+               index_type: str = 'ivf_sq8', nlist: int | None = None,
+               nprobe: int = 16, pq_m: int | None = None,
+               **hnsw_params: int) -> 'VectorIndex | None':
+        """IVF index at path changed to index `documents` in place.
+
+        `keys[i]` identifies `documents[i]` and its vector: a key kept
+        from the previous build keeps its vector, `vectors(numbers)`
+        returns embeddings of documents with new keys. Returns None when
+        the index has to be built anew (other type or params, centroids
+        do not fit the new size, too many removed ids). `hnsw_params`
+        of build do not apply to IVF indexes and are ignored.
+        """
+        path = Path(path)
+        meta = _read_meta(path)
+        n_vectors = len(keys)
+        if (index_type not in IVF_TYPES or meta is None
+                or n_vectors < MIN_POINTS_PER_CENTROID
+                or (index_type == 'ivf_pq' and n_vectors < 256)
+                or meta['search_params'] != {'nprobe': nprobe}
+                or not _reusable_factory(meta, index_type,
+                                         meta['dimension'], n_vectors,
+                                         nlist, pq_m)):
+            return None
+
+        previous_ids = dict(zip(
+            json.loads((path / 'keys.json').read_text()),
+            np.load(path / 'vector_ids.npy').tolist()))
+        next_id = meta['next_id']
+        vector_ids = np.empty(n_vectors, dtype=np.int64)
+        added = []
+        for doc_number, key in enumerate(keys):
+            vector_id = previous_ids.pop(key, None)
+            if vector_id is None:
+                vector_id = next_id
+                next_id += 1
+                added.append(doc_number)
+            vector_ids[doc_number] = vector_id
+        if next_id > MAX_ID_SPARSITY * n_vectors:
+            return None
+
+        index = faiss.read_index(str(path / 'index.faiss'))
+        if previous_ids:
+            index.remove_ids(np.array(list(previous_ids.values()),
+                                      dtype=np.int64))
+        if added:
+            new_vectors = np.ascontiguousarray(vectors(added),
+                                               dtype=np.float32)
+            faiss.normalize_L2(new_vectors)
+            index.add_with_ids(new_vectors, vector_ids[added])
+
+        meta = {**meta, 'n_docs': n_vectors, 'next_id': next_id}
+        return cls(meta, index, DocumentStore.from_documents(documents),
+                   vector_ids, list(keys))
+
+    def save(self, path: str | Path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        faiss.write_index(self.index, str(path / 'index.faiss'))
+        np.save(path / 'vector_ids.npy', self.vector_ids)
+        np.save(path / 'id_rows.npy', self.id_rows)
+        (path / 'keys.json').write_text(
+            json.dumps(self.keys, ensure_ascii=False))
+        self.docstore.save(path)
+        # meta goes last: an index without it is incomplete
+        (path / 'meta.json').write_text(json.dumps(self.meta))
+
+    @classmethod
+    def load(cls, path: str | Path,
+             search_params: dict[str, int] | None = None) -> 'VectorIndex':
+        # a symlinked index may be switched to a new version meanwhile
+        path = Path(path).resolve()
+        meta = json.loads((path / 'meta.json').read_text())
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError(
+                f'Vector index format {meta["version"]} is not supported')
+        if meta['index_type'] in IVF_TYPES:
+            io_flags = faiss.IO_FLAG_MMAP
+        else:
+            # zero-copy mmap of flat codes, faiss >= 1.10
+            io_flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+        index = faiss.read_index(str(path / 'index.faiss'),
+                                 io_flags | faiss.IO_FLAG_READ_ONLY)
+
+        params = {**meta['search_params'], **(search_params or {})}
+        if params:
+            faiss.ParameterSpace().set_index_parameters(
+                index, ','.join(f'{k}={v}' for k, v in params.items()))
+        return cls(meta, index, DocumentStore.load(path),
+                   np.load(path / 'vector_ids.npy', mmap_mode='r'),
+                   id_rows=np.load(path / 'id_rows.npy', mmap_mode='r'))
+
+    def search(self, vectors: np.ndarray,
+               k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Numbers and cosine similarities of top k documents per query"""
+        vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+        faiss.normalize_L2(vectors)
+        scores, vector_ids = self.index.search(vectors, k)
+        # faiss pads results with -1 when fewer than k are found
+        doc_numbers = np.where(vector_ids >= 0,
+                               self.id_rows[np.maximum(vector_ids, 0)], -1)
+        return doc_numbers, scores
+
+    def document(self, doc_number: int) -> Document:
+        return self.docstore[doc_number]
+
+
+class VectorIndexRetriever(BaseRetriever):
+    """Langchain retriever over VectorIndex"""
+
+    index: Any
+    embeddings: Any
+    k: int = 5
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: Any = None) -> list[Document]:
+        vector = self.embeddings.embed_query(query)
+        doc_numbers, _ = self.index.search(vector, self.k)
+        # faiss pads results with -1 when fewer than k are found
+        return [self.index.document(int(i)) for i in doc_numbers[0] if i >= 0]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build vector index from langchain FAISS store')
+    parser.add_argument('--from-langchain', required=True,
+                        help='directory with index.faiss and index.pkl')
+    parser.add_argument('--index-type', choices=INDEX_TYPES,
+                        default='ivf_sq8')
+    parser.add_argument('directory')
+    args = parser.parse_args()
+
+    source = Path(args.from_langchain)
+    flat_index = faiss.read_index(str(source / 'index.faiss'))
+    with open(source / 'index.pkl', 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    vectors = flat_index.reconstruct_n(0, flat_index.ntotal)
+    documents = [docstore.search(index_to_docstore_id[i])
+                 for i in range(flat_index.ntotal)]
+    VectorIndex.build(documents, vectors, args.index_type).save(
+        args.directory)
+
+
+if __name__ == '__main__':
+    main()
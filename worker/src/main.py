@@ -1,18 +1,31 @@
 import asyncio
 import json
+import multiprocessing
 import signal
 import sys
 import time
-from typing import Callable
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from datetime import datetime, timezone
 
 from loguru import logger
 from redis.asyncio import Redis
+from suz_shared.codec import decode_task
+from suz_shared.redis_cache import create_redis
+from suz_shared.redis_functions import load_redis_functions
 
-from handlers import verify_handlers
+from handlers import Handler, verify_handlers
 from schemas.answer import Answer
-from schemas.handler import HandlerConfig
+from schemas.handler import HandlerConfig, HandlerExecutor
 from schemas.task import Task, TaskStatus
 from settings import settings
+from utils.metrics_utils import (busy_slots, observe_queue_wait,
+                                 observe_redis_command, processing_seconds,
+                                 slot_limit, start_exporter, tasks_finished)
+from utils.redis_functions import (claim_task, complete_task, fail_task,
+                                   prune_workers, reap_leases, release_leases,
+                                   renew_leases, worker_heartbeat,
+                                   worker_leave)
 
 logger.add('worker.log', level=settings.LOGLEVEL, rotation='10 MB')
 
@@ -21,15 +34,21 @@ class Worker:
     def __init__(self):
         self.started = False
         self.id = f'worker:{str(time.time()).replace(".", "")}'
-        self.redis = Redis(
-            host=settings.HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
+        self.redis = create_redis(
+            settings.HOST, settings.REDIS_PORT, settings.REDIS_DB,
+            settings.REDIS_MAX_CONNECTIONS, settings.REDIS_POOL_TIMEOUT,
             socket_timeout=10,
             socket_connect_timeout=5,
-            decode_responses=True
         )
+        self.redis.command_observer = observe_redis_command
         self.tasks = set()
+        self.processing = set()
+        self.leases: set[str] = set()
+        self.handlers: dict[str, Handler] = {}
+        self.healthy_handlers: set[str] = set()
+        self.executors: dict[str, Executor] = {}
+        self.slots: dict[str, asyncio.Semaphore] = {}
+        self.slot_released = asyncio.Event()
         self.shutdown_event = asyncio.Event()
 
     async def __aenter__(self):
@@ -44,6 +63,10 @@ class Worker:
             return
 
         logger.info('ℹ️ Starting cleanup procedure...')
+        if self.processing:
+            logger.info(
+                f'ℹ️ Waiting for {len(self.processing)} running tasks...')
+            await asyncio.wait(self.processing, timeout=10.0)
         for task in self.tasks:
             task.cancel()
         try:
@@ -54,8 +77,25 @@ class Worker:
         except asyncio.TimeoutError:
             logger.warning('⚠️ Some tasks did not finish gracefully')
 
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
         try:
-            await self.redis.delete(self.id)
+            requeued = await release_leases(self.redis, self.id, self.leases)
+            if requeued:
+                logger.info(f'♻️ Unfinished tasks requeued: {requeued}')
+        except Exception as e:
+            logger.error(f'‼️ Unable to release leases: {e}')
+
+        for handler in self.handlers.values():
+            try:
+                await handler.teardown()
+            except Exception as e:
+                logger.error(
+                    f'‼️ Teardown error "{handler.handler_id}": {e}')
+
+        try:
+            await worker_leave(self.redis, self.id)
 
         except Exception as e:
             logger.error(f'‼️ Cleanup error: {e}')
@@ -69,6 +109,78 @@ class Worker:
         task.add_done_callback(lambda t: self.tasks.remove(t))
         return task
 
+    def setup_executors(self, handlers_configs: list[HandlerConfig]):
+        """Create a pool and a concurrency slot counter per handler"""
+        for h_config in handlers_configs:
+            if h_config.executor == HandlerExecutor.PROCESS:
+                # fork would copy the worker state (event loop, Redis
+                # connections, threads) into the pool processes
+                executor = ProcessPoolExecutor(
+                    max_workers=h_config.max_concurrency,
+                    mp_context=multiprocessing.get_context('spawn'))
+            else:
+                executor = ThreadPoolExecutor(
+                    max_workers=h_config.max_concurrency,
+                    thread_name_prefix=h_config.task_type)
+            self.executors[h_config.handler_id] = executor
+            self.slots[h_config.handler_id] = asyncio.Semaphore(
+                h_config.max_concurrency)
+            slot_limit.labels(h_config.handler_id).set(
+                h_config.max_concurrency)
+            logger.info(
+                f'ℹ️ {h_config.handler_id}: {h_config.executor.value} '
+                f'executor, max concurrency {h_config.max_concurrency}')
+
+    def remove_executors(self, handler_ids: set[str]):
+        """Shut down pools of handlers that failed verification"""
+        for handler_id in handler_ids:
+            self.executors.pop(handler_id).shutdown(
+                wait=False, cancel_futures=True)
+            del self.slots[handler_id]
+
+    def free_handlers(self) -> list[str]:
+        """Handlers that can accept one more task"""
+        return [handler_id
+                for handler_id, slot in self.slots.items()
+                if not slot.locked() and handler_id in self.healthy_handlers]
+
+    async def wait_for_slot(self, timeout: float = 1.0):
+        self.slot_released.clear()
+        try:
+            await asyncio.wait_for(self.slot_released.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def start_processing(self, handler_id: str, coro):
+        """Run coro in a handler slot, slot must be acquired by caller"""
+        async def run_in_slot():
+            busy = busy_slots.labels(handler_id)
+            busy.inc()
+            try:
+                await coro
+            finally:
+                busy.dec()
+                self.slots[handler_id].release()
+                self.slot_released.set()
+
+        task = self.create_task(run_in_slot())
+        self.processing.add(task)
+        task.add_done_callback(self.processing.discard)
+        return task
+
+    async def run_handler(self, handler: Handler, task: Task) -> Answer:
+        """Await async handler or execute sync one in its executor"""
+        return await handler(task)
+
+    async def check_health(self) -> bool:
+        """Refresh healthy handlers set, return True if it changed"""
+        healthy_handlers = {
+            handler_id for handler_id, handler in self.handlers.items()
+            if await handler.health()}
+        changed = healthy_handlers != self.healthy_handlers
+        self.healthy_handlers = healthy_handlers
+        return changed
+
 
 async def run_worker():
     async with Worker() as worker:
@@ -78,13 +190,21 @@ async def run_worker():
                 loop.add_signal_handler(sig, worker.shutdown_event.set)
 
         try:
-            handlers_funcs = verify_handlers(settings.HANDLERS)
-
-            await __store_handlers(worker, handlers_funcs)
+            await load_redis_functions(worker.redis)
+            worker.setup_executors(settings.HANDLERS)
+            worker.handlers = await verify_handlers(
+                settings.HANDLERS, worker.executors)
+            worker.remove_executors(
+                set(worker.executors) - set(worker.handlers))
+            worker.healthy_handlers = set(worker.handlers)
+
+            await __store_handlers(worker, worker.handlers)
             worker.started = True
+            start_exporter(settings.METRICS_PORT)
             worker.create_task(heartbeat(worker))
+            worker.create_task(lease_reaper(worker))
 
-            await __worker_loop(worker, handlers_funcs)
+            await __worker_loop(worker, worker.handlers)
 
         except asyncio.CancelledError:
             logger.info('ℹ️ Worker stopped gracefully')
@@ -94,7 +214,7 @@ async def run_worker():
 
 
 async def __store_handlers(
-        worker:Worker, handlers_funcs: dict[str, Callable[[Task], Answer]]):
+        worker:Worker, handlers_funcs: dict[str, Handler]):
     redis = worker.redis
     """Store and verify handlers in Redis"""
     to_remove = []
@@ -113,15 +233,11 @@ async def __store_handlers(
         f'ℹ️ Available worker handlers:'
         f' {[h.handler_id for h in settings.HANDLERS]}')
 
-    json_worker_handlers = json.dumps(
-        [h.handler_id for h in settings.HANDLERS])
     json_stored_handlers_configs = await __get_handlers_configs(redis)
 
-    async with redis.pipeline() as pipe:
-        await pipe.set('handlers_configs', json_stored_handlers_configs)
-        await pipe.setex(worker.id, 30, json_worker_handlers)
-        await pipe.lpush('workers', worker.id)
-        await pipe.execute()
+    # configs go first: backend reads them when worker joins
+    await redis.set('handlers_configs', json_stored_handlers_configs)
+    await worker_heartbeat(redis, worker.id, list(handlers_funcs))
 
     logger.info(f'ℹ️ {worker.id} handlers successfully stored in Redis')
 
@@ -150,32 +266,64 @@ async def heartbeat(worker: Worker):
     """Update worker alive status"""
     while not worker.shutdown_event.is_set():
         try:
-            await worker.redis.expire(worker.id, 30)
-            await asyncio.sleep(15)
+            health_changed = await worker.check_health()
+            updated = await worker_heartbeat(
+                worker.redis, worker.id, list(worker.healthy_handlers))
+            if health_changed:
+                logger.warning(
+                    f'⚠️ Healthy handlers changed: '
+                    f'{sorted(worker.healthy_handlers)}')
+            elif updated:
+                logger.warning(f'⚠️ {worker.id} was pruned, registered again')
+            await renew_leases(
+                worker.redis, worker.leases, settings.TASK_LEASE_TIMEOUT)
         except Exception as e:
+            # keep beating: a stopped heartbeat lets other workers reap
+            # leases of tasks still running here
             logger.warning(f'⚠️ Heartbeat failed: {e}')
-            break
+        await asyncio.sleep(settings.HEARTBEAT_INTERVAL)
+
+
+async def lease_reaper(worker: Worker):
+    """Requeue tasks leased by workers that are gone"""
+    while not worker.shutdown_event.is_set():
+        try:
+            pruned = await prune_workers(worker.redis, settings.WORKER_TTL)
+            if pruned:
+                logger.warning(f'⚠️ Dead workers removed: {pruned}')
+            requeued = await reap_leases(worker.redis)
+            if requeued:
+                logger.warning(f'♻️ Orphaned tasks requeued: {requeued}')
+        except Exception as e:
+            logger.warning(f'⚠️ Lease reaper failed: {e}')
+        await asyncio.sleep(settings.LEASE_REAPER_INTERVAL)
 
 
 async def __worker_loop(
-        worker: Worker, handlers_funcs: dict[str, Callable[[Task], Answer]]):
+        worker: Worker, handlers_funcs: dict[str, Handler]):
     """Start main worker processing loop"""
-    handler_id_queues = [
-        f'task_queue:{handler_id}' for handler_id in handlers_funcs.keys()]
     while not worker.shutdown_event.is_set():
         try:
-            source_queue, task_id = await worker.redis.brpop(
-                handler_id_queues, timeout=1)
-            if not task_id:
+            handler_ids = worker.free_handlers()
+            if not handler_ids:
+                await worker.wait_for_slot()
                 continue
 
-            logger.info(f'ℹ️ Received task: {task_id} from {source_queue}')
-            async with worker.redis.pipeline() as pipe:
-                await pipe.lrem('task_queue', 0, task_id)
-                await pipe.lpush('processing_queue', task_id)
-                await pipe.execute()
+            claimed = await claim_task(
+                worker.redis, worker.id, handler_ids,
+                settings.TASK_LEASE_TIMEOUT)
+            if not claimed:
+                await asyncio.sleep(settings.CLAIM_POLL_INTERVAL)
+                continue
+
+            handler_id, task_id = claimed
+            worker.leases.add(task_id)
+            logger.info(
+                f'ℹ️ Received task: {task_id} from task_queue:{handler_id}')
 
-            await __process_task(worker.redis, task_id, handlers_funcs)
+            await worker.slots[handler_id].acquire()
+            worker.start_processing(
+                handler_id, __process_task(worker, task_id, handlers_funcs))
 
         except asyncio.CancelledError:
             logger.info('ℹ️ Worker loop cancelled')
@@ -190,11 +338,15 @@ async def __worker_loop(
 
 
 async def __process_task(
-        redis: Redis,
+        worker: Worker,
         task_id: str,
-        handlers_funcs: dict[str, Callable[[Task], Answer]]):
+        handlers_funcs: dict[str, Handler]):
+    redis = worker.redis
+    handler_id = ''
     try:
         task = await __get_task(redis, task_id)
+        handler_id = task.handler_id
+        observe_queue_wait(task)
         handler = handlers_funcs.get(task.handler_id)
 
         if not handler:  # TODO move task to pending?
@@ -202,8 +354,9 @@ async def __process_task(
 
         logger.debug(f'⚙️ Processing prompt: {task.prompt}')
         start_time = time.time()
-        result = handler(task)
+        result = await worker.run_handler(handler, task)
         processing_time = time.time() - start_time
+        processing_seconds.labels(handler_id).observe(processing_time)
 
         if isinstance(result, str):
             result = Answer(text=result)
@@ -211,26 +364,26 @@ async def __process_task(
         task.status = TaskStatus.COMPLETED
         task.result = result
         task.worker_processing_time = processing_time
+        task.finished_at = datetime.now(timezone.utc).isoformat()
         logger.debug(f'⚙️ Result: {result}')
 
-        async with redis.pipeline() as pipe:
-            await pipe.setex(f'task:{task_id}', 86400, task.model_dump_json())
-            await pipe.lrem('processing_queue', 1, task_id)
-            await pipe.execute()
+        await complete_task(redis, task)
+        tasks_finished.labels(handler_id, 'completed').inc()
 
         logger.success(
             f'✅️ Task {task_id} completed in {processing_time:.2f}s')
 
     except Exception as e:
-        await __handle_task_error(redis, task_id, e)
+        await __handle_task_error(redis, task_id, handler_id, e)
+    worker.leases.discard(task_id)
 
 
 async def __get_task(redis: Redis, task_id: str) -> Task:
     try:
-        task_data = await redis.get(f'task:{task_id}')
+        task_data = await redis.hgetall(f'task:{task_id}')
         if not task_data:
             raise KeyError('Task not found')
-        task = Task.model_validate_json(task_data)
+        task = decode_task(task_data)
         task.status = TaskStatus.RUNNING
     except Exception as e:
         logger.error(f'‼️ Task startup error {task_id}: {e}')
@@ -238,41 +391,27 @@ async def __get_task(redis: Redis, task_id: str) -> Task:
     return task
 
 
-async def __handle_task_error(redis: Redis, task_id: str, error: Exception):
+async def __handle_task_error(
+        redis: Redis, task_id: str, handler_id: str, error: Exception):
     """Handle task processing errors"""
     try:
-        task_data = await redis.get(f'task:{task_id}')
-        if not task_data:
+        error_msg = str(error)
+        failed = await fail_task(
+            redis, task_id, Answer(text=error_msg), settings.MAX_RETRIES,
+            datetime.now(timezone.utc).isoformat())
+        if not failed:
             logger.error(f'‼️ Task {task_id} not found')
             return
 
-        task = Task.model_validate_json(task_data)
-        task.retries += 1
-        error_msg = str(error)
-
-        if task.retries >= settings.MAX_RETRIES:
-            task.error = Answer(text=error_msg)
-            task.status = TaskStatus.FAILED
-            task_data = task.model_dump_json()
-            async with redis.pipeline() as pipe:
-                await pipe.lrem('processing_queue', 1, task_id)
-                await pipe.rpush('dead_letters', task_id)
-                await pipe.setex(f'task:{task_id}', 86400, task_data)
-                await pipe.execute()
-
+        outcome, retries = failed
+        tasks_finished.labels(
+            handler_id, 'failed' if outcome == 'failed' else 'retried').inc()
+        if outcome == 'failed':
             logger.error(f'‼️ Task {task_id} moved to DLQ: {error_msg}')
         else:
-            task_data = task.model_dump_json()
-            async with redis.pipeline() as pipe:
-                await pipe.lrem('processing_queue', 1, task_id)
-                await pipe.rpush('task_queue', task_id)
-                await pipe.lpush(f'task_queue:{task.handler_id}', task_id)
-                await pipe.setex(f'task:{task_id}', 86400, task_data)
-                await pipe.execute()
-
             logger.warning(
                 f'⚠️ Retry for task {task_id}'
-                f' (attempt {task.retries}): {error_msg}')
+                f' (attempt {retries}): {error_msg}')
 
     except Exception as e:
         logger.error(f'‼️ Critical task processing error {task_id}: {e}')
@@ -1,6 +1,3 @@
-from pydantic import BaseModel
+from suz_shared.schemas.answer import Answer
 
-
-class Answer(BaseModel):
-    text: str
-    relevant_docs: dict[str, str] = {}
+__all__ = ['Answer']
@@ -18,9 +18,17 @@ class Settings(BaseSettings):
     HOST: str = '127.0.0.1'
     REDIS_PORT: int = 6379
     REDIS_DB: int = 0
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: float = 5
 
     MODEL_PATH: str = ''
     MAX_RETRIES: int = 3
+    TASK_LEASE_TIMEOUT: int = 60
+    LEASE_REAPER_INTERVAL: int = 15
+    CLAIM_POLL_INTERVAL: float = 0.2
+    HEARTBEAT_INTERVAL: int = 10
+    WORKER_TTL: int = 30
+    METRICS_PORT: int = 0  # 0 disables the metrics exporter
     HANDLERS: list[HandlerConfig]
 
     @classmethod
@@ -0,0 +1,59 @@
+"""Prometheus metrics of worker.
+
+Exported over HTTP on METRICS_PORT (0, the default, disables the
+exporter), every worker process of a host needs its own port; a worker
+whose port is taken runs without metrics. Observations only take a lock
+and increment a bucket, so they stay on in production.
+"""
+from datetime import datetime, timezone
+
+from loguru import logger
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from schemas.task import Task
+
+WAIT_BUCKETS = (.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+PROCESSING_BUCKETS = (.1, .25, .5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+REDIS_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+
+queue_wait_seconds = Histogram(
+    'suz_task_queue_wait_seconds',
+    'Time from enqueue (of the first attempt) to claim',
+    ('handler_id',), buckets=WAIT_BUCKETS)
+processing_seconds = Histogram(
+    'suz_task_processing_seconds', 'Handler run time',
+    ('handler_id',), buckets=PROCESSING_BUCKETS)
+tasks_finished = Counter(
+    'suz_tasks_finished', 'Finished task attempts',
+    ('handler_id', 'outcome'))
+busy_slots = Gauge(
+    'suz_worker_busy_slots', 'Tasks being processed', ('handler_id',))
+slot_limit = Gauge(
+    'suz_worker_slots', 'Handler concurrency limit', ('handler_id',))
+redis_command_seconds = Histogram(
+    'suz_worker_redis_command_duration_seconds',
+    'Redis command latency', ('command',), buckets=REDIS_BUCKETS)
+
+
+def start_exporter(port: int):
+    if not port:
+        return
+    try:
+        start_http_server(port)
+    except OSError as e:
+        logger.warning(f'⚠️ Metrics exporter not started on port {port}: {e}')
+
+
+def observe_redis_command(command: str, seconds: float):
+    redis_command_seconds.labels(command).observe(seconds)
+
+
+def observe_queue_wait(task: Task):
+    try:
+        queued_at = datetime.fromisoformat(task.queued_at)
+    except ValueError:
+        return
+    if queued_at.tzinfo is None:
+        queued_at = queued_at.replace(tzinfo=timezone.utc)
+    queue_wait_seconds.labels(task.handler_id).observe(max(
+        (datetime.now(timezone.utc) - queued_at).total_seconds(), 0))
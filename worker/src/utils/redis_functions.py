@@ -0,0 +1,85 @@
+"""Worker side of the `suz_queue` Redis Functions library.
+
+Library source lives in `redis_functions/suz_queue.lua` in the project
+root and is shared with backend, see the file header for semantics. It
+is loaded by `suz_shared.redis_functions.load_redis_functions`.
+"""
+import json
+
+from redis.asyncio import Redis
+from suz_shared.codec import encode_task
+
+from schemas.answer import Answer
+from schemas.task import Task
+
+
+async def worker_heartbeat(
+        redis: Redis, worker_id: str, handler_ids: list[str]) -> bool:
+    """Register worker or refresh its heartbeat.
+
+    Returns True if worker joined (again) or its handlers changed.
+    """
+    return bool(await redis.fcall(
+        'worker_heartbeat', 0, worker_id, json.dumps(sorted(handler_ids))))
+
+
+async def worker_leave(redis: Redis, worker_id: str):
+    await redis.fcall('worker_leave', 0, worker_id)
+
+
+async def prune_workers(redis: Redis, worker_ttl: int) -> list[str]:
+    """Remove workers that missed heartbeats, return their ids"""
+    return await redis.fcall('worker_prune', 0, worker_ttl)
+
+
+async def claim_task(
+        redis: Redis, worker_id: str, handler_ids: list[str],
+        lease_timeout: int) -> tuple[str, str] | None:
+    """Pop first available task of handlers and lease it to worker"""
+    claimed = await redis.fcall(
+        'task_claim', 0, worker_id, lease_timeout, *handler_ids)
+    if not claimed:
+        return None
+    handler_id, task_id = claimed
+    return handler_id, task_id
+
+
+async def renew_leases(
+        redis: Redis, task_ids: set[str], lease_timeout: int):
+    if task_ids:
+        await redis.fcall('lease_renew', 0, lease_timeout, *task_ids)
+
+
+async def release_leases(
+        redis: Redis, worker_id: str, task_ids: set[str]) -> list[str]:
+    """Return unfinished tasks of the worker back to their queues"""
+    if not task_ids:
+        return []
+    return await redis.fcall('lease_requeue', 0, worker_id, 0, *task_ids)
+
+
+async def reap_leases(redis: Redis, limit: int = 100) -> list[str]:
+    """Requeue expired leases of dead workers"""
+    return await redis.fcall('lease_requeue', 0, '', limit)
+
+
+async def complete_task(redis: Redis, task: Task):
+    """Store task result fields and finish processing"""
+    fields = encode_task(
+        task, include={'result', 'worker_processing_time', 'finished_at'})
+    await redis.fcall(
+        'task_complete', 0, task.task_id,
+        *[item for field in fields.items() for item in field])
+
+
+async def fail_task(
+        redis: Redis, task_id: str, error: Answer, max_retries: int,
+        finished_at: str) -> tuple[str, int] | None:
+    """Count failed attempt, return outcome ('retry'/'failed') and retries"""
+    failed = await redis.fcall(
+        'task_fail', 0, task_id, error.model_dump_json(), max_retries,
+        finished_at)
+    if not failed:
+        return None
+    outcome, retries = failed
+    return outcome, retries